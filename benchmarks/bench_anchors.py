@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+'''
+benchmarks/bench_anchors.py
+
+Compares the streaming anchor extraction used by the WAF parsers to the
+BeautifulSoup implementation it replaced on large synthetic directory
+listings. BeautifulSoup is only needed to run the comparison. Each parser
+runs in a new process of its own, and its memory use is reported as the
+growth of the peak resident memory of that process while parsing.
+
+Usage::
+
+    python benchmarks/bench_anchors.py --rows 50000
+
+'''
+from __future__ import print_function
+from catalog_harvesting.anchors import get_anchors, get_erddap_anchors
+from distutils.version import LooseVersion
+import argparse
+import os
+import resource
+import six
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def waf_listing(rows):
+    '''
+    Returns an Apache style directory listing of rows XML documents
+
+    :param int rows: Number of documents in the listing
+    '''
+    lines = ['<html><head><title>Index of /iso</title></head><body>',
+             '<h1>Index of /iso</h1><table>',
+             '<tr><td><a href="/">Parent Directory</a></td></tr>']
+    for i in range(rows):
+        lines.append('<tr><td><a href="dataset_%06d.xml">dataset_%06d.xml</a>'
+                     '</td><td>2018-01-01 00:00</td><td>24K</td></tr>' % (i, i))
+    lines.append('</table></body></html>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def erddap_listing(rows, version='1.82'):
+    '''
+    Returns an ERDDAP WAF listing of rows XML documents. ERDDAP versions older
+    than 1.82 list the documents in a <pre>, newer ones in a table.
+
+    :param int rows: Number of documents in the listing
+    :param str version: ERDDAP version reported in the footer
+    '''
+    new_layout = LooseVersion(version) >= LooseVersion('1.82')
+    lines = ['<html><head><title>ERDDAP - Index of /erddap/metadata/iso19115/xml/</title></head><body>',
+             '<div class="standard_width">' if new_layout else '<div>',
+             '<table class="compact nowrap">' if new_layout else '<pre>']
+    for i in range(rows):
+        row = ('<a href="dataset_%06d_iso19115.xml">dataset_%06d_iso19115.xml</a>' % (i, i))
+        if new_layout:
+            lines.append('<tr><td>%s</td><td>01-Jan-2018 00:00</td><td>24K</td></tr>' % row)
+        else:
+            lines.append('%s 01-Jan-2018 00:00 24K' % row)
+    lines.append('</table>' if new_layout else '</pre>')
+    lines.append('</div><p>ERDDAP, Version %s</p></body></html>' % version)
+    return '\n'.join(lines).encode('utf-8')
+
+
+def soup_anchors(content):
+    '''
+    The original WAFParser.get_links
+    '''
+    soup = BeautifulSoup(content, 'html.parser')
+    return [(a.get('href'), a.text) for a in soup.find_all('a')]
+
+
+def soup_erddap_anchors(content):
+    '''
+    The original ERDDAPWAFParser.get_links
+    '''
+    soup = BeautifulSoup(content, 'html.parser')
+    raw_ver = soup.find(text=lambda t: 'ERDDAP, Version ' in t)
+    if not isinstance(raw_ver, six.string_types):
+        ver_full = None
+    else:
+        try:
+            ver_full = LooseVersion(raw_ver.strip().rsplit()[-1])
+        except:
+            ver_full = None
+
+    if ver_full is None or ver_full < LooseVersion('1.82'):
+        link_container = soup.find('pre')
+    else:
+        link_container = soup.find('div', {'class': 'standard_width'}).find('table')
+
+    return [(link.get('href'), link.text) for link in
+            link_container.find_all('a', text=lambda t: t.endswith('.xml'))]
+
+
+# Listing name to (function returning the listing, streaming parser,
+# BeautifulSoup parser)
+LISTINGS = [
+    ('WAF', waf_listing, get_anchors, soup_anchors),
+    ('ERDDAP 1.80', lambda rows: erddap_listing(rows, '1.80'),
+     get_erddap_anchors, soup_erddap_anchors),
+    ('ERDDAP 1.82', lambda rows: erddap_listing(rows, '1.82'),
+     get_erddap_anchors, soup_erddap_anchors)
+]
+
+
+def peak_rss():
+    '''
+    Returns the peak resident memory of this process in KB. On Linux
+    ru_maxrss keeps the peak of the parent process from before the fork, so
+    the peak of this process is read from /proc where available.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(path, listing, label):
+    '''
+    Parses the listing saved at path in this process and prints the elapsed
+    time, the growth of the peak resident memory while parsing and the number
+    of anchors found. Only meaningful in a process that has done nothing
+    else, so the listing is read from a file rather than generated.
+    '''
+    for name, make_listing, streaming, soup in LISTINGS:
+        if name == listing:
+            func = streaming if label == 'streaming' else soup
+    with open(path, 'rb') as f:
+        content = f.read()
+    before = peak_rss()
+    start = time.time()
+    anchors = func(content)
+    elapsed = time.time() - start
+    peak = peak_rss()
+    print(elapsed, peak - before, len(anchors))
+
+
+def run(path, listing, label):
+    '''
+    Returns the results of measure, run in a new Python process so the memory
+    of earlier parses doesn't hide the memory used by this one
+    '''
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__),
+        '--measure', path, listing, label
+    ])
+    elapsed, peak, count = output.split()
+    return float(elapsed), int(peak), int(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rows', type=int, default=20000,
+                        help='Number of documents in each listing')
+    parser.add_argument('--measure', nargs=3,
+                        metavar=('PATH', 'LISTING', 'PARSER'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    labels = ['streaming']
+    if BeautifulSoup is not None:
+        labels.append('beautifulsoup')
+    print('%-12s %-14s %10s %12s %8s' % ('listing', 'parser', 'seconds',
+                                         'peak +KB', 'anchors'))
+    for name, make_listing, streaming, soup in LISTINGS:
+        fd, path = tempfile.mkstemp(suffix='.html')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(make_listing(args.rows))
+            for label in labels:
+                elapsed, peak, count = run(path, name, label)
+                print('%-12s %-14s %10.3f %12d %8d' % (name, label, elapsed,
+                                                       peak, count))
+        finally:
+            os.remove(path)
+
+    if BeautifulSoup is not None:
+        # Only once every parser has been measured in a process of its own
+        for name, make_listing, streaming, soup in LISTINGS:
+            content = make_listing(args.rows)
+            assert streaming(content) == soup(content)
+
+
+if __name__ == '__main__':
+    main()
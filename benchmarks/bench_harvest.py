@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+'''
+benchmarks/bench_harvest.py
+
+Harvests a synthetic WAF, ERDDAP WAF (in the layouts before and after ERDDAP
+1.82) and CSW served by a local FakeServer, and reports the records harvested
+per second, the peak resident memory and the time spent in each stage of
+every harvest. "peak KB" is the peak resident memory of the harvest process
+during the run. "worker KB" is the largest peak resident memory of any
+validation worker process of the harvest so far. Records are written to mongomock unless a MongoDB connection
+string is given. No remote server is contacted.
+
+Usage::
+
+    python benchmarks/bench_harvest.py --records 5000 --size 20000 \\
+        --latency 0.01 --reharvest
+
+'''
+from __future__ import print_function
+from catalog_harvesting.harvest import download_waf, download_erddap_waf
+from catalog_harvesting.csw import download_csw
+from catalog_harvesting.metrics import start_metrics, stop_metrics
+from catalog_harvesting.util import get_database, unique_id
+from fake_server import FakeServer, WAF_PATH, ERDDAP_PATH, CSW_PATH
+from multiprocessing import Process, Queue
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+
+# Name to (harvest_type, path on the FakeServer, ERDDAP version, function)
+HARVESTS = {
+    'waf': ('WAF', WAF_PATH, None, download_waf),
+    'erddap-1.80': ('ERDDAP-WAF', ERDDAP_PATH, '1.80', download_erddap_waf),
+    'erddap-1.82': ('ERDDAP-WAF', ERDDAP_PATH, '1.82', download_erddap_waf),
+    'csw': ('CSW', CSW_PATH, None, download_csw)
+}
+
+
+def get_db(mongo_url):
+    '''
+    Returns the database the records are written to
+    '''
+    if mongo_url:
+        return get_database(mongo_url)
+    import mongomock
+    return mongomock.MongoClient().db
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident memory of this process to its current resident
+    memory. Returns False where that isn't supported (Linux only).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss():
+    '''
+    Returns the peak resident memory of this process in KB
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(name, url, args, queue):
+    '''
+    Runs a harvest in a child process and reports, for each run, the number
+    of records and errors, the elapsed time, the peak resident memory of the
+    harvest process during the run, the largest peak resident memory of its
+    validation workers so far and the summary of the harvest metrics. Where
+    the peak can't be reset between runs, the peak of a later run is the peak
+    of the process since it started.
+    '''
+    harvest_type, path, version, func = HARVESTS[name]
+    db = get_db(args.mongo)
+    harvest = {
+        '_id': unique_id(),
+        'url': url,
+        'organization': 'benchmark',
+        'harvest_type': harvest_type,
+        'csw_page_size': args.page_size
+    }
+    dest = tempfile.mkdtemp()
+    try:
+        for run in range(2 if args.reharvest else 1):
+            reset_peak_rss()
+            start_metrics(harvest)
+            start = time.time()
+            records, errors = func(db, harvest, url,
+                                   os.path.join(dest, 'benchmark'))
+            elapsed = time.time() - start
+            summary = stop_metrics(harvest)
+            # The validation workers are waited for once the harvest ends
+            workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            queue.put((run, records, errors, elapsed, peak_rss(), workers,
+                       summary))
+        if args.mongo:
+            db.Records.delete_many({"harvest_id": harvest['_id']})
+    finally:
+        shutil.rmtree(dest)
+        queue.put(None)
+
+
+def run(server, name, args):
+    '''
+    Returns the results of measure for a harvest
+    '''
+    harvest_type, path, version, func = HARVESTS[name]
+    if version is not None:
+        server.erddap_version = version
+    queue = Queue()
+    process = Process(target=measure,
+                      args=(name, server.url + path, args, queue))
+    process.start()
+    results = []
+    for result in iter(queue.get, None):
+        results.append(result)
+    process.join()
+    return results
+
+
+def print_stages(summary):
+    '''
+    Prints the time spent in each stage, the longest first
+    '''
+    stages = sorted(summary['stages'].items(),
+                    key=lambda item: item[1]['total'], reverse=True)
+    for stage, stats in stages:
+        print('    %-16s %10.3f %8d %10.4f %10.4f %10.4f' % (
+            stage, stats['total'], stats['count'], stats['p50'],
+            stats['p90'], stats['p99']))
+    for counter, value in sorted(summary['counters'].items()):
+        print('    %-16s %10d' % (counter, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--records', type=int, default=1000,
+                        help='Number of records served')
+    parser.add_argument('-s', '--size', type=int, default=20000,
+                        help='Approximate size of each record in bytes')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Seconds each response is delayed by')
+    parser.add_argument('-d', '--directories', type=int, default=10,
+                        help='Number of subdirectories of the WAF')
+    parser.add_argument('--csw-limit', type=int, default=100,
+                        help='Maximum number of records per CSW response')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Number of records requested from the CSW at a '
+                             'time')
+    parser.add_argument('-r', '--reharvest', action='store_true',
+                        help='Harvest each source a second time to measure '
+                             'incremental harvests')
+    parser.add_argument('-m', '--mongo',
+                        help='MongoDB connection string, defaults to '
+                             'mongomock')
+    parser.add_argument('harvests', nargs='*',
+                        help='Harvests to run (%s), defaults to all' %
+                             ', '.join(sorted(HARVESTS)))
+    args = parser.parse_args()
+    harvests = args.harvests or ['waf', 'erddap-1.80', 'erddap-1.82', 'csw']
+    for name in harvests:
+        if name not in HARVESTS:
+            parser.error('unknown harvest %s' % name)
+
+    server = FakeServer(records=args.records, record_size=args.size,
+                        latency=args.latency, directories=args.directories,
+                        csw_limit=args.csw_limit)
+    server.start()
+    try:
+        for name in harvests:
+            for (run_number, records, errors, elapsed, peak, workers,
+                 summary) in run(server, name, args):
+                label = name if run_number == 0 else name + ' (again)'
+                print('%-20s %8s %8s %10s %10s %12s %12s' % (
+                    'harvest', 'records', 'errors', 'seconds', 'records/s',
+                    'peak KB', 'worker KB'))
+                print('%-20s %8d %8d %10.3f %10.1f %12d %12d' % (
+                    label, records, errors, elapsed,
+                    records / elapsed if elapsed else 0, peak, workers))
+                print('    %-16s %10s %8s %10s %10s %10s' % (
+                    'stage', 'seconds', 'count', 'p50', 'p90', 'p99'))
+                print_stages(summary)
+                print()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
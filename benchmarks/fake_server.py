@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+'''
+benchmarks/fake_server.py
+
+A local HTTP stand-in for the servers harvests download from. It serves a
+synthetic WAF directory tree, an ERDDAP WAF listing in either the <pre>
+layout of ERDDAP versions before 1.82 or the newer table layout, and a CSW
+answering GetCapabilities and GetRecords requests. Every response is delayed
+by a configurable latency.
+
+Usage::
+
+    server = FakeServer(records=1000, record_size=20000, latency=0.01)
+    server.start()
+    download_waf(db, harvest, server.url + '/waf/', dest)
+    server.stop()
+
+'''
+from distutils.version import LooseVersion
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse
+import re
+import threading
+import time
+
+
+WAF_PATH = '/waf/'
+ERDDAP_PATH = '/erddap/metadata/iso19115/xml/'
+CSW_PATH = '/csw'
+
+LAST_MODIFIED = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+RECORD = '''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:fileIdentifier><gco:CharacterString>record-%(id)06d</gco:CharacterString></gmd:fileIdentifier>
+  <gmd:dateStamp><gco:Date>2018-01-01</gco:Date></gmd:dateStamp>
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>
+      <gmd:citation><gmd:CI_Citation>
+        <gmd:title><gco:CharacterString>Synthetic dataset %(id)d</gco:CharacterString></gmd:title>
+      </gmd:CI_Citation></gmd:citation>
+      <gmd:abstract><gco:CharacterString>%(abstract)s</gco:CharacterString></gmd:abstract>
+      <gmd:extent><gmd:EX_Extent><gmd:geographicElement>
+        <gmd:EX_GeographicBoundingBox>
+          <gmd:westBoundLongitude><gco:Decimal>%(lon)s</gco:Decimal></gmd:westBoundLongitude>
+          <gmd:eastBoundLongitude><gco:Decimal>%(lon)s</gco:Decimal></gmd:eastBoundLongitude>
+          <gmd:southBoundLatitude><gco:Decimal>%(lat)s</gco:Decimal></gmd:southBoundLatitude>
+          <gmd:northBoundLatitude><gco:Decimal>%(lat)s</gco:Decimal></gmd:northBoundLatitude>
+        </gmd:EX_GeographicBoundingBox>
+      </gmd:geographicElement></gmd:EX_Extent></gmd:extent>
+    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+</gmd:MD_Metadata>
+'''
+
+CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:Capabilities xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:ows="http://www.opengis.net/ows" xmlns:ogc="http://www.opengis.net/ogc" xmlns:xlink="http://www.w3.org/1999/xlink" version="2.0.2">
+  <ows:ServiceIdentification>
+    <ows:Title>Benchmark CSW</ows:Title>
+    <ows:ServiceType>CSW</ows:ServiceType>
+    <ows:ServiceTypeVersion>2.0.2</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetRecords">
+      <ows:DCP><ows:HTTP>
+        <ows:Get xlink:href="%(url)s"/>
+        <ows:Post xlink:href="%(url)s"/>
+      </ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <ogc:Filter_Capabilities>
+    <ogc:Spatial_Capabilities>
+      <ogc:GeometryOperands><ogc:GeometryOperand>gml:Envelope</ogc:GeometryOperand></ogc:GeometryOperands>
+      <ogc:SpatialOperators><ogc:SpatialOperator name="BBOX"/></ogc:SpatialOperators>
+    </ogc:Spatial_Capabilities>
+    <ogc:Scalar_Capabilities>
+      <ogc:ComparisonOperators><ogc:ComparisonOperator>EqualTo</ogc:ComparisonOperator></ogc:ComparisonOperators>
+    </ogc:Scalar_Capabilities>
+    <ogc:Id_Capabilities><ogc:EID/></ogc:Id_Capabilities>
+  </ogc:Filter_Capabilities>
+</csw:Capabilities>
+'''
+
+GET_RECORDS_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" version="2.0.2">
+  <csw:SearchStatus timestamp="2018-01-01T00:00:00Z"/>
+  <csw:SearchResults numberOfRecordsMatched="%d" numberOfRecordsReturned="%d" nextRecord="%d" elementSet="full">
+%s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>
+'''
+
+
+def record_xml(record_id, size):
+    '''
+    Returns a synthetic ISO 19115 record padded to about size bytes
+
+    :param int record_id: Number of the record
+    :param int size: Approximate size of the record in bytes
+    '''
+    fields = {
+        'id': record_id,
+        'abstract': '',
+        'lon': '%.4f' % (-180 + record_id % 360),
+        'lat': '%.4f' % (-80 + record_id % 160)
+    }
+    padding = max(0, size - len(RECORD % fields))
+    fields['abstract'] = ('Synthetic abstract. ' * (padding // 20 + 1))[:padding]
+    return (RECORD % fields).encode('utf-8')
+
+
+def strip_declaration(doc):
+    '''
+    Returns a document without its XML declaration, to embed it in another
+    '''
+    return doc.split(b'?>', 1)[1] if doc.startswith(b'<?xml') else doc
+
+
+def waf_listing(title, links):
+    '''
+    Returns an Apache style directory listing
+
+    :param str title: Path of the directory
+    :param list links: Hrefs listed in the directory
+    '''
+    lines = ['<html><head><title>Index of %s</title></head><body>' % title,
+             '<h1>Index of %s</h1><table>' % title,
+             '<tr><td><a href="../">Parent Directory</a></td></tr>']
+    for link in links:
+        lines.append('<tr><td><a href="%s">%s</a></td>'
+                     '<td>2018-01-01 00:00</td><td>24K</td></tr>' % (link, link))
+    lines.append('</table></body></html>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def erddap_listing(links, version):
+    '''
+    Returns an ERDDAP WAF listing. ERDDAP versions older than 1.82 list the
+    documents in a <pre>, newer ones in a table.
+
+    :param list links: Hrefs listed in the directory
+    :param str version: ERDDAP version reported in the footer
+    '''
+    new_layout = LooseVersion(version) >= LooseVersion('1.82')
+    lines = ['<html><head><title>ERDDAP - Index of %s</title></head><body>' % ERDDAP_PATH,
+             '<div class="standard_width">' if new_layout else '<div>',
+             '<table class="compact nowrap">' if new_layout else '<pre>']
+    for link in links:
+        row = '<a href="%s">%s</a>' % (link, link)
+        if new_layout:
+            lines.append('<tr><td>%s</td><td>01-Jan-2018 00:00</td><td>24K</td></tr>' % row)
+        else:
+            lines.append('%s 01-Jan-2018 00:00 24K' % row)
+    lines.append('</table>' if new_layout else '</pre>')
+    lines.append('</div><p>ERDDAP, Version %s</p></body></html>' % version)
+    return '\n'.join(lines).encode('utf-8')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the requests of a FakeServer
+    '''
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        path = urlparse(self.path).path
+        if path == CSW_PATH:
+            return self.send(CAPABILITIES % {'url': fake.url + CSW_PATH},
+                             'text/xml')
+        if path.endswith('/'):
+            listing = fake.get_listing(path)
+            if listing is None:
+                return self.send(b'Not Found', 'text/plain', 404)
+            return self.send(listing, 'text/html')
+
+        record_id = fake.get_record_id(path)
+        if record_id is None:
+            return self.send(b'Not Found', 'text/plain', 404)
+        etag = '"record-%d"' % record_id
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(b'', 'text/xml', 304)
+        self.send(fake.get_record(record_id), 'text/xml',
+                  headers={'ETag': etag, 'Last-Modified': LAST_MODIFIED})
+
+    def do_POST(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path != CSW_PATH:
+            return self.send(b'Not Found', 'text/plain', 404)
+        position = int(re.search(b'startPosition="(\\d+)"', body).group(1))
+        maxrecords = int(re.search(b'maxRecords="(\\d+)"', body).group(1))
+        self.send(fake.get_records_response(position, maxrecords), 'text/xml')
+
+    def send(self, content, content_type, status=200, headers=None):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(content)
+
+
+class FakeServer(object):
+    '''
+    Serves records number 0 to ``records`` - 1 as:
+
+    - ``/waf/``: A WAF with the records spread over ``directories``
+      subdirectories
+    - ``/erddap/metadata/iso19115/xml/``: An ERDDAP WAF of the version given
+      by ``erddap_version``
+    - ``/csw``: A CSW returning at most ``csw_limit`` records per request
+
+    Documents are served with an ETag and answer conditional requests with
+    304 Not Modified.
+    '''
+
+    def __init__(self, records=1000, record_size=20000, latency=0.0,
+                 directories=10, erddap_version='1.82', csw_limit=100):
+        '''
+        :param int records: Number of records served
+        :param int record_size: Approximate size of each record in bytes
+        :param float latency: Seconds each response is delayed by
+        :param int directories: Number of subdirectories of the WAF
+        :param str erddap_version: Version of the ERDDAP listing layout
+        :param int csw_limit: Maximum number of records per GetRecords
+                              response
+        '''
+        self.records = records
+        self.record_size = record_size
+        self.latency = latency
+        self.directories = max(1, directories)
+        self.erddap_version = erddap_version
+        self.csw_limit = csw_limit
+        self.httpd = None
+        self.thread = None
+        self._cache = {}
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        '''
+        Starts serving on an unused local port
+        '''
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def get_record(self, record_id):
+        if record_id not in self._cache:
+            self._cache[record_id] = record_xml(record_id, self.record_size)
+        return self._cache[record_id]
+
+    def get_record_id(self, path):
+        '''
+        Returns the number of the record at path, or None
+        '''
+        match = re.search(r'record_(\d+)(_iso19115)?\.xml$', path)
+        if match is None:
+            return None
+        record_id = int(match.group(1))
+        if record_id >= self.records:
+            return None
+        return record_id
+
+    def get_listing(self, path):
+        '''
+        Returns the directory listing at path, or None
+        '''
+        if path == WAF_PATH:
+            return waf_listing(path, ['d%03d/' % i
+                                      for i in range(self.directories)])
+        if path == ERDDAP_PATH:
+            return erddap_listing(['record_%06d_iso19115.xml' % i
+                                   for i in range(self.records)],
+                                  self.erddap_version)
+        match = re.match(r'^/waf/d(\d+)/$', path)
+        if match is None:
+            return None
+        directory = int(match.group(1))
+        return waf_listing(path, ['record_%06d.xml' % i for i in
+                                  range(directory, self.records,
+                                        self.directories)])
+
+    def get_records_response(self, position, maxrecords):
+        '''
+        Returns a GetRecords response of the records from position, which
+        starts at 1
+        '''
+        count = min(maxrecords, self.csw_limit)
+        ids = range(position - 1, min(self.records, position - 1 + count))
+        nextrecord = position + len(ids)
+        if nextrecord > self.records:
+            nextrecord = 0
+        records = b'\n'.join(strip_declaration(self.get_record(i))
+                             for i in ids)
+        return GET_RECORDS_RESPONSE.encode('utf-8') % (
+            self.records, len(ids), nextrecord, records)
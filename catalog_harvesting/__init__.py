@@ -12,6 +12,9 @@ __version__ = '1.2.0'
 
 LOGGER = None
 
+# Redis client shared by the whole process, see get_redis
+REDIS = None
+
 
 def get_logger():
     '''
@@ -36,3 +39,17 @@ def get_redis_connection():
         host = connection_str
     db = path
     return host, port, db
+
+
+def get_redis():
+    '''
+    Returns the Redis client shared by the whole process, connected to
+    REDIS_URL. Its connection pool opens new connections in forked processes.
+    '''
+    global REDIS
+    if REDIS is None:
+        import redis
+        host, port, db = get_redis_connection()
+        pool = redis.ConnectionPool(host=host, port=port, db=db)
+        REDIS = redis.Redis(connection_pool=pool)
+    return REDIS
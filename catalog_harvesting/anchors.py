@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/anchors.py
+
+Streaming extraction of the anchors in HTML directory listings. Elements are
+discarded as soon as they have been read so memory use does not grow with the
+size of the listing.
+'''
+from distutils.version import LooseVersion
+from lxml import etree
+import six
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_events(content, texts=True, chunk_size=CHUNK_SIZE):
+    '''
+    Returns a generator of (event, value) tuples for an HTML document. Events
+    are 'start' and 'end' for elements, with the element as the value, and
+    'text' for each text node, with the string as the value. A text node is
+    reported once the element it trails or belongs to has ended, and the
+    text of an anchor is complete when the anchor's 'end' event is reported.
+
+    Elements are discarded once they and their trailing text have been
+    reported, except for the descendants of an anchor that has not ended.
+
+    :param content: The HTML document as bytes or text
+    :param bool texts: Report 'text' events
+    :param int chunk_size: Number of characters fed to the parser at a time
+    '''
+    if isinstance(content, six.binary_type):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            content = content.decode('latin-1')
+    if not content.strip():
+        return
+
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    anchors = 0
+    for _ in _feed(parser, content, chunk_size):
+        for event, el in parser.read_events():
+            if event == 'start':
+                # The previous sibling and its trailing text are complete
+                if not anchors:
+                    prev = el.getprevious()
+                    while prev is not None:
+                        if texts and prev.tail:
+                            yield 'text', prev.tail
+                        el.getparent().remove(prev)
+                        prev = el.getprevious()
+                if el.tag == 'a':
+                    anchors += 1
+                yield event, el
+                continue
+
+            if el.tag == 'a':
+                anchors -= 1
+            if texts and el.text:
+                yield 'text', el.text
+            yield event, el
+            if not anchors:
+                if texts:
+                    for child in el:
+                        if child.tail:
+                            yield 'text', child.tail
+                del el[:]
+
+
+def _feed(parser, content, chunk_size):
+    '''
+    Feeds content to parser one chunk at a time, yielding after each chunk so
+    the parsed events can be read, and closes the parser at the end.
+    '''
+    for offset in range(0, len(content), chunk_size):
+        parser.feed(content[offset:offset + chunk_size])
+        yield
+    parser.close()
+    yield
+
+
+def get_text(el):
+    '''
+    Returns all of the text contained in an element
+
+    :param el: An lxml element
+    '''
+    return ''.join(el.itertext())
+
+
+def get_anchors(content):
+    '''
+    Returns a list of tuples: href, text for each anchor in the document
+
+    :param content: The HTML document as bytes or text
+    '''
+    return [(el.get('href'), get_text(el))
+            for event, el in iter_events(content, texts=False)
+            if event == 'end' and el.tag == 'a']
+
+
+def get_erddap_anchors(content):
+    '''
+    Returns a list of tuples href, text for each anchor to an XML document in
+    an ERDDAP WAF listing. ERDDAP versions older than 1.82 list the documents
+    in a <pre>, newer versions in a table inside a div.standard_width.
+
+    :param content: The HTML document as bytes or text
+    '''
+    version = None
+    containers = {'pre': None, 'div': None, 'table': None}
+    inside = {'pre': False, 'div': False, 'table': False}
+    anchors = {'pre': [], 'table': []}
+
+    for event, value in iter_events(content):
+        if event == 'text':
+            if version is None and 'ERDDAP, Version ' in value:
+                version = value
+            continue
+
+        tag = value.tag
+        if event == 'start':
+            if tag == 'pre' and containers['pre'] is None:
+                containers['pre'] = value
+                inside['pre'] = True
+            elif tag == 'div' and containers['div'] is None and \
+                    'standard_width' in (value.get('class') or '').split():
+                containers['div'] = value
+                inside['div'] = True
+            elif tag == 'table' and containers['table'] is None and \
+                    inside['div']:
+                containers['table'] = value
+                inside['table'] = True
+            continue
+
+        if tag == 'a':
+            text = get_text(value)
+            if text.endswith('.xml'):
+                link = (value.get('href'), text)
+                for name in anchors:
+                    if inside[name]:
+                        anchors[name].append(link)
+        for name in inside:
+            if value is containers[name]:
+                inside[name] = False
+
+    if get_erddap_version(version) < LooseVersion('1.82'):
+        # if the ERDDAP version is less than 1.82, the attributes are stored
+        # in a <pre>
+        name = 'pre'
+    else:
+        name = 'table'
+    if containers[name] is None:
+        raise ValueError("ERDDAP WAF listing has no <%s> of documents" % name)
+    return anchors[name]
+
+
+def get_erddap_version(text):
+    '''
+    Returns the ERDDAP version from the text of the page footer, or 0 if it is
+    unknown
+
+    :param str text: Text containing "ERDDAP, Version x.y"
+    '''
+    if text is None:
+        return LooseVersion('0')
+    try:
+        return LooseVersion(text.strip().rsplit()[-1])
+    except Exception:
+        return LooseVersion('0')
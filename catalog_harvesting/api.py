@@ -5,14 +5,20 @@ catalog_harvesting/api.py
 A microservice designed to perform small tasks in association with the CLI
 '''
 
-from flask import Flask, jsonify
-from pymongo import MongoClient
-from catalog_harvesting import get_redis_connection, get_logger
+from flask import Flask, Response, jsonify, request
+from catalog_harvesting import get_redis, get_logger
 from catalog_harvesting import harvest as harvest_api
-from rq import Queue
+from catalog_harvesting.fanout import enqueue_harvests, finish_batch_job
+from catalog_harvesting.record_queue import (finish_record_job,
+                                             is_current_generation,
+                                             check_record_runs,
+                                             recover_record_runs)
+from catalog_harvesting.indexes import ensure_indexes
+from catalog_harvesting.metrics import format_prometheus
+from catalog_harvesting.util import get_database
+from rq import Queue, get_current_job
 import os
 import json
-import redis
 
 app = Flask(__name__)
 
@@ -27,21 +33,13 @@ def init_db():
     '''
     global db
     # We want the process to stop here, if it's not defined or we can't connect
-    conn_string = os.environ['MONGO_URL']
-    tokens = conn_string.split('/')
-    if len(tokens) > 3:
-        db_name = tokens[3]
-    else:
-        db_name = 'default'
-    conn = MongoClient(conn_string)
-    conn.server_info()
-    db = conn[db_name]
+    db = get_database(os.environ['MONGO_URL'])
+    db.client.server_info()
+    ensure_indexes(db)
     return db
 
 
-REDIS_HOST, REDIS_PORT, REDIS_DB = get_redis_connection()
-redis_pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-redis_connection = redis.Redis(connection_pool=redis_pool)
+redis_connection = get_redis()
 
 queue = Queue('default', connection=redis_connection)
 
@@ -57,18 +55,70 @@ def index():
     return jsonify(), 204
 
 
-def harvest_job(harvest_id):
+def harvest_job(harvest_id, batch_id=None):
     '''
     Actually perform the harvest
 
     :param str harvest_id: ID of harvest
+    :param str batch_id: ID of the batch enqueued by enqueue_harvests the job
+                         belongs to, if any
+    '''
+    try:
+        harvest = db.Harvests.find_one({"_id": harvest_id})
+        harvest_api.download_harvest(db, harvest, OUTPUT_DIR,
+                                     redis_connection)
+    finally:
+        if batch_id is not None:
+            finish_batch_job(redis_connection, batch_id)
+
+    return json.dumps({"result": True})
+
+
+def record_job(harvest_id, run_id, generation, documents):
+    '''
+    Downloads a batch of the documents of a harvest enqueued by
+    enqueue_record_jobs. The last job of the run updates the harvest.
+
+    :param str harvest_id: ID of harvest
+    :param str run_id: ID of the run of the harvest
+    :param str generation: ID of the enqueue of the run the job belongs to
+    :param list documents: List of the link to each document and the local
+                           filename to write it to
     '''
     harvest = db.Harvests.find_one({"_id": harvest_id})
-    harvest_api.download_harvest(db, harvest, OUTPUT_DIR)
+    if not is_current_generation(harvest, run_id, generation):
+        get_logger().info("Skipping record job of an abandoned or superseded "
+                          "run %s", run_id)
+        return json.dumps({"result": False})
+
+    job = get_current_job()
+    records, errors, counters = 0, len(documents), {}
+    try:
+        records, errors, counters = harvest_api.download_record_batch(
+            db, harvest, documents)
+    finally:
+        totals = finish_record_job(redis_connection, generation, records,
+                                   errors, counters,
+                                   job.id if job is not None else None)
+        if totals is not None:
+            harvest_api.finish_record_harvest(db, harvest, totals)
+        # Fails the runs whose other record jobs were lost with their worker
+        check_record_runs(db, redis_connection)
 
     return json.dumps({"result": True})
 
 
+def clean_job(dest, max_days):
+    '''
+    Removes the documents in dest that no harvest has seen in max_days days
+
+    :param str dest: Folder to clean
+    :param int max_days: Maximum number of days to keep an old record
+    '''
+    harvest_api.force_clean(dest, max_days, db)
+    return json.dumps({"result": True})
+
+
 def delete_harvest_job(harvest_id):
     '''
     Schedules the deletion of a harvest
@@ -106,6 +156,37 @@ def get_harvest(harvest_id):
     return jsonify({"result": True})
 
 
+@app.route("/api/harvests", methods=['POST'])
+def harvest_all():
+    '''
+    Enqueues a harvest job for every published harvest. Once all of them have
+    finished the stale contents of the output directory are removed, unless
+    the force_clean query parameter is false.
+    '''
+    max_days = None
+    if request.args.get('force_clean', 'true').lower() != 'false':
+        max_days = harvest_api.get_stale_expiration_days()
+    recover_record_runs(db, redis_connection)
+    batch_id = enqueue_harvests(db, redis_connection, OUTPUT_DIR, max_days)
+    return jsonify({"result": True, "batch_id": batch_id})
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    '''
+    Returns the metrics of the last run of each harvest in the Prometheus text
+    format
+    '''
+    harvests = db.Harvests.find({}, {
+        "last_record_count": True,
+        "last_bad_count": True,
+        "last_harvest_duration": True,
+        "last_harvest_metrics": True
+    })
+    return Response(format_prometheus(harvests),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/api/harvest/<string:harvest_id>", methods=['DELETE'])
 def delete_harvest(harvest_id):
     queue.enqueue(delete_harvest_job, harvest_id, timeout=900)
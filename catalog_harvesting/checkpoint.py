@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/checkpoint.py
+
+Keeps track of the progress of a harvest so that an interrupted harvest is
+resumed instead of started over
+'''
+from catalog_harvesting import get_logger
+from catalog_harvesting.util import unique_id
+from datetime import datetime, timedelta
+import os
+
+
+# Number of hours after which an interrupted harvest is started over
+CHECKPOINT_HOURS = float(os.environ.get('HARVEST_CHECKPOINT_HOURS', 12))
+
+
+def start_checkpoint(db, harvest, max_hours=CHECKPOINT_HOURS):
+    '''
+    Returns the checkpoint of a run of a harvest that is about to start. The
+    checkpoint of an interrupted run is resumed if it was started less than
+    max_hours ago, otherwise a new run is started. The checkpoint is stored
+    in the harvest's ``checkpoint`` field, both in MongoDB and in harvest.
+
+    :param db: MongoDB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param float max_hours: Maximum age of a checkpoint that is resumed
+    '''
+    now = datetime.utcnow()
+    checkpoint = harvest.get('checkpoint')
+    if checkpoint and checkpoint.get('run_id') and checkpoint.get('started') \
+            and now - checkpoint['started'] < timedelta(hours=max_hours):
+        get_logger().info("Resuming harvest %s from %s", harvest['url'],
+                          checkpoint['started'])
+    else:
+        checkpoint = {"run_id": unique_id(), "started": now}
+    db.Harvests.update_one({"_id": harvest['_id']}, {
+        "$set": {"checkpoint": checkpoint}
+    })
+    harvest['checkpoint'] = checkpoint
+    return checkpoint
+
+
+def save_checkpoint(db, harvest, **fields):
+    '''
+    Stores the progress of the current run of a harvest in its checkpoint.
+    Does nothing if the harvest is not run with a checkpoint.
+
+    :param db: MongoDB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param fields: The fields of the checkpoint to set
+    '''
+    checkpoint = harvest.get('checkpoint')
+    if not checkpoint:
+        return
+    checkpoint.update(fields)
+    db.Harvests.update_one({"_id": harvest['_id']}, {
+        "$set": dict(("checkpoint.%s" % key, value)
+                     for key, value in fields.items())
+    })
@@ -7,12 +7,12 @@ catalog_harvesting/ckan_api.py
 from __future__ import print_function
 from __future__ import unicode_literals
 from catalog_harvesting import get_logger
+from catalog_harvesting.session import get_session
 
 import os
 import re
 import posixpath
 import json
-import requests
 
 CKAN_API = os.environ.get('CKAN_API', 'http://ckan/')
 CKAN_API_KEY = os.environ.get('CKAN_API_KEY')
@@ -47,7 +47,7 @@ def get_harvest_info(db, harvest):
     ckan_harvest_id = groups[2]
     ckan_harvest_url = posixpath.join(CKAN_API, 'action/harvest_source_show')
 
-    response = requests.get(ckan_harvest_url, params={"id": ckan_harvest_id}, allow_redirects=True, timeout=10)
+    response = get_session().get(ckan_harvest_url, params={"id": ckan_harvest_id}, allow_redirects=True, timeout=10)
     if response.status_code != 200:
         get_logger().error("CKAN ERROR: HTTP %s", str(response.status_code))
         get_logger().error(response.content)
@@ -66,12 +66,12 @@ def create_harvest_job(ckan_harvest_id):
     ckan_harvest_url = posixpath.join(CKAN_API, 'action/harvest_job_create')
     payload = json.dumps({"source_id": ckan_harvest_id})
 
-    response = requests.post(ckan_harvest_url,
-                             headers={
-                                 'Content-Type': 'application/json;charset=utf-8',
-                                 'Authorization': CKAN_API_KEY
-                             },
-                             data=payload)
+    response = get_session().post(ckan_harvest_url,
+                                  headers={
+                                      'Content-Type': 'application/json;charset=utf-8',
+                                      'Authorization': CKAN_API_KEY
+                                  },
+                                  data=payload)
     if response.status_code != 200:
         get_logger().error("CKAN ERROR: HTTP %s", str(response.status_code))
         get_logger().error(response.content)
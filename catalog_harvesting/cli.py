@@ -6,8 +6,14 @@ Command line interface for pulling a WAF
 '''
 
 from catalog_harvesting import get_logger
+from catalog_harvesting import get_redis
 from catalog_harvesting.harvest import (download_waf, download_csw,
-                                        download_from_db, force_clean)
+                                        download_from_db, force_clean,
+                                        get_stale_expiration_days)
+from catalog_harvesting.fanout import enqueue_harvests
+from catalog_harvesting.record_queue import recover_record_runs
+from catalog_harvesting.indexes import ensure_indexes
+from catalog_harvesting.util import get_database
 from argparse import ArgumentParser
 import logging
 import logging.config
@@ -33,31 +39,44 @@ def main():
                         help='Enables verbose logging')
     parser.add_argument('-f', '--force-clean', action='store_true',
                         help='Removes stale contents of the folder')
+    parser.add_argument('-i', '--ensure-indexes', action='store_true',
+                        help='Creates any missing indexes in the database')
+    parser.add_argument('-q', '--enqueue', action='store_true',
+                        help='Enqueues a job per published harvest for the '
+                             'workers instead of harvesting in this process')
     args = parser.parse_args()
 
     if args.verbose:
         setup_logging()
 
     get_logger().info("Starting")
+    if args.ensure_indexes and not args.src.startswith('http'):
+        ensure_indexes(get_database(args.src))
+
     if args.src and args.dest:
         if args.src.startswith('http'):
             if args.type == 'waf':
                 download_waf(args.src, args.dest)
             elif args.type == 'csw':
                 download_csw(args.src, args.dest)
+        elif args.enqueue:
+            # The last harvest job to finish removes the stale datasets
+            max_days = None
+            if args.force_clean:
+                max_days = get_stale_expiration_days()
+            db = get_database(args.src)
+            recover_record_runs(db, get_redis())
+            enqueue_harvests(db, get_redis(), args.dest, max_days)
+            return
         else:
             download_from_db(args.src, args.dest)
 
     if args.force_clean and args.dest:
         get_logger().info("Removing stale datasets")
-        try:
-            # get the STALE_EXPIRATION_DAYS and parse to int or set it to 3
-            # if unset
-            max_days = int(os.getenv('STALE_EXPIRATION_DAYS', 3))
-        # if the environment variable was unparseable to int, also set to 3
-        except ValueError:
-            max_days = 3
-        force_clean(args.dest, max_days)
+        db = None
+        if not args.src.startswith('http'):
+            db = get_database(args.src)
+        force_clean(args.dest, get_stale_expiration_days(), db)
 
 
 def setup_logging(
@@ -8,45 +8,286 @@ from owslib.iso import namespaces
 from six.moves.urllib.parse import urlencode
 from lxml import etree
 from catalog_harvesting import get_logger
-from catalog_harvesting.records import process_doc
+from catalog_harvesting.session import get_session
+from catalog_harvesting.checkpoint import save_checkpoint
+from catalog_harvesting.metrics import HarvestMetrics, get_metrics
+from catalog_harvesting.records import (process_doc, purge_old_records,
+                                        ValidationPool, RecordSync)
+from collections import deque
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 import os
+import time
 
 
-def get_records(csw, max_batches=10000):
+# Number of records requested from a CSW in each GetRecords request
+CSW_PAGE_SIZE = int(os.environ.get('HARVEST_CSW_PAGE_SIZE', 100))
+# Maximum number of GetRecords requests made to a CSW at once
+CSW_WORKERS = int(os.environ.get('HARVEST_CSW_WORKERS', 4))
+
+
+def get_csw_limits(harvest):
     '''
-    Returns a generator for iterating over the results of a CSW query
+    Returns a tuple of the number of records per GetRecords request and the
+    number of concurrent requests for a CSW harvest. A harvest can override
+    the defaults with the ``csw_page_size`` and ``csw_workers`` fields.
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    page_size = harvest.get('csw_page_size') or CSW_PAGE_SIZE
+    workers = harvest.get('csw_workers') or CSW_WORKERS
+    return int(page_size), int(workers)
+
+
+GMD = namespaces['gmd']
+CSW = 'http://www.opengis.net/cat/csw/2.0.2'
+OWS = 'http://www.opengis.net/ows'
+METADATA_TAGS = ('{%s}MD_Metadata' % GMD,
+                 '{http://www.isotc211.org/2005/gmi}MI_Metadata')
+SEARCH_RESULTS = '{%s}SearchResults' % CSW
+EXCEPTION_REPORT = '{%s}ExceptionReport' % OWS
+FILE_IDENTIFIER = '{%s}fileIdentifier/{%s}CharacterString' % (GMD,
+                                                              namespaces['gco'])
+
+
+def get_records_url(csw):
+    '''
+    Returns the URL GetRecords requests are posted to, as advertised by the
+    capabilities of the CSW
 
     :param csw: CSW Instance
+    '''
+    for operation in getattr(csw, 'operations', []):
+        if operation.name.lower() != 'getrecords':
+            continue
+        posts = [m for m in operation.methods if m.get('type').lower() == 'post']
+        # Like OWSLib, only choose between several POST endpoints
+        if len(posts) < 2:
+            break
+        for method in posts:
+            for constraint in method.get('constraints') or []:
+                if constraint.name.lower() == 'postencoding' and \
+                        'xml' in [v.lower() for v in constraint.values]:
+                    return method.get('url')
+        return posts[0].get('url')
+    return csw.url
+
+
+def get_records_request(position, maxrecords):
+    '''
+    Returns the body of a GetRecords request for a page of ISO 19115 records
+
+    :param int position: Position of the first record in the page
+    :param int maxrecords: Number of records in the page
+    '''
+    root = etree.Element('{%s}GetRecords' % CSW, nsmap={'csw': CSW})
+    root.set('service', 'CSW')
+    root.set('version', '2.0.2')
+    root.set('resultType', 'results')
+    root.set('outputSchema', GMD)
+    root.set('outputFormat', 'application/xml')
+    root.set('startPosition', str(position))
+    root.set('maxRecords', str(maxrecords))
+    query = etree.SubElement(root, '{%s}Query' % CSW)
+    query.set('typeNames', 'csw:Record')
+    etree.SubElement(query, '{%s}ElementSetName' % CSW).text = 'full'
+    return etree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+def iter_page(url, position, maxrecords=CSW_PAGE_SIZE, results=None,
+              timeout=30, metrics=None):
+    '''
+    Requests a page of ISO 19115 records from a CSW and returns a generator of
+    tuples of the record identifier and the record XML. The response is
+    parsed as it arrives and each record is discarded once it has been
+    yielded, so memory use does not depend on the size of the page.
+
+    :param str url: URL GetRecords requests are posted to
+    :param int position: Position of the first record in the page
+    :param int maxrecords: Number of records in the page
+    :param dict results: A dictionary the matches, returned and nextrecord
+                         attributes of the search results are stored in
+    :param int timeout: Seconds to wait for the server to respond
+    :param HarvestMetrics metrics: Collects the time spent requesting and
+                                   reading each record as ``download``
+    '''
+    if results is None:
+        results = {}
+    metrics = metrics or HarvestMetrics()
+    start = time.time()
+    response = get_session().post(url,
+                                  data=get_records_request(position,
+                                                           maxrecords),
+                                  headers={'Content-Type': 'text/xml',
+                                           'Accept': 'text/xml'},
+                                  stream=True, timeout=timeout)
+    try:
+        if response.status_code != 200:
+            raise IOError("Failed to retrieve records: HTTP %s" %
+                          response.status_code)
+        response.raw.decode_content = True
+        seen = set()
+        context = etree.iterparse(response.raw, events=('start', 'end'))
+        for event, el in context:
+            if event == 'start':
+                if el.tag == SEARCH_RESULTS:
+                    results['matches'] = int(el.get('numberOfRecordsMatched', 0))
+                    results['returned'] = int(el.get('numberOfRecordsReturned', 0))
+                    results['nextrecord'] = int(el.get('nextRecord', 0))
+                continue
+            if el.tag == EXCEPTION_REPORT:
+                raise IOError("CSW Exception: %s" %
+                              ' '.join(t.strip() for t in el.itertext()))
+            parent = el.getparent()
+            if el.tag not in METADATA_TAGS or parent is None or \
+                    parent.tag != SEARCH_RESULTS:
+                continue
+
+            # The tail may only be partly read at the end event, leave it out
+            # so the same record always serializes to the same bytes
+            doc = etree.tostring(el, with_tail=False)
+            name = el.findtext(FILE_IDENTIFIER)
+            if name is not None:
+                name = name.strip()
+            if not name:
+                name = sha1(doc).hexdigest()
+            el.clear()
+            while el.getprevious() is not None:
+                del parent[0]
+            if name in seen:
+                continue
+            seen.add(name)
+            metrics.add_time('download', time.time() - start)
+            yield name, doc
+            start = time.time()
+    finally:
+        response.close()
+
+
+def get_page(url, position, maxrecords=CSW_PAGE_SIZE, results=None,
+             metrics=None):
+    '''
+    Requests a page of ISO 19115 records from a CSW and returns a list of
+    tuples of the record identifier and the record XML
+
+    :param str url: URL GetRecords requests are posted to
+    :param int position: Position of the first record in the page
+    :param int maxrecords: Number of records in the page
+    :param dict results: A dictionary the search results are stored in
+    :param HarvestMetrics metrics: Collects the time spent downloading
+    '''
+    return list(iter_page(url, position, maxrecords, results,
+                          metrics=metrics))
+
+
+class StreamedPage(object):
+    '''
+    The records of a page, read from the response as the page is iterated.
+    Records still unread when the next page is requested are kept in memory
+    by read_all, so the page can be iterated later.
+    '''
+
+    def __init__(self, records):
+        '''
+        :param records: A generator of records returned by iter_page
+        '''
+        self.records = records
+        self.unread = deque()
+
+    def __iter__(self):
+        while self.unread:
+            yield self.unread.popleft()
+        for record in self.records:
+            yield record
+
+    def read_all(self):
+        '''
+        Reads the rest of the response
+        '''
+        self.unread.extend(self.records)
+
+
+def get_pages(url, maxrecords=CSW_PAGE_SIZE, workers=CSW_WORKERS,
+              max_batches=10000, start=1, metrics=None):
+    '''
+    Returns a generator of pages of records from a CSW in order, as tuples of
+    the position of the first record in the page and the page. Each page is
+    an iterable of tuples of the record identifier and the record XML.
+
+    Once the first page reports the number of matches, the remaining pages
+    are requested concurrently by up to ``workers`` requests at a time, and
+    up to ``workers + 1`` pages are held in memory. With a single worker the
+    pages are requested one after the other and each record is read from the
+    response as the page is iterated, so memory use does not depend on the
+    size of the page.
+
+    :param str url: URL GetRecords requests are posted to
+    :param int maxrecords: Number of records to request at a time
+    :param int workers: Maximum number of concurrent requests
     :param int max_batches: Maximum number of requests that should be made to
                             the server
+    :param int start: Position of the first record to request
+    :param HarvestMetrics metrics: Collects the time spent downloading
     '''
     # start a loop to fetch all the records.  Some CSW servers have limits on
     # the number of records you can fetch and fetching many records at once
-    # is not particularly memory efficient, so fetch in batches of 100 until
-    # the matches are exhausted
+    # is not particularly memory efficient, so fetch in batches of maxrecords
+    # until the matches are exhausted
 
     # set a maximum number of record batches just as a precaution in case
     # the CSW fails to operate correctly while fetching, for example
-    position = 1
-    batches = 0
-    while True:
-        csw.getrecords2(outputschema=namespaces['gmd'],  # Return ISO 19115 metadata
-                        startposition=position,
-                        esn='full', maxrecords=100)
-        yield csw
-
-        # nextrecord is 0 when all matches have been exhausted according to
-        # the CSW 2.0.2 spec
-        if (csw.results['nextrecord'] == 0 or
-            # Some GeoNetwork implementations use nextrecord equal to
-            # matches + 1.  Cover this (non-standard?) case so that infinite
-            # loops don't occur
-            csw.results['nextrecord'] > csw.results['matches'] or
-            batches >= max_batches):
-            break
+    results = {}
+    if workers <= 1:
+        position = start
+        batches = 0
+        while True:
+            page = StreamedPage(iter_page(url, position, maxrecords, results,
+                                          metrics=metrics))
+            yield position, page
+            # The paging fields are only known once the page has been read
+            page.read_all()
 
-        position = csw.results['nextrecord']
-        batches += 1
+            # nextrecord is 0 when all matches have been exhausted according
+            # to the CSW 2.0.2 spec
+            if (results['nextrecord'] == 0 or
+                # Some GeoNetwork implementations use nextrecord equal to
+                # matches + 1.  Cover this (non-standard?) case so that
+                # infinite loops don't occur
+                results['nextrecord'] > results['matches'] or
+                batches >= max_batches):
+                break
+
+            position = results['nextrecord']
+            batches += 1
+        return
+
+    yield start, get_page(url, start, maxrecords, results, metrics)
+    nextrecord = results['nextrecord']
+    matches = results['matches']
+    if nextrecord == 0 or nextrecord > matches:
+        return
+
+    # Servers may return fewer records than requested, so the windows follow
+    # the number of records the server actually returned
+    step = max(1, nextrecord - start)
+    positions = deque(range(nextrecord, matches + 1, step)[:max_batches])
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        while positions or pending:
+            while positions and len(pending) < workers:
+                position = positions.popleft()
+                pending.append((position,
+                                pool.apply_async(get_page,
+                                                 (url, position, step, None,
+                                                  metrics))))
+            position, page = pending.popleft()
+            yield position, page.get()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def get_csw_url(csw_url, record_id):
@@ -61,17 +302,23 @@ def get_csw_url(csw_url, record_id):
     return '{}?{}'.format(csw_url, urlencode(query))
 
 
-def parse_csw_record(db, harvest, csw_url, dest, name, raw_rec):
+def parse_csw_record(db, harvest, csw_url, dest, name, doc,
+                     previous=None, result=None, writer=None):
     '''
     Parses and writes ISO metadata record
+
+    :param str name: The identifier of the record
+    :param str doc: The XML of the record
+    :param dict previous: The record from the previous harvest of this record
+    :param tuple result: The result of process_xml for the record if it was
+                         already processed
+    :param writer: A RecordWriter or RecordSync to write the record with
     '''
     # replace slashes with underscore so writing to file does not
     # cause missing file
     name_sanitize = name.replace('/', '_')
     file_loc = os.path.join(dest, name_sanitize + '.xml')
     get_logger().info("Writing to file %s", file_loc)
-    with open(file_loc, 'wb') as f:
-        f.write(raw_rec.xml)
     try:
         parts = file_loc.split('/')
         organization = parts[-2]
@@ -82,7 +329,9 @@ def parse_csw_record(db, harvest, csw_url, dest, name, raw_rec):
         # Get the HTTP GET Request for the record
         csw_get_record_by_id = get_csw_url(csw_url, name)
 
-        rec = process_doc(raw_rec.xml, record_url, file_loc, harvest, csw_get_record_by_id, db)
+        rec = process_doc(doc, record_url, file_loc, harvest,
+                          csw_get_record_by_id, db, previous=previous,
+                          result=result, writer=writer)
         if len(rec['validation_errors']):
             return False
     except etree.XMLSyntaxError as e:
@@ -107,7 +356,9 @@ def parse_csw_record(db, harvest, csw_url, dest, name, raw_rec):
 
 def download_csw(db, harvest, csw_url, dest):
     '''
-    Downloads from a CSW endpoint.
+    Downloads from a CSW endpoint. The position of the page being harvested
+    is stored in the checkpoint of the harvest, so a harvest that is resumed
+    starts requesting records from there.
 
     :param db: Mongo DB Client
     :param dict harvest: A dictionary returned from the mongo collection for
@@ -119,15 +370,45 @@ def download_csw(db, harvest, csw_url, dest):
         os.makedirs(dest)
 
     csw = CatalogueServiceWeb(csw_url)
-    # remove any records from past run
-    db.Records.remove({"harvest_id": harvest['_id']})
-    count, errors = 0, 0
-    for csw in get_records(csw):
-        for name, raw_rec in csw.records.items():
-            success = parse_csw_record(db, harvest, csw_url, dest, name, raw_rec)
+    records_url = get_records_url(csw)
+    sync = RecordSync(db, harvest)
+    page_size, workers = get_csw_limits(harvest)
+    start = (harvest.get('checkpoint') or {}).get('csw_position') or 1
+    metrics = get_metrics(harvest)
+
+    def tasks():
+        pages = get_pages(records_url, page_size, workers, start=start,
+                          metrics=metrics)
+        for position, page in metrics.timed_iter(pages, 'csw_page'):
+            # Marks that every page before this one has been processed
+            yield (None, position), None, None
+            for name, doc in page:
+                metrics.count('download_bytes', len(doc))
+                link = get_csw_url(csw_url, name)
+                if sync.is_done(link):
+                    continue
+                prev = sync.get_previous(link)
+                yield (name, prev), doc, prev
+
+    count, errors = sync.done_count, sync.done_errors
+    validation_pool = ValidationPool(metrics=metrics)
+    try:
+        for item, doc, result in validation_pool.imap(tasks()):
+            name, prev = item
+            if name is None:
+                sync.flush()
+                save_checkpoint(db, harvest, csw_position=item[1])
+                continue
+            success = parse_csw_record(db, harvest, csw_url, dest, name,
+                                       doc, previous=prev, result=result,
+                                       writer=sync)
             count += 1
             if not success:
                 errors += 1
+    finally:
+        sync.flush()
+    sync.finish()
+    purge_old_records(sync.new_locations, sync.old_locations, metrics)
 
     return count, errors
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/deletion.py
+
+Removes documents from the Central WAF and their records from MongoDB in
+batches
+'''
+from catalog_harvesting import get_logger
+from catalog_harvesting.metrics import HarvestMetrics
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import errno
+import os
+
+
+# Number of documents removed at a time
+DELETE_BATCH_SIZE = int(os.environ.get('HARVEST_DELETE_BATCH_SIZE', 1000))
+# Number of threads removing batches of documents concurrently
+DELETE_WORKERS = int(os.environ.get('HARVEST_DELETE_WORKERS', 4))
+
+
+def remove_files(locations):
+    '''
+    Removes the files at locations and returns the number of files removed.
+    Files that don't exist are skipped.
+
+    :param list locations: List of file paths
+    '''
+    removed = 0
+    for location in locations:
+        if not location:
+            continue
+        try:
+            os.remove(location)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        removed += 1
+    return removed
+
+
+def iter_batches(iterable, batch_size):
+    '''
+    Returns a generator of lists of up to batch_size items of iterable
+
+    :param iterable: The iterable to split into batches
+    :param int batch_size: Maximum number of items in a batch
+    '''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Deleter(object):
+    '''
+    Removes batches of files in a pool of threads while the caller keeps
+    producing batches, and streams each batch back to the caller once its
+    files are removed.
+
+    Usage::
+
+        deleter = Deleter(workers=4, metrics=metrics)
+        for batch in deleter.imap(iter_batches(locations, 1000)):
+            pass
+        get_logger().info("Removed %d files", deleter.removed)
+
+    '''
+
+    def __init__(self, workers=DELETE_WORKERS, metrics=None):
+        '''
+        :param int workers: Number of threads removing files
+        :param HarvestMetrics metrics: Counts the files removed and the time
+                                       spent removing them
+        '''
+        self.workers = max(1, workers)
+        self.metrics = metrics or HarvestMetrics()
+        # Maximum number of batches held in memory
+        self.window = 2 * self.workers
+        self.removed = 0
+
+    def imap(self, batches, key=None):
+        '''
+        Returns a generator of the batches, in order, after the files of each
+        batch have been removed
+
+        :param batches: An iterable of lists
+        :param key: A function returning the file path of an item of a batch,
+                    by default the items are the file paths
+        '''
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        try:
+            for batch in batches:
+                locations = batch if key is None else [key(item)
+                                                       for item in batch]
+                pending.append((batch, pool.apply_async(remove_files,
+                                                        (locations,))))
+                while pending and (len(pending) >= self.window or
+                                   pending[0][1].ready()):
+                    yield self.finish(*pending.popleft())
+            while pending:
+                yield self.finish(*pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def finish(self, batch, result):
+        '''
+        Returns a batch once its files are removed, counting the files removed
+        '''
+        with self.metrics.timer('delete_wait'):
+            removed = result.get()
+        self.removed += removed
+        self.metrics.count('files_removed', removed)
+        get_logger().debug("Removed %d files", self.removed)
+        return batch
+
+
+def delete_locations(locations, workers=DELETE_WORKERS,
+                     batch_size=DELETE_BATCH_SIZE, metrics=None):
+    '''
+    Removes the files at locations in batches and returns the number of files
+    removed
+
+    :param locations: An iterable of file paths
+    :param int workers: Number of threads removing files
+    :param int batch_size: Number of files removed at a time
+    :param HarvestMetrics metrics: Counts the files removed
+    '''
+    deleter = Deleter(workers, metrics)
+    for batch in deleter.imap(iter_batches(locations, batch_size)):
+        pass
+    return deleter.removed
+
+
+def delete_records(db, query, workers=DELETE_WORKERS,
+                   batch_size=DELETE_BATCH_SIZE, metrics=None):
+    '''
+    Removes the records matching query and their documents, and returns the
+    number of records removed. The records are streamed from the database and
+    each batch of records is removed once its documents are, so an
+    interrupted deletion never leaves documents without a record.
+
+    :param db: MongoDB Database Object
+    :param dict query: Query of the Records collection
+    :param int workers: Number of threads removing files
+    :param int batch_size: Number of records removed at a time
+    :param HarvestMetrics metrics: Counts the files and records removed
+    '''
+    metrics = metrics or HarvestMetrics()
+    deleter = Deleter(workers, metrics)
+    cursor = db.Records.find(query, {"location": True}).batch_size(batch_size)
+    count = 0
+    batches = iter_batches(cursor, batch_size)
+    for batch in deleter.imap(batches, key=lambda rec: rec.get('location')):
+        ids = [rec['_id'] for rec in batch]
+        with metrics.timer('mongo_delete'):
+            db.Records.delete_many({"_id": {"$in": ids}})
+        count += len(ids)
+        metrics.count('records_removed', len(ids))
+    get_logger().info("Removed %d records and %d files", count,
+                      deleter.removed)
+    return count
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/download.py
+
+A bounded pool of workers for downloading documents from a harvest source
+concurrently
+'''
+from catalog_harvesting import get_logger
+from multiprocessing.pool import ThreadPool
+from six.moves.urllib.parse import urlparse
+import os
+import threading
+
+
+# Maximum number of documents downloaded at once for a single harvest
+DOWNLOAD_WORKERS = int(os.environ.get('HARVEST_DOWNLOAD_WORKERS', 8))
+# Maximum number of documents downloaded at once from any one remote host
+HOST_CONNECTIONS = int(os.environ.get('HARVEST_HOST_CONNECTIONS', 4))
+
+
+def get_download_limits(harvest):
+    '''
+    Returns a tuple of the number of download workers and the number of
+    connections allowed per remote host for a harvest. A harvest can override
+    the defaults with the ``download_workers`` and ``host_connections`` fields.
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    workers = harvest.get('download_workers') or DOWNLOAD_WORKERS
+    per_host = harvest.get('host_connections') or HOST_CONNECTIONS
+    return int(workers), int(per_host)
+
+
+class DownloadPool(object):
+    '''
+    Downloads documents using a bounded number of worker threads, while never
+    opening more than ``per_host`` connections to the same remote host.
+
+    Usage::
+
+        pool = DownloadPool(fetch, workers=8, per_host=4)
+        for link, location, response, error in pool.imap(documents):
+            if error is None:
+                do_something_with_response(response)
+
+    '''
+
+    def __init__(self, fetch, workers=DOWNLOAD_WORKERS,
+                 per_host=HOST_CONNECTIONS):
+        '''
+        :param fetch: A callable accepting a URL and a local filename that
+                      downloads the document and returns the response
+        :param int workers: Maximum number of concurrent downloads
+        :param int per_host: Maximum number of concurrent downloads per host
+        '''
+        self.fetch = fetch
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        # Maximum number of downloaded documents waiting on the caller
+        self.backlog = 2 * self.workers
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host_semaphore(self, url):
+        '''
+        Returns the semaphore limiting connections to the host of url
+
+        :param str url: URL of the document
+        '''
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def download(self, document):
+        '''
+        Downloads a single document and returns a tuple of the link, the local
+        filename, the value returned by fetch and the exception raised while
+        downloading, if any.
+
+        :param tuple document: A tuple of the link and the local filename
+        '''
+        link, location = document
+        try:
+            with self.host_semaphore(link):
+                get_logger().info("Downloading %s", link)
+                result = self.fetch(link, location)
+        except Exception as e:
+            get_logger().exception("Failed to download %s", link)
+            return link, location, None, e
+        return link, location, result, None
+
+    def imap(self, documents):
+        '''
+        Returns a generator of (link, location, result, error) tuples in the
+        order the downloads complete. Downloads stop once ``backlog`` results
+        are waiting on the caller.
+
+        :param documents: An iterable of tuples of the link and the local
+                          filename of each document
+        '''
+        slots = threading.Semaphore(self.backlog)
+        state = {'closed': False}
+
+        def throttled():
+            for document in documents:
+                slots.acquire()
+                if state['closed']:
+                    return
+                yield document
+
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self.download, throttled()):
+                slots.release()
+                yield result
+        finally:
+            # unblock the pool's task handler so the pool can terminate
+            state['closed'] = True
+            slots.release()
+            pool.terminate()
+            pool.join()
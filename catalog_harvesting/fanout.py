@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/fanout.py
+
+Spreads a harvest of every published harvest across the RQ workers, one job
+per harvest
+'''
+from catalog_harvesting import get_logger
+from catalog_harvesting.scheduler import get_harvest_order
+from catalog_harvesting.util import unique_id
+from rq import Queue
+import os
+
+
+# Queue the harvest jobs are enqueued on. Workers listen to it after the
+# default queue, so harvests requested through the API are run first.
+HARVEST_QUEUE = os.environ.get('HARVEST_QUEUE', 'nightly')
+# Maximum number of seconds a single harvest job may run
+HARVEST_JOB_TIMEOUT = int(os.environ.get('HARVEST_JOB_TIMEOUT', 3600))
+# Number of seconds the progress of a batch is kept in redis
+BATCH_TTL = 2 * 24 * 3600
+# Redis key holding the ID of the last batch enqueued
+CURRENT_BATCH_KEY = 'harvest_batch:current'
+
+# The jobs are referenced by name so enqueueing them does not start the API
+HARVEST_JOB = 'catalog_harvesting.api.harvest_job'
+CLEAN_JOB = 'catalog_harvesting.api.clean_job'
+
+
+def get_batch_key(batch_id):
+    '''
+    Returns the redis key holding the progress of a batch
+
+    :param str batch_id: ID of the batch
+    '''
+    return 'harvest_batch:{}'.format(batch_id)
+
+
+def enqueue_harvests(db, redis_connection, dest, max_days=None,
+                     queue_name=HARVEST_QUEUE):
+    '''
+    Enqueues a harvest job for every published harvest, the harvests that
+    took the longest last time first, and returns the ID of the batch. If
+    max_days is given, the last job of the batch to finish enqueues a job
+    that removes the stale contents of dest.
+
+    A job that fails or times out still finishes its batch, but a worker
+    that is killed outright (i.e. by the OOM killer) never does. If the
+    previous batch is still unfinished, its clean job is enqueued here
+    instead, see finish_previous_batch.
+
+    :param db: MongoDB Client
+    :param redis_connection: Redis client
+    :param str dest: Destination folder of the harvests
+    :param int max_days: Maximum number of days to keep an old record before
+                         removing it, or None to keep every record
+    :param str queue_name: Name of the RQ queue
+    '''
+    harvests = get_harvest_order(list(db.Harvests.find({"publish": True})))
+    queue = Queue(queue_name, connection=redis_connection)
+    finish_previous_batch(redis_connection)
+    batch_id = unique_id()
+    redis_connection.set(CURRENT_BATCH_KEY, batch_id, ex=BATCH_TTL)
+
+    if not harvests:
+        if max_days is not None:
+            queue.enqueue(CLEAN_JOB, dest, max_days,
+                          timeout=HARVEST_JOB_TIMEOUT)
+        return batch_id
+
+    key = get_batch_key(batch_id)
+    pipe = redis_connection.pipeline()
+    pipe.hset(key, 'remaining', len(harvests))
+    pipe.hset(key, 'dest', dest)
+    pipe.hset(key, 'max_days', '' if max_days is None else max_days)
+    pipe.hset(key, 'queue', queue_name)
+    pipe.expire(key, BATCH_TTL)
+    pipe.execute()
+
+    get_logger().info("Enqueueing %d harvests on %s", len(harvests),
+                      queue_name)
+    for harvest in harvests:
+        queue.enqueue(HARVEST_JOB, harvest['_id'],
+                      batch_id=batch_id, timeout=HARVEST_JOB_TIMEOUT)
+    return batch_id
+
+
+def finish_previous_batch(redis_connection):
+    '''
+    Finishes the last batch enqueued if some of its jobs never finished, i.e.
+    because their worker was killed, and enqueues its clean job. Returns True
+    if the batch was unfinished.
+
+    :param redis_connection: Redis client
+    '''
+    batch_id = redis_connection.get(CURRENT_BATCH_KEY)
+    if batch_id is None:
+        return False
+    if isinstance(batch_id, bytes):
+        batch_id = batch_id.decode('utf-8')
+    key = get_batch_key(batch_id)
+    remaining = redis_connection.hget(key, 'remaining')
+    if remaining is None or int(remaining) <= 0:
+        return False
+    get_logger().warning("Harvest batch %s has %s unfinished jobs",
+                         batch_id, int(remaining))
+    # Leaves a single job to finish, so finishing it cleans once
+    redis_connection.hset(key, 'remaining', 1)
+    return finish_batch_job(redis_connection, batch_id)
+
+
+def finish_batch_job(redis_connection, batch_id):
+    '''
+    Records that a job of a batch finished. Returns True if it was the last
+    job of the batch, in which case the job removing the stale contents of
+    the destination folder is enqueued.
+
+    :param redis_connection: Redis client
+    :param str batch_id: ID of the batch
+    '''
+    key = get_batch_key(batch_id)
+    remaining = redis_connection.hincrby(key, 'remaining', -1)
+    if remaining != 0:
+        # A negative count means the batch expired or was already finished
+        return False
+
+    dest, max_days, queue_name = [
+        value.decode('utf-8') if isinstance(value, bytes) else value
+        for value in redis_connection.hmget(key, 'dest', 'max_days', 'queue')
+    ]
+    redis_connection.delete(key)
+    get_logger().info("Finished harvest batch %s", batch_id)
+    if max_days:
+        queue = Queue(queue_name, connection=redis_connection)
+        queue.enqueue(CLEAN_JOB, dest, int(max_days),
+                      timeout=HARVEST_JOB_TIMEOUT)
+    return True
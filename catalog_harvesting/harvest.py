@@ -7,58 +7,74 @@ A set of modules to support downloading and synchronizing a WAF
 from catalog_harvesting.waf_parser import WAFParser
 from catalog_harvesting.erddap_waf_parser import ERDDAPWAFParser
 from catalog_harvesting.csw import download_csw
-from catalog_harvesting import get_logger, get_redis_connection
-from catalog_harvesting.records import parse_records
+from catalog_harvesting.download import DownloadPool, get_download_limits
+from catalog_harvesting import get_logger, get_redis
+from catalog_harvesting.records import (process_doc, get_record_url,
+                                        purge_old_records, ValidationPool,
+                                        RecordSync, start_validation_pool,
+                                        stop_validation_pool, is_incremental,
+                                        VALIDATION_WORKERS)
+from catalog_harvesting.scheduler import HarvestScheduler
+from catalog_harvesting.checkpoint import start_checkpoint
+from catalog_harvesting.metrics import (start_metrics, get_metrics,
+                                        stop_metrics)
+from catalog_harvesting.waf_index import clean_expired
+from catalog_harvesting.deletion import delete_records
+from catalog_harvesting.record_queue import (use_record_jobs, enqueue_records,
+                                             finish_record_job)
 from catalog_harvesting.ckan_api import get_harvest_info, create_harvest_job
 from catalog_harvesting.notify import Mail, Message, MAIL_DEFAULT_SENDER
+from catalog_harvesting.util import get_database
+from catalog_harvesting.session import get_session
 from hashlib import sha1
-from pymongo import MongoClient
 from datetime import datetime
 from base64 import b64encode
-import requests
 import os
 import time
-import redis
 
 
 def download_from_db(conn_string, dest):
     '''
-    Download several WAFs using collections from MongoDB as a source
+    Download several WAFs using collections from MongoDB as a source. The
+    harvests are run concurrently by a HarvestScheduler, longest first.
 
     :param str conn_string: MongoDB connection string
     :param str db_name: The name of the MongoDB database to connect to
     :param str dest: Write directory destination
     '''
 
-    tokens = conn_string.split('/')
-    if len(tokens) > 3:
-        db_name = tokens[3]
-    else:
-        db_name = 'default'
-
-    db = MongoClient(conn_string)[db_name]
-    for harvest in list(db.Harvests.find({"publish": True})):
-        try:
-            download_harvest(db, harvest, dest)
-        except KeyboardInterrupt:
-            # exit on SIGINT
-            raise
-        except:
-            get_logger().exception("Failed to harvest")
-            get_logger().error(harvest)
+    db = get_database(conn_string)
+    harvests = list(db.Harvests.find({"publish": True}))
+    # Fork the validation workers before any harvest threads are started
+    start_validation_pool()
+    try:
+        scheduler = HarvestScheduler(
+            lambda harvest: download_harvest(db, harvest, dest))
+        scheduler.run(harvests)
+    finally:
+        stop_validation_pool()
 
 
-def download_harvest(db, harvest, dest):
+def download_harvest(db, harvest, dest, redis_connection=None):
     '''
     Downloads a harvest from the mongo db and updates the harvest with the
-    latest harvest date.
+    latest harvest date. A harvest that was interrupted is resumed from its
+    checkpoint, which is removed once the harvest succeeds. The time spent in
+    each stage of the harvest is stored in ``last_harvest_metrics``.
+
+    Given a redis connection, the documents of a harvest that uses record
+    jobs are only crawled and enqueued, see enqueue_record_jobs.
 
     :param db: Mongo DB Client
     :param dict harvest: A dictionary returned from the mongo collection for
                          harvests.
+    :param str dest: Write directory destination
+    :param redis_connection: Redis client
     '''
     src = harvest['url']
     get_logger().info('harvesting: %s' % src)
+    start = time.time()
+    metrics = start_metrics(harvest)
     db.Harvests.update({"_id": harvest['_id']}, {
         "$set": {
             "last_harvest_dt": "harvesting",
@@ -66,8 +82,12 @@ def download_harvest(db, harvest, dest):
         }
     })
     try:
+        start_checkpoint(db, harvest)
         provider_str = harvest['organization']
         path = os.path.join(dest, provider_str)
+        if redis_connection is not None and use_record_jobs(harvest):
+            enqueue_record_jobs(db, redis_connection, harvest, src, path)
+            return
         if harvest['harvest_type'] == 'WAF':
             records, errors = download_waf(db, harvest, src, path)
         elif harvest['harvest_type'] == 'ERDDAP-WAF':
@@ -82,10 +102,18 @@ def download_harvest(db, harvest, dest):
                 "last_record_count": records,
                 "last_good_count": (records - errors),
                 "last_bad_count": errors,
+                "last_harvest_duration": time.time() - start,
                 "last_harvest_status": "ok"
-            }
+            },
+            "$unset": {"checkpoint": ""}
+        })
+        with metrics.timer('ckan'):
+            trigger_ckan_harvest(db, harvest)
+        summary = stop_metrics(harvest)
+        get_logger().info("Harvested %s: %s", src, summary)
+        db.Harvests.update({"_id": harvest['_id']}, {
+            "$set": {"last_harvest_metrics": summary}
         })
-        trigger_ckan_harvest(db, harvest)
     except:
         send_notifications(db, harvest)
         get_logger().exception("Failed to successfully harvest %s",
@@ -93,6 +121,7 @@ def download_harvest(db, harvest, dest):
         db.Harvests.update({"_id": harvest['_id']}, {
             "$set": {
                 "last_harvest_dt": datetime.utcnow(),
+                "last_harvest_metrics": stop_metrics(harvest),
                 "last_harvest_status": "fail"
             }
         })
@@ -108,15 +137,9 @@ def delete_harvest(db, harvest):
     '''
 
     try:
-        # Remove attempts
-        records = list(db.Records.find({"harvest_id": harvest['_id']}))
-        for record in records:
-            if os.path.exists(record['location']):
-                get_logger().info("Removing %s", record['location'])
-                os.remove(record['location'])
-
-        db.Records.remove({"harvest_id": harvest['_id']})
+        delete_records(db, {"harvest_id": harvest['_id']})
 
+        # Remove attempts
         db.Attempts.remove({"parent_harvest": harvest['_id']})
         db.Harvests.remove({"_id": harvest['_id']})
 
@@ -141,7 +164,7 @@ def send_notifications(db, harvest):
         if user_emails and user_emails[0]['address']:
             emails.append(user_emails[0]['address'])
 
-    recipients = [email for email in emails if throttle_email(email)]
+    recipients = throttle_emails(emails)
     # If there are no recipients, obviously don't send an email
     if not recipients:
         return
@@ -158,24 +181,39 @@ def send_notifications(db, harvest):
     mail.send(msg)
 
 
-def throttle_email(email, timeout=3600):
+def throttle_email(email, timeout=3600, redis_connection=None):
     '''
-    Returns True if an email has already been sent in the last timeout seconds.
+    Returns True if an email may be sent to the recipient, i.e. no email was
+    sent in the last timeout seconds.
 
     :param str email: Email address of the recipient
     :param int timeout: Seconds to wait until the next email can be sent
+    :param redis_connection: Redis client, defaults to the shared client
     '''
-    host, port, db = get_redis_connection()
-    redis_pool = redis.ConnectionPool(host=host, port=port, db=db)
-    rc = redis.Redis(connection_pool=redis_pool)
+    return bool(throttle_emails([email], timeout, redis_connection))
 
-    key = 'harvesting:notifications:' + b64encode(email)
 
-    value = rc.get(key)
-    if value is None:
-        rc.setex(key, 1, timeout)
-        return True
-    return False
+def throttle_emails(emails, timeout=3600, redis_connection=None):
+    '''
+    Returns the recipients that may be sent an email, i.e. that were not sent
+    one in the last timeout seconds, and starts their timeout. Every recipient
+    is checked and set in a single round trip, atomically for each recipient,
+    so concurrent workers never both notify the same recipient.
+
+    :param list emails: Email addresses of the recipients
+    :param int timeout: Seconds to wait until the next email can be sent
+    :param redis_connection: Redis client, defaults to the shared client
+    '''
+    if not emails:
+        return []
+    rc = redis_connection or get_redis()
+    pipe = rc.pipeline(transaction=False)
+    for email in emails:
+        key = 'harvesting:notifications:' + \
+            b64encode(email.encode('utf-8')).decode('ascii')
+        pipe.set(key, 1, ex=timeout, nx=True)
+    return [email for email, allowed in zip(emails, pipe.execute())
+            if allowed]
 
 
 def trigger_ckan_harvest(db, harvest):
@@ -208,40 +246,25 @@ def download_waf(db, harvest, src, dest):
     if not os.path.exists(dest):
         os.makedirs(dest)
 
-    waf_parser = WAFParser(src)
-    old_records = set(rec["location"] for rec in
-                      db.Records.find({"harvest_id": harvest['_id'],
-                                       "location": {"$exists": True}},
-                                      {"location": True}))
-    db.Records.remove({"harvest_id": harvest['_id']})
-    new_records = set()
-
-    count = 0
-    errors = 0
-    for link in waf_parser.parse():
-        get_logger().info("Downloading %s", link)
-        try:
-            link_hash = sha1(link.encode('utf-8')).hexdigest()
-            doc_name = link_hash + '.xml'
-            local_filename = os.path.join(dest, doc_name)
-            get_logger().info("Saving to %s", local_filename)
-
-            download_file(link, local_filename)
-            rec = parse_records(db, harvest, link, local_filename)
-            new_records.add(rec["location"])
-
-            if len(rec['validation_errors']):
-                errors += 1
-            count += 1
-
-        except KeyboardInterrupt:
-            raise
-        except Exception:
-            errors += 1
-            get_logger().exception("Failed to download")
-            continue
-    purge_old_records(new_records, old_records)
-    return count, errors
+    return download_documents(db, harvest, get_waf_documents(harvest, src,
+                                                             dest))
+
+
+def get_waf_documents(harvest, src, dest):
+    '''
+    Returns a generator of tuples of the link to each document of a WAF and
+    the local filename to write it to
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param url src: URL to the WAF
+    :param str dest: Folder to download to
+    '''
+    waf_parser = WAFParser(src, metrics=get_metrics(harvest))
+    for link in waf_parser.iter_documents():
+        link_hash = sha1(link.encode('utf-8')).hexdigest()
+        doc_name = link_hash + '.xml'
+        yield link, os.path.join(dest, doc_name)
 
 
 def download_erddap_waf(db, harvest, src, dest):
@@ -257,65 +280,315 @@ def download_erddap_waf(db, harvest, src, dest):
     if not os.path.exists(dest):
         os.makedirs(dest)
 
-    waf_parser = ERDDAPWAFParser(src)
-
-    old_records = set(rec["location"] for rec in
-                      db.Records.find({"harvest_id": harvest['_id'],
-                                       "location": {"$exists": True}},
-                                      {"location": True}))
-    db.Records.remove({"harvest_id": harvest['_id']})
-    new_records = set()
-
-    count = 0
-    errors = 0
-    for link in waf_parser.parse():
-        get_logger().info("Downloading %s", link)
-        try:
-            doc_name = link.split('/')[-1]
-            local_filename = os.path.join(dest, doc_name)
-            # CKAN only looks for XML documents for the harvester
-            if not local_filename.endswith('.xml'):
-                local_filename += '.xml'
-            download_file(link, local_filename)
-            rec = parse_records(db, harvest, link, local_filename)
-            new_records.add(rec["location"])
-            if len(rec['validation_errors']):
+    return download_documents(db, harvest, get_erddap_documents(harvest, src,
+                                                                dest))
+
+
+def get_erddap_documents(harvest, src, dest):
+    '''
+    Returns a generator of tuples of the link to each document of an ERDDAP
+    WAF and the local filename to write it to
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param url src: URL to the WAF
+    :param str dest: Folder to download to
+    '''
+    waf_parser = ERDDAPWAFParser(src, metrics=get_metrics(harvest))
+    for link in waf_parser.iter_documents():
+        doc_name = link.split('/')[-1]
+        local_filename = os.path.join(dest, doc_name)
+        # CKAN only looks for XML documents for the harvester
+        if not local_filename.endswith('.xml'):
+            local_filename += '.xml'
+        yield link, local_filename
+
+
+def enqueue_record_jobs(db, redis_connection, harvest, src, dest):
+    '''
+    Crawls a WAF or ERDDAP WAF and enqueues record jobs downloading its
+    documents, so the documents of the harvest are downloaded, validated and
+    written by every worker listening to the record queue. The harvest is
+    updated by finish_record_harvest once the last job finishes.
+
+    For harvests that aren't incremental the records of the previous run are
+    removed up front, and their documents are left for the cleaning job.
+
+    :param db: Mongo DB Client
+    :param redis_connection: Redis client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param url src: URL to the WAF
+    :param str dest: Folder to download to
+    '''
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+
+    run_id = harvest['checkpoint']['run_id']
+    if not is_incremental(harvest):
+        db.Records.remove({"harvest_id": harvest['_id'],
+                           "harvest_run": {"$ne": run_id}})
+
+    if harvest['harvest_type'] == 'ERDDAP-WAF':
+        documents = get_erddap_documents(harvest, src, dest)
+    else:
+        documents = get_waf_documents(harvest, src, dest)
+    enqueue_records(db, redis_connection, harvest, documents)
+    summary = stop_metrics(harvest)
+    generation = harvest['checkpoint']['record_generation']
+    totals = finish_record_job(redis_connection, generation,
+                               counters=summary['counters'])
+    if totals is not None:
+        finish_record_harvest(db, harvest, totals)
+
+
+def download_record_batch(db, harvest, documents):
+    '''
+    Downloads the documents of a record job, and returns a tuple of the number
+    of records, the number of records with errors and the counters of the
+    metrics of the job.
+
+    :param db: Mongo DB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param list documents: A list of tuples of the link to a document and the
+                           local filename to write it to
+    '''
+    metrics = start_metrics(harvest)
+    try:
+        sync = RecordSync(db, harvest, links=[link for link, _ in documents])
+        # The record jobs are the parallelism, validate in the job itself
+        count, errors = process_documents(db, harvest, documents, sync,
+                                          validation_workers=1)
+    finally:
+        stop_metrics(harvest)
+    return count, errors, dict(metrics.counters)
+
+
+def finish_record_harvest(db, harvest, totals):
+    '''
+    Finishes a run of a harvest whose documents were downloaded by record
+    jobs. The records and documents that weren't seen in the run are removed
+    and the harvest is updated with the totals of the run.
+
+    :param db: Mongo DB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param dict totals: The totals of the run returned by finish_record_job
+    '''
+    run_id = harvest['checkpoint']['run_id']
+    delete_records(db, {"harvest_id": harvest['_id'],
+                        "harvest_run": {"$ne": run_id}})
+    records = totals.get('records', 0)
+    errors = totals.get('errors', 0)
+    duration = time.time() - totals.get('started', time.time())
+    get_logger().info("Harvested %s with record jobs: %d records",
+                      harvest['url'], records)
+    db.Harvests.update({"_id": harvest['_id']}, {
+        "$set": {
+            "last_harvest_dt": datetime.utcnow(),
+            "last_record_count": records,
+            "last_good_count": (records - errors),
+            "last_bad_count": errors,
+            "last_harvest_duration": duration,
+            "last_harvest_metrics": {
+                "duration": duration,
+                "stages": {},
+                "counters": totals.get('counters', {})
+            },
+            "last_harvest_status": "ok"
+        },
+        "$unset": {"checkpoint": ""}
+    })
+    trigger_ckan_harvest(db, harvest)
+
+
+def download_documents(db, harvest, documents):
+    '''
+    Downloads documents concurrently and parses each downloaded document into
+    a record. Returns a tuple of the number of records and the number of
+    records with errors.
+
+    For incremental harvests, documents that were harvested before are
+    requested conditionally and the existing record is kept as is if the
+    source reports that the document has not been modified. Documents that
+    are downloaded again but hash to the same contents reuse the validation
+    results of the existing record. Documents already processed by an
+    interrupted run of the harvest that is being resumed are skipped.
+
+    :param db: Mongo DB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param documents: An iterable of tuples of the link to a document and the
+                      local filename to write it to
+    '''
+    sync = RecordSync(db, harvest)
+    count, errors = process_documents(db, harvest, documents, sync)
+    sync.finish()
+    purge_old_records(sync.new_locations, sync.old_locations,
+                      get_metrics(harvest))
+    return count, errors
+
+
+def process_documents(db, harvest, documents, sync,
+                      validation_workers=VALIDATION_WORKERS):
+    '''
+    Downloads documents concurrently and writes their records through sync.
+    Returns a tuple of the number of records and the number of records with
+    errors, including the records of the documents already done.
+
+    :param db: Mongo DB Client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param documents: An iterable of tuples of the link to a document and the
+                      local filename to write it to
+    :param RecordSync sync: Synchronizes the records of the harvest
+    :param int validation_workers: Number of worker processes validating the
+                                   documents
+    '''
+    metrics = get_metrics(harvest)
+
+    def fetch(link, location):
+        rec = sync.get_previous(link)
+        headers = None
+        if rec is not None and rec.get('location') == location and \
+                os.path.exists(location):
+            headers = get_cache_headers(rec)
+        with metrics.timer('download'):
+            response = fetch_document(link, headers)
+        if response.status_code == 304:
+            metrics.count('not_modified')
+        else:
+            metrics.count('download_bytes', len(response.content))
+        return response
+
+    workers, per_host = get_download_limits(harvest)
+    pool = DownloadPool(fetch, workers=workers, per_host=per_host)
+    # Skip the documents already processed by an interrupted run
+    remaining = ((link, local_filename) for link, local_filename in documents
+                 if not sync.is_done(link))
+
+    def downloaded():
+        for link, local_filename, response, error in pool.imap(remaining):
+            doc = None
+            if error is None and response.status_code != 304:
+                doc = response.content
+            yield ((link, local_filename, response, error), doc,
+                   sync.get_previous(link))
+
+    count = sync.done_count
+    errors = sync.done_errors
+    validation_pool = ValidationPool(validation_workers, metrics=metrics)
+    try:
+        for item, doc, result in validation_pool.imap(downloaded()):
+            link, local_filename, response, error = item
+            if error is not None:
+                metrics.count('download_errors')
                 errors += 1
-            count += 1
-        except KeyboardInterrupt:
-            raise
-        except Exception:
-            errors += 1
-            get_logger().exception("Failed to download")
-            continue
-    purge_old_records(new_records, old_records)
+                continue
+            try:
+                if doc is None:
+                    rec = sync.keep(link)
+                    if rec is None:
+                        # The record was already kept for an earlier
+                        # duplicate of the link
+                        continue
+                    get_logger().info("Not modified %s", link)
+                    # Keep the file from aging out of the central WAF
+                    os.utime(local_filename, None)
+                else:
+                    rec = process_doc(doc, get_record_url(local_filename),
+                                      local_filename, harvest, link, db,
+                                      cache_info=get_cache_info(response),
+                                      previous=sync.get_previous(link),
+                                      result=result, writer=sync)
+
+                if len(rec['validation_errors']):
+                    errors += 1
+                count += 1
+
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                errors += 1
+                get_logger().exception("Failed to download")
+                continue
+    finally:
+        sync.flush()
     return count, errors
 
 
-def download_file(url, location):
+def fetch_document(url, headers=None):
     '''
-    Downloads a file from a URL and writes it to location
+    Downloads a document from a URL into memory and returns the HTTP response,
+    which is either a 200 or, for a conditional request, a 304. Raises an
+    IOError for any other status, so the body and validators of an error
+    response are never stored.
 
     :param str url: URL to download document
-    :param str location: Full filename to write to
+    :param dict headers: Additional HTTP headers to send with the request
+    '''
+    response = get_session().get(url, headers=headers, timeout=30)
+    if response.status_code not in (200, 304):
+        raise IOError("Failed to retrieve document: HTTP %s" %
+                      response.status_code)
+    return response
+
+
+def get_cache_info(response):
+    '''
+    Returns a dictionary of the HTTP cache validators of a response to store
+    with the record
+
+    :param response: HTTP response for a document
+    '''
+    return {
+        "etag": response.headers.get('ETag'),
+        "last_modified": response.headers.get('Last-Modified')
+    }
+
+
+def get_cache_headers(record):
+    '''
+    Returns the HTTP headers for a conditional request of a previously
+    harvested record
+
+    :param dict record: A record from the mongo collection for records
+    '''
+    headers = {}
+    if record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record.get('last_modified'):
+        headers['If-Modified-Since'] = record['last_modified']
+    return headers
+
+
+def get_stale_expiration_days():
+    '''
+    Returns the number of days to keep a record that has not been updated,
+    from the STALE_EXPIRATION_DAYS environment variable or 3 if it is unset
+    or unparseable
     '''
-    r = requests.get(url, stream=True, timeout=30)
-    with open(location, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024 * 1024):
-            if chunk:
-                f.write(chunk)
-    return location
+    try:
+        return int(os.getenv('STALE_EXPIRATION_DAYS', 3))
+    except ValueError:
+        return 3
 
 
-def force_clean(path, max_days=3):
+def force_clean(path, max_days=3, db=None):
     '''
     Deletes any files in path that end in .xml and are older than the specified
-    number of days
+    number of days. With a database, the expired files are looked up in the
+    index of the files seen by harvests instead of scanning path.
 
     :param str path: Path to a folder to clean
     :param int max_days: Maximum number of days to keep an old record before
                          removing it.
+    :param db: MongoDB Database Object
     '''
+    if db is not None:
+        return clean_expired(db, path, max_days)
+
     now = time.time()
     for root, dirs, files in os.walk(path):
         for filename in files:
@@ -328,18 +601,3 @@ def force_clean(path, max_days=3):
             if (now - mtime) > (24 * 3600 * max_days):
                 get_logger().info("Removing %s", filepath)
                 os.remove(filepath)
-
-
-def purge_old_records(new_records, old_records):
-    '''
-    Deletes any records in old_records that aren't in new_records
-
-    :param list new_records: List of records
-    :param list old_records: List of records
-    '''
-    get_logger().info("Purging old records from WAF")
-    removal = old_records - new_records
-    for location in removal:
-        if os.path.exists(location):
-            get_logger().info("Removing %s", location)
-            os.remove(location)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/indexes.py
+
+Indexes required by the queries made against the registry's collections
+'''
+from catalog_harvesting import get_logger
+from pymongo import ASCENDING
+
+
+# Collection name to the list of index keys required on it
+INDEXES = {
+    'Records': [
+        [('harvest_id', ASCENDING), ('url', ASCENDING)],
+        [('harvest_id', ASCENDING), ('location', ASCENDING)]
+    ],
+    'Attempts': [
+        [('parent_harvest', ASCENDING)]
+    ],
+    'Harvests': [
+        [('publish', ASCENDING)]
+    ],
+    'users': [
+        [('profile.organization', ASCENDING)]
+    ],
+    'Organizations': [
+        [('name', ASCENDING)]
+    ],
+    'WafFiles': [
+        [('last_seen', ASCENDING)]
+    ]
+}
+
+
+def missing_indexes(db):
+    '''
+    Returns a list of tuples of the collection name and index keys for each
+    required index that doesn't exist in the database
+
+    :param db: MongoDB Database Object
+    '''
+    missing = []
+    for collection, indexes in sorted(INDEXES.items()):
+        existing = [info['key'] for info in
+                    db[collection].index_information().values()]
+        for keys in indexes:
+            if keys not in [list(key) for key in existing]:
+                missing.append((collection, keys))
+    return missing
+
+
+def ensure_indexes(db):
+    '''
+    Creates any required index that doesn't exist in the database and returns
+    the list of tuples of the collection name and index keys that were created
+
+    :param db: MongoDB Database Object
+    '''
+    missing = missing_indexes(db)
+    for collection, keys in missing:
+        get_logger().warning("Creating missing index %s on %s", keys,
+                             collection)
+        db[collection].create_index(keys, background=True)
+    return missing
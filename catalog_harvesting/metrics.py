@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/metrics.py
+
+Timings and counters of the stages of a harvest
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+
+# Percentiles reported for the timings of each stage
+PERCENTILES = (50, 90, 99)
+
+# Metrics of the harvests running in this process, by harvest _id
+ACTIVE_METRICS = {}
+
+
+def percentile(values, pct):
+    '''
+    Returns the nearest-rank percentile of a sorted list of values
+
+    :param list values: Sorted list of values
+    :param int pct: The percentile, from 0 to 100
+    '''
+    if not values:
+        return 0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(len(values) - 1, max(0, rank))]
+
+
+class HarvestMetrics(object):
+    '''
+    Collects the time spent in each stage of a harvest and counters such as
+    the number of bytes downloaded. It is safe to use from several threads.
+
+    Usage::
+
+        metrics = HarvestMetrics()
+        with metrics.timer('download'):
+            response = fetch_document(link)
+        metrics.count('download_bytes', len(response.content))
+        summary = metrics.summary()
+
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Returns a context manager that adds the time spent in its block to a
+        stage
+
+        :param str stage: Name of the stage
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+    def timed_iter(self, iterable, stage):
+        '''
+        Returns a generator of the items of iterable that adds the time spent
+        waiting on each item to a stage
+
+        :param iterable: The iterable to time
+        :param str stage: Name of the stage
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.time() - start)
+            yield item
+
+    def add_time(self, stage, seconds):
+        '''
+        Adds a timing to a stage
+
+        :param str stage: Name of the stage
+        :param float seconds: Time spent in the stage
+        '''
+        with self._lock:
+            self.timings[stage].append(seconds)
+
+    def add_timings(self, timings):
+        '''
+        Adds the timings of a dictionary of stage names to seconds, i.e. the
+        timings recorded by process_xml
+
+        :param dict timings: Dictionary of stage names to seconds
+        '''
+        if not timings:
+            return
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.timings[stage].append(seconds)
+
+    def count(self, name, value=1):
+        '''
+        Increments a counter
+
+        :param str name: Name of the counter
+        :param int value: Value to add to the counter
+        '''
+        with self._lock:
+            self.counters[name] += value
+
+    def summary(self):
+        '''
+        Returns a dictionary summarizing the metrics, suitable for storing in
+        MongoDB
+        '''
+        with self._lock:
+            timings = dict((stage, sorted(values))
+                           for stage, values in self.timings.items())
+            counters = dict(self.counters)
+
+        stages = {}
+        for stage, values in timings.items():
+            total = sum(values)
+            stats = {
+                "count": len(values),
+                "total": total,
+                "mean": total / len(values),
+                "max": values[-1]
+            }
+            for pct in PERCENTILES:
+                stats["p%d" % pct] = percentile(values, pct)
+            stages[stage] = stats
+        return {
+            "duration": time.time() - self.started,
+            "stages": stages,
+            "counters": counters
+        }
+
+
+def start_metrics(harvest):
+    '''
+    Starts collecting the metrics of a harvest and returns them
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    metrics = HarvestMetrics()
+    ACTIVE_METRICS[harvest['_id']] = metrics
+    return metrics
+
+
+def get_metrics(harvest):
+    '''
+    Returns the metrics of a harvest started by start_metrics. If the metrics
+    of the harvest are not being collected, metrics that are discarded are
+    returned instead.
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    metrics = ACTIVE_METRICS.get(harvest.get('_id'))
+    if metrics is None:
+        metrics = HarvestMetrics()
+    return metrics
+
+
+def stop_metrics(harvest):
+    '''
+    Stops collecting the metrics of a harvest and returns the summary of them
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    metrics = ACTIVE_METRICS.pop(harvest['_id'], None)
+    if metrics is None:
+        return None
+    return metrics.summary()
+
+
+def format_prometheus(harvests):
+    '''
+    Returns the metrics of the last run of each harvest in the Prometheus
+    text exposition format
+
+    :param list harvests: A list of harvest dictionaries
+    '''
+    lines = [
+        '# TYPE harvest_records gauge',
+        '# TYPE harvest_bad_records gauge',
+        '# TYPE harvest_duration_seconds gauge',
+        '# TYPE harvest_stage_seconds summary',
+        '# TYPE harvest_counter gauge'
+    ]
+    for harvest in harvests:
+        harvest_label = 'harvest="%s"' % escape_label(harvest['_id'])
+        for name, field in (('harvest_records', 'last_record_count'),
+                            ('harvest_bad_records', 'last_bad_count'),
+                            ('harvest_duration_seconds',
+                             'last_harvest_duration')):
+            if harvest.get(field) is not None:
+                lines.append('%s{%s} %s' % (name, harvest_label,
+                                            harvest[field]))
+
+        summary = harvest.get('last_harvest_metrics') or {}
+        for stage, stats in sorted(summary.get('stages', {}).items()):
+            labels = '%s,stage="%s"' % (harvest_label, escape_label(stage))
+            for pct in PERCENTILES:
+                lines.append('harvest_stage_seconds{%s,quantile="%s"} %s' %
+                             (labels, pct / 100.0, stats.get('p%d' % pct, 0)))
+            lines.append('harvest_stage_seconds_sum{%s} %s' %
+                         (labels, stats['total']))
+            lines.append('harvest_stage_seconds_count{%s} %s' %
+                         (labels, stats['count']))
+        for name, value in sorted(summary.get('counters', {}).items()):
+            lines.append('harvest_counter{%s,name="%s"} %s' %
+                         (harvest_label, escape_label(name), value))
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    '''
+    Escapes a Prometheus label value
+
+    :param value: The value of the label
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
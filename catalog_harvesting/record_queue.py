@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/record_queue.py
+
+Spreads the documents of a single harvest across the RQ workers, one job per
+batch of documents, so the largest harvests are not limited to one worker
+'''
+from catalog_harvesting import get_logger
+from catalog_harvesting.checkpoint import save_checkpoint
+from catalog_harvesting.fanout import HARVEST_JOB_TIMEOUT
+from catalog_harvesting.deletion import iter_batches
+from catalog_harvesting.util import unique_id
+from datetime import datetime
+from rq import Queue, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry
+import os
+import time
+
+
+# Harvests are split into record jobs unless a harvest sets ``record_jobs``
+RECORD_JOBS = bool(os.environ.get('HARVEST_RECORD_JOBS', 'False').lower() == 'true')
+# Queue the record jobs are enqueued on
+RECORD_QUEUE = os.environ.get('HARVEST_RECORD_QUEUE', 'records')
+# Number of documents downloaded, validated and written by each record job
+RECORD_BATCH_SIZE = int(os.environ.get('HARVEST_RECORD_BATCH_SIZE', 50))
+# Number of seconds the progress of a run is kept in redis
+RUN_TTL = 2 * 24 * 3600
+# Number of seconds between checks for record jobs whose worker was killed
+RECOVERY_INTERVAL = int(os.environ.get('HARVEST_RECOVERY_INTERVAL', 600))
+RECOVERY_KEY = 'harvest_run:recovery'
+
+# Harvest types whose documents can be downloaded independently of each other
+RECORD_JOB_TYPES = ('WAF', 'ERDDAP-WAF')
+
+# The job is referenced by name so enqueueing it does not start the API
+RECORD_JOB = 'catalog_harvesting.api.record_job'
+
+
+def use_record_jobs(harvest):
+    '''
+    Returns True if the documents of a harvest are downloaded by record jobs.
+    A harvest can override the HARVEST_RECORD_JOBS setting with its
+    ``record_jobs`` field.
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    if harvest['harvest_type'] not in RECORD_JOB_TYPES:
+        return False
+    return bool(harvest.get('record_jobs', RECORD_JOBS))
+
+
+def get_run_key(generation):
+    '''
+    Returns the redis key holding the progress of the record jobs of a
+    generation
+
+    :param str generation: ID of the generation, see enqueue_records
+    '''
+    return 'harvest_run:{}'.format(generation)
+
+
+def get_jobs_key(generation):
+    '''
+    Returns the redis key holding the IDs of the record jobs of a generation
+    that haven't finished, and the number of documents of each
+
+    :param str generation: ID of the generation, see enqueue_records
+    '''
+    return 'harvest_run:{}:jobs'.format(generation)
+
+
+def is_current_generation(harvest, run_id, generation):
+    '''
+    Returns True if a record job of the run and generation belongs to the
+    last enqueue of the run of the harvest that is in progress
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param str run_id: ID of the run of the job
+    :param str generation: ID of the generation of the job
+    '''
+    checkpoint = (harvest or {}).get('checkpoint') or {}
+    return checkpoint.get('run_id') == run_id and \
+        checkpoint.get('record_generation') == generation
+
+
+def enqueue_records(db, redis_connection, harvest, documents,
+                    batch_size=RECORD_BATCH_SIZE, queue_name=RECORD_QUEUE):
+    '''
+    Enqueues a record job for every batch_size documents and returns the
+    number of jobs enqueued. The harvest must have been started with a
+    checkpoint. The last job to finish is told so by finish_record_job.
+
+    A run that is resumed is enqueued again, so each enqueue starts a new
+    generation, stored as ``record_generation`` in the checkpoint. The jobs
+    of earlier generations of the run are skipped and never count towards
+    the new one.
+
+    The IDs of the jobs that haven't finished are kept, so a run whose jobs
+    were lost with their worker can be failed, see recover_record_runs.
+
+    :param db: MongoDB Client
+    :param redis_connection: Redis client
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    :param documents: An iterable of tuples of the link to a document and the
+                      local filename to write it to
+    :param int batch_size: Number of documents of each job
+    :param str queue_name: Name of the RQ queue
+    '''
+    run_id = harvest['checkpoint']['run_id']
+    previous = harvest['checkpoint'].get('record_generation')
+    generation = unique_id()
+    save_checkpoint(db, harvest, record_generation=generation)
+    if previous:
+        redis_connection.delete(get_run_key(previous),
+                                get_jobs_key(previous))
+    key = get_run_key(generation)
+    jobs_key = get_jobs_key(generation)
+    queue = Queue(queue_name, connection=redis_connection)
+
+    # The enqueuer holds one count itself, so the jobs that finish while the
+    # source is still being crawled never bring it down to 0
+    pipe = redis_connection.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, 'remaining', 1)
+    pipe.hset(key, 'records', 0)
+    pipe.hset(key, 'errors', 0)
+    pipe.hset(key, 'started', time.time())
+    pipe.hset(key, 'queue', queue_name)
+    # The job enqueueing the documents, removed once they are all enqueued
+    enqueuer = get_current_job(connection=redis_connection)
+    pipe.hset(key, 'enqueuer', enqueuer.id if enqueuer is not None else '')
+    pipe.expire(key, RUN_TTL)
+    pipe.delete(jobs_key)
+    pipe.execute()
+
+    jobs = 0
+    try:
+        for batch in iter_batches(documents, batch_size):
+            # Registered before it is enqueued, so the job is always found
+            # by get_lost_jobs until it finishes
+            job_id = unique_id()
+            pipe = redis_connection.pipeline()
+            pipe.hincrby(key, 'remaining', 1)
+            pipe.hset(jobs_key, job_id, len(batch))
+            pipe.expire(jobs_key, RUN_TTL)
+            pipe.execute()
+            queue.enqueue(RECORD_JOB, harvest['_id'], run_id, generation,
+                          [list(document) for document in batch],
+                          timeout=HARVEST_JOB_TIMEOUT, job_id=job_id)
+            jobs += 1
+    except:
+        # The run is abandoned, the jobs already enqueued finish on their own
+        redis_connection.delete(key, jobs_key)
+        raise
+    redis_connection.hdel(key, 'enqueuer')
+    get_logger().info("Enqueued %d record jobs of %s on %s", jobs,
+                      harvest['url'], queue_name)
+    return jobs
+
+
+def finish_record_job(redis_connection, generation, records=0, errors=0,
+                      counters=None, job_id=None):
+    '''
+    Records that a record job of a generation, or the enqueuer, finished.
+    Returns None, or the totals of the run if it was the last job of the
+    generation: a dictionary of the number of records and records with
+    errors, the time the generation started and the sums of the counters of
+    the jobs.
+
+    :param redis_connection: Redis client
+    :param str generation: ID of the generation
+    :param int records: Number of records processed by the job
+    :param int errors: Number of records with errors
+    :param dict counters: Counters of the metrics of the job
+    :param str job_id: ID of the RQ job, None for the enqueuer
+    '''
+    key = get_run_key(generation)
+    pipe = redis_connection.pipeline()
+    if job_id is not None:
+        pipe.hdel(get_jobs_key(generation), job_id)
+    pipe.hincrby(key, 'records', records)
+    pipe.hincrby(key, 'errors', errors)
+    for name, value in (counters or {}).items():
+        pipe.hincrby(key, 'counter:' + name, int(value))
+    pipe.hincrby(key, 'remaining', -1)
+    pipe.expire(key, RUN_TTL)
+    remaining = pipe.execute()[-2]
+    if remaining != 0:
+        # A negative count means the generation expired, was abandoned,
+        # superseded or already finished
+        return None
+
+    totals = {"counters": {}}
+    for name, value in redis_connection.hgetall(key).items():
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if name.startswith('counter:'):
+            totals['counters'][name[len('counter:'):]] = int(value)
+        elif name == 'started':
+            totals['started'] = float(value)
+        elif name in ('records', 'errors'):
+            totals[name] = int(value)
+    redis_connection.delete(key, get_jobs_key(generation))
+    return totals
+
+
+def is_lost(redis_connection, job_id):
+    '''
+    Returns True if a job will never finish: it failed without finishing,
+    i.e. because its worker was killed outright, or it no longer exists
+
+    :param redis_connection: Redis client
+    :param str job_id: ID of the RQ job
+    '''
+    try:
+        job = Job.fetch(job_id, connection=redis_connection)
+    except NoSuchJobError:
+        return True
+    return job.get_status() == JobStatus.FAILED
+
+
+def get_lost_jobs(redis_connection, generation):
+    '''
+    Returns a list of the IDs of the jobs of a generation that will never
+    finish, see is_lost. While the documents are still being enqueued only
+    the job enqueueing them is checked. RQ marks a job whose worker
+    disappeared as failed once the job's timeout has passed.
+
+    :param redis_connection: Redis client
+    :param str generation: ID of the generation
+    '''
+    key = get_run_key(generation)
+    queue_name, enqueuer = [
+        value.decode('utf-8') if isinstance(value, bytes) else value
+        for value in redis_connection.hmget(key, 'queue', 'enqueuer')
+    ]
+    if queue_name is None:
+        return []
+    StartedJobRegistry(queue_name, connection=redis_connection).cleanup()
+    if enqueuer is not None:
+        # The last job registered may not be enqueued yet
+        if enqueuer and is_lost(redis_connection, enqueuer):
+            return [enqueuer]
+        return []
+
+    lost = []
+    for job_id in redis_connection.hkeys(get_jobs_key(generation)):
+        if isinstance(job_id, bytes):
+            job_id = job_id.decode('utf-8')
+        if is_lost(redis_connection, job_id):
+            lost.append(job_id)
+    return lost
+
+
+def recover_record_runs(db, redis_connection):
+    '''
+    Fails the runs of the harvests whose record jobs will never all finish,
+    and returns the number of runs failed. Otherwise such a run would stay in
+    progress until the harvest runs again.
+
+    The records that weren't seen are kept, like for any failed harvest. The
+    checkpoint is kept too, so the next run resumes after the records this
+    run wrote.
+
+    :param db: MongoDB Client
+    :param redis_connection: Redis client
+    '''
+    failed = 0
+    query = {"checkpoint.record_generation": {"$exists": True}}
+    for harvest in db.Harvests.find(query):
+        generation = harvest['checkpoint']['record_generation']
+        lost = get_lost_jobs(redis_connection, generation)
+        if not lost:
+            continue
+        get_logger().warning("%d record jobs of %s never finished",
+                             len(lost), harvest['url'])
+        redis_connection.delete(get_run_key(generation),
+                                get_jobs_key(generation))
+        db.Harvests.update({"_id": harvest['_id']}, {
+            "$set": {
+                "last_harvest_dt": datetime.utcnow(),
+                "last_harvest_status": "fail"
+            }
+        })
+        failed += 1
+    return failed
+
+
+def check_record_runs(db, redis_connection, interval=RECOVERY_INTERVAL):
+    '''
+    Runs recover_record_runs unless it ran in the last interval seconds, in
+    any process. Returns the number of runs failed.
+
+    :param db: MongoDB Client
+    :param redis_connection: Redis client
+    :param int interval: Minimum number of seconds between checks
+    '''
+    if not redis_connection.set(RECOVERY_KEY, 1, nx=True, ex=interval):
+        return 0
+    return recover_record_runs(db, redis_connection)
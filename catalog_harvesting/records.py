@@ -9,18 +9,70 @@ from __future__ import print_function
 from lxml import etree
 from datetime import datetime
 from catalog_harvesting import get_logger
+from catalog_harvesting.session import get_session
+from catalog_harvesting.metrics import HarvestMetrics, get_metrics
+from catalog_harvesting.deletion import delete_locations
+from catalog_harvesting.waf_index import record_locations
 from ckanext.spatial.validation import ISO19139NGDCSchema
 from owslib import iso
+from bson import ObjectId
+from pymongo import InsertOne, DeleteOne, ReplaceOne, UpdateOne
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import AsyncResult
 import hashlib
-import requests
+import inspect
 import os
+import threading
+import time
 
 # ensure ISO/TC211 namespaces are defined
 GLOBAL_NS = {"gmd": "http://www.isotc211.org/2005/gmd",
              "gco": "http://www.isotc211.org/2005/gco"}
 
+# Fields of a record that are derived from the document contents alone
+SUMMARY_FIELDS = ('title', 'description', 'services', 'hash_val',
+                  'metadata_date', 'file_id', 'validation_errors')
 
-def parse_records(db, harvest_obj, link, location):
+# Reuse the results of previous harvests for unchanged documents
+INCREMENTAL = bool(os.environ.get('HARVEST_INCREMENTAL', 'True').lower() == 'true')
+
+# Compiled ISO 19139 schemas that no thread is validating with. An
+# XMLSchema keeps the errors of its last validation, so each thread validates
+# with a schema of its own, see acquire_iso_schema
+ISO_SCHEMAS = []
+ISO_SCHEMA_NAME = 'NGDC Schema (schema.xsd)'
+
+# Number of record writes sent to MongoDB in a single bulk operation
+BULK_SIZE = int(os.environ.get('HARVEST_BULK_SIZE', 500))
+
+# Number of processes validating documents, 1 validates in the harvest process
+VALIDATION_WORKERS = int(os.environ.get('HARVEST_VALIDATION_WORKERS', 0)) or cpu_count()
+
+# Worker processes shared by every ValidationPool, see start_validation_pool
+SHARED_POOL = None
+
+# fsync documents before they are published and their directories in batches
+FSYNC = bool(os.environ.get('HARVEST_FSYNC', 'False').lower() == 'true')
+
+# Directories with published documents that have not been fsynced yet
+PENDING_DIRECTORIES = set()
+PENDING_LOCK = threading.Lock()
+
+
+def is_incremental(harvest_obj):
+    '''
+    Returns True if the harvest may reuse the records of previous harvests for
+    documents that have not changed. A harvest can override the
+    HARVEST_INCREMENTAL setting with its ``incremental`` field.
+
+    :param dict harvest_obj: A dictionary representing a harvest to be run
+    '''
+    return bool(harvest_obj.get('incremental', INCREMENTAL))
+
+
+def parse_records(db, harvest_obj, link, location, cache_info=None,
+                  previous=None):
     '''
     Downloads each XML document from the source and performs XSD Validation on
     the record. Returns a tuple of two integers representing the quantity of
@@ -31,51 +83,81 @@ def parse_records(db, harvest_obj, link, location):
     :param dict harvest_obj: A dictionary representing a harvest to be run
     :param str link: URL to the Record
     :param str location: File path to the XML document on local filesystem.
+    :param dict cache_info: HTTP cache validators to store with the record
+    :param dict previous: The record from the previous harvest of this link
     '''
     with open(location, 'r') as f:
         doc = f.read()
 
+    record_url = get_record_url(location)
+    rec = process_doc(doc, record_url, location, harvest_obj, link, db,
+                      cache_info=cache_info, previous=previous)
+    return rec
+
+
+def get_record_url(location):
+    '''
+    Returns the URL to a document in the Central WAF
+
+    :param str location: File path to the XML document on local filesystem.
+    '''
     parts = location.split('/')
     organization = parts[-2]
     filename = parts[-1]
     waf_url = os.environ.get('WAF_URL_ROOT', 'http://registry.ioos.us/')
-    record_url = os.path.join(waf_url, organization, filename)
-    rec = process_doc(doc, record_url, location, harvest_obj, link, db)
-    return rec
+    return os.path.join(waf_url, organization, filename)
 
 
-def process_doc(doc, record_url, location, harvest_obj, link, db):
+def process_doc(doc, record_url, location, harvest_obj, link, db,
+                cache_info=None, previous=None, result=None, writer=None):
     """
     Processes a document, validating the document and modifying any point
-    geometry, and then inserts a record object into the database.
+    geometry, writes the document to location and then inserts a record
+    object into the database.
 
     :param str doc: A string which is parseable XML representing the record
                     contents
     :param str record_url: A URL to the record in the Central WAF
-    :param str location: File path to the XML document on local filesystem.
+    :param str location: File path to write the XML document to on the local
+                         filesystem.
     :param dict harvest_obj: A dictionary representing a harvest to be run
     :param str link: URL to the original document's URL
     :param db: MongoDB Database Object
+    :param dict cache_info: HTTP cache validators to store with the record
+    :param dict previous: The record from the previous harvest of this link.
+                          If the document is unchanged the summary and
+                          validation results of the record are reused.
+    :param tuple result: The result of process_xml for the document if it
+                         was already processed, i.e. by a ValidationPool
+    :param writer: A RecordWriter or RecordSync that buffers the record to
+                   be written in bulk instead of inserting it immediately
     """
+    metrics = get_metrics(harvest_obj)
     try:
-        rec = validate(doc)
-        rec['record_url'] = record_url
-        # After the validation has been performed, patch the geometry
-        try:
-            patch_geometry(location)
-        except:
-            get_logger().exception("Failed to patch geometry for %s",
-                                   record_url)
-            rec["validation_errors"] = [{
-                "line_number": "?",
-                "error": "Invalid Geometry. See gmd:EX_GeographicBoundingBox"
-            }]
-            rec['record_url'] = None
+        if result is None:
+            timings = {}
+            result = process_xml(doc, previous, timings)
+            metrics.add_timings(timings)
+        summary, body = result
+        if body is None and not os.path.exists(location):
+            # The document is unchanged but missing from the Central WAF
+            summary, body = process_xml(doc)
+        rec = dict(summary)
+        if (body is not None and 'record_url' in rec and
+                rec['record_url'] is None):
+            get_logger().warning("Failed to patch geometry for %s", link)
+        rec.setdefault('record_url', record_url)
         rec['url'] = link
         rec['update_time'] = datetime.now()
         rec['harvest_id'] = harvest_obj['_id']
         rec['location'] = location
-        # hash the xml contents
+        if body is None:
+            # Keep the file from aging out of the Central WAF
+            os.utime(location, None)
+        else:
+            with metrics.timer('write_file'):
+                write_document(location, body)
+            metrics.count('write_bytes', len(body))
     except etree.XMLSyntaxError as e:
         err_msg = "Record for '{}' had malformed XML, skipping".format(link)
         rec = {
@@ -84,6 +166,7 @@ def process_doc(doc, record_url, location, harvest_obj, link, db):
             "services": [],
             "hash_val": None,
             "metadata_data": None,
+            "url": link,
             "harvest_id": harvest_obj['_id'],
             "location": location,
             "validation_errors": [{
@@ -92,15 +175,400 @@ def process_doc(doc, record_url, location, harvest_obj, link, db):
             }]
         }
         get_logger().error(err_msg)
+        write_document(location, doc)
     except:
         get_logger().exception("Failed to create record: %s", record_url)
         raise
+    if cache_info:
+        rec.update(cache_info)
     # upsert the record based on whether the url is already existing
-    insert_result = db.Records.insert(rec)
+    if writer is not None:
+        insert_result = writer.insert(rec)
+    else:
+        insert_result = db.Records.insert(rec)
     rec['_id'] = str(insert_result)
     return rec
 
 
+def process_xml(xml_string, previous=None, timings=None):
+    '''
+    Parses a document once to hash, validate, summarize and patch the geometry
+    of it. Returns a tuple of the summary of the document and the contents to
+    write to the Central WAF. If the document is unchanged from the previous
+    record, the summary of the record is reused and the contents are None.
+
+    :param str xml_string: A string containing an XML ISO-19115-2 Document
+    :param dict previous: The record from the previous harvest of the document
+    :param dict timings: A dictionary the seconds spent parsing, validating
+                         and patching the geometry of the document are
+                         stored in
+    '''
+    if timings is None:
+        timings = {}
+    summary = get_unchanged_summary(xml_string, previous)
+    if summary is not None:
+        return summary, None
+
+    start = time.time()
+    xml_root = etree.fromstring(xml_string)
+    timings['parse'] = time.time() - start
+    start = time.time()
+    summary = validate_tree(xml_root, hashlib.md5(xml_string).hexdigest())
+    timings['validate'] = time.time() - start
+    # After the validation has been performed, patch the geometry
+    start = time.time()
+    try:
+        patched = patch_geometry(xml_root)
+    except:
+        # Logged by process_doc, which knows the URL of the document
+        summary["validation_errors"] = [{
+            "line_number": "?",
+            "error": "Invalid Geometry. See gmd:EX_GeographicBoundingBox"
+        }]
+        summary['record_url'] = None
+        patched = False
+    timings['geometry'] = time.time() - start
+    if patched:
+        return summary, etree.tostring(xml_root)
+    return summary, xml_string
+
+
+# os.rename does not replace existing files on Windows, and os.replace is
+# only available on Python 3
+replace = getattr(os, 'replace', os.rename)
+
+
+def write_document(location, body, fsync=None):
+    '''
+    Writes the contents of a document to location. The contents are written
+    to a hidden temporary file in the same directory that is then renamed to
+    location, so readers of the Central WAF never see a partially written
+    document.
+
+    :param str location: File path to write the XML document to
+    :param str body: Contents of the document
+    :param bool fsync: fsync the document before it is published and queue
+                       its directory for sync_directories, defaults to the
+                       HARVEST_FSYNC setting
+    '''
+    if fsync is None:
+        fsync = FSYNC
+    directory, filename = os.path.split(location)
+    # Not an .xml file, so neither CKAN nor force_clean pick it up
+    tmp_location = os.path.join(directory, '.%s.%d.%d.tmp' % (
+        filename, os.getpid(), threading.current_thread().ident))
+    try:
+        with open(tmp_location, 'wb') as f:
+            f.write(body)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        replace(tmp_location, location)
+    except:
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+        raise
+    if fsync:
+        with PENDING_LOCK:
+            PENDING_DIRECTORIES.add(directory or '.')
+
+
+def sync_directories():
+    '''
+    fsyncs the directories documents were published to by write_document
+    since the last call, so the renames survive a crash
+    '''
+    with PENDING_LOCK:
+        directories = list(PENDING_DIRECTORIES)
+        PENDING_DIRECTORIES.clear()
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class RecordWriter(object):
+    '''
+    Buffers writes to the Records collection and sends them to MongoDB as
+    unordered bulk operations.
+
+    Usage::
+
+        writer = RecordWriter(db)
+        try:
+            for rec in records:
+                writer.insert(rec)
+        finally:
+            writer.flush()
+
+    '''
+
+    def __init__(self, db, size=BULK_SIZE, metrics=None):
+        '''
+        :param db: MongoDB Database Object
+        :param int size: Number of writes buffered before they are flushed
+        :param HarvestMetrics metrics: Collects the time spent writing
+        '''
+        self.db = db
+        self.size = max(1, size)
+        self.metrics = metrics or HarvestMetrics()
+        self.pending = []
+
+    def insert(self, rec):
+        '''
+        Buffers the insertion of a record and returns the _id it is inserted
+        with.
+
+        :param dict rec: The record to insert
+        '''
+        doc = dict(rec)
+        doc.setdefault('_id', ObjectId())
+        self.add(InsertOne(doc))
+        return doc['_id']
+
+    def upsert(self, rec, record_id):
+        '''
+        Buffers the replacement of the record of the same harvest and URL, or
+        its insertion if there is none, and returns the _id of the record.
+
+        :param dict rec: The record to write
+        :param record_id: The _id of the existing record
+        '''
+        doc = dict(rec)
+        doc['_id'] = record_id
+        self.add(ReplaceOne({"_id": record_id,
+                             "harvest_id": doc['harvest_id'],
+                             "url": doc['url']}, doc, upsert=True))
+        return record_id
+
+    def update(self, record_id, fields):
+        '''
+        Buffers setting fields of a record
+
+        :param record_id: The _id of the record to update
+        :param dict fields: The fields to set
+        '''
+        self.add(UpdateOne({"_id": record_id}, {"$set": fields}))
+
+    def remove(self, record_id):
+        '''
+        Buffers the removal of a record
+
+        :param record_id: The _id of the record to remove
+        '''
+        self.add(DeleteOne({"_id": record_id}))
+
+    def add(self, request):
+        '''
+        Buffers a bulk write request, flushing the buffer once it is full
+        '''
+        self.pending.append(request)
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Sends the buffered writes to MongoDB, once the directories of the
+        documents the records point to have been synced
+        '''
+        sync_directories()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        with self.metrics.timer('mongo_write'):
+            self.db.Records.bulk_write(pending, ordered=False)
+        self.metrics.count('mongo_writes', len(pending))
+
+
+class RecordSync(object):
+    '''
+    Synchronizes the records of a harvest with the documents found in a run of
+    the harvest.
+
+    For incremental harvests the existing records are kept while the harvest
+    runs. Each record is upserted on the harvest and the URL of the document,
+    and the records of documents that weren't seen are removed by finish.
+    Otherwise every record of the harvest is removed up front.
+
+    If the harvest has a ``checkpoint``, every record written or kept is
+    marked with the ``run_id`` of the checkpoint. When an interrupted run is
+    resumed with the same checkpoint, the documents whose records are marked
+    are done and are neither removed nor processed again.
+
+    The locations of the documents seen are recorded in the WafFiles index
+    whenever the writes are flushed, see catalog_harvesting.waf_index.
+
+    A record job synchronizes only the records of its own documents, given by
+    links, and never removes records; the records that weren't seen in the
+    run are removed once every record job of the run has finished.
+
+    Usage::
+
+        sync = RecordSync(db, harvest)
+        try:
+            for link, doc in documents:
+                if sync.is_done(link):
+                    continue
+                process_doc(doc, ..., previous=sync.get_previous(link),
+                            writer=sync)
+        finally:
+            sync.flush()
+        sync.finish()
+        purge_old_records(sync.new_locations, sync.old_locations)
+
+    '''
+
+    def __init__(self, db, harvest_obj, writer=None, links=None):
+        '''
+        :param db: MongoDB Database Object
+        :param dict harvest_obj: A dictionary representing a harvest to be run
+        :param RecordWriter writer: Buffers the writes to the Records
+                                    collection
+        :param list links: URLs of the documents of a record job
+        '''
+        self.db = db
+        self.harvest_obj = harvest_obj
+        self.writer = writer or RecordWriter(db,
+                                             metrics=get_metrics(harvest_obj))
+        self.run_id = (harvest_obj.get('checkpoint') or {}).get('run_id')
+        self.previous = {}
+        self.stale = {}
+        self.done = set()
+        self.done_count = 0
+        self.done_errors = 0
+        self.new_locations = set()
+        self.old_locations = set()
+        # Locations seen that have not been recorded in the index yet
+        self.unindexed = set()
+
+        query = {"harvest_id": harvest_obj['_id']}
+        if links is not None:
+            query['url'] = {"$in": list(links)}
+        for rec in db.Records.find(query):
+            if rec.get('location'):
+                self.old_locations.add(rec['location'])
+            if self.run_id is not None and \
+                    rec.get('harvest_run') == self.run_id:
+                # Processed by the interrupted run being resumed
+                self.mark_done(rec)
+                continue
+            self.stale[rec['_id']] = rec
+            if rec.get('url'):
+                self.previous[rec['url']] = rec
+
+        if links is None and not is_incremental(harvest_obj):
+            query = {"harvest_id": harvest_obj['_id']}
+            if self.run_id is not None:
+                query['harvest_run'] = {"$ne": self.run_id}
+            db.Records.remove(query)
+            self.previous = {}
+            self.stale = {}
+
+    def mark_done(self, rec):
+        '''
+        Records that the document of a record was processed by the run of the
+        harvest being resumed
+
+        :param dict rec: A record of the run being resumed
+        '''
+        if rec.get('url'):
+            self.done.add(rec['url'])
+        if rec.get('location'):
+            self.new_locations.add(rec['location'])
+            self.unindexed.add(rec['location'])
+        self.done_count += 1
+        if rec.get('validation_errors'):
+            self.done_errors += 1
+
+    def is_done(self, link):
+        '''
+        Returns True if the document was processed by the run of the harvest
+        being resumed
+
+        :param str link: URL to the original document
+        '''
+        return link in self.done
+
+    def get_previous(self, link):
+        '''
+        Returns the record of the document from a previous harvest or None
+
+        :param str link: URL to the original document
+        '''
+        return self.previous.get(link)
+
+    def keep(self, link):
+        '''
+        Keeps the record of an unchanged document as is and returns it, or
+        returns None if there is no record to keep.
+
+        :param str link: URL to the original document
+        '''
+        rec = self.previous.pop(link, None)
+        if rec is None:
+            return None
+        self.stale.pop(rec['_id'], None)
+        if rec.get('location'):
+            self.new_locations.add(rec['location'])
+            self.unindexed.add(rec['location'])
+        if self.run_id is not None:
+            self.writer.update(rec['_id'], {"harvest_run": self.run_id})
+        return rec
+
+    def insert(self, rec):
+        '''
+        Writes a record, replacing the previous record of the same document,
+        and returns its _id.
+
+        :param dict rec: The record to write
+        '''
+        if self.run_id is not None:
+            rec['harvest_run'] = self.run_id
+        prev = self.previous.pop(rec['url'], None)
+        self.new_locations.add(rec['location'])
+        self.unindexed.add(rec['location'])
+        if prev is None:
+            return self.writer.insert(rec)
+        self.stale.pop(prev['_id'], None)
+        return self.writer.upsert(rec, prev['_id'])
+
+    def flush(self):
+        '''
+        Flushes the buffered writes, so the progress of the run is kept if the
+        harvest is interrupted
+        '''
+        self.writer.flush()
+        if self.unindexed:
+            locations, self.unindexed = self.unindexed, set()
+            record_locations(self.db, locations)
+
+    def finish(self):
+        '''
+        Flushes the buffered writes and removes the records of documents that
+        weren't seen in this run of the harvest. Only call this once every
+        document of the harvest has been processed.
+        '''
+        self.flush()
+        if self.stale:
+            self.db.Records.remove({"_id": {"$in": list(self.stale)}})
+            self.stale = {}
+
+
+def purge_old_records(new_records, old_records, metrics=None):
+    '''
+    Deletes any records in old_records that aren't in new_records
+
+    :param set new_records: Set of record locations
+    :param set old_records: Set of record locations
+    :param HarvestMetrics metrics: Counts the files removed
+    '''
+    get_logger().info("Purging old records from WAF")
+    removed = delete_locations(old_records - new_records, metrics=metrics)
+    get_logger().info("Removed %d old records", removed)
+
+
 def iso_get(iso_endpoint):
     '''
     Takes a URL referencing an ISO19115 XML file and returns a dictionary
@@ -111,7 +579,7 @@ def iso_get(iso_endpoint):
     :rtype: dict
     '''
 
-    resp = requests.get(iso_endpoint, timeout=10)
+    resp = get_session().get(iso_endpoint, timeout=10)
     if resp.status_code != 200:
         raise IOError("Failed to retrieve document: HTTP %s" % resp.status_code)
     validation = validate(resp.content)
@@ -119,15 +587,44 @@ def iso_get(iso_endpoint):
     return validation
 
 
+def get_unchanged_summary(xml_string, previous):
+    '''
+    Returns the summary of a previously harvested record if xml_string is
+    identical to the document it was created from, otherwise None.
+
+    :param str xml_string: A string containing an XML ISO-19115-2 Document
+    :param dict previous: The record from the previous harvest of the document
+    '''
+    if not previous or not previous.get('hash_val'):
+        return None
+    if hashlib.md5(xml_string).hexdigest() != previous['hash_val']:
+        return None
+    summary = dict((field, previous.get(field)) for field in SUMMARY_FIELDS)
+    # process_xml stores a null record_url for documents whose geometry could
+    # not be patched, which must be kept. Otherwise process_doc sets the URL.
+    if 'record_url' in previous and previous['record_url'] is None:
+        summary['record_url'] = None
+    return summary
+
+
 def validate(xml_string):
     '''
     Returns a dictionary containing a summary of the document including validation errors
 
     :param str xml_string: A string containing an XML ISO-19115-2 Document
     '''
+    return validate_tree(etree.fromstring(xml_string),
+                         hashlib.md5(xml_string).hexdigest())
+
+
+def validate_tree(iso_obj, hash_val):
+    '''
+    Returns a dictionary containing a summary of a parsed document including
+    validation errors
 
-    hash_val = hashlib.md5(xml_string).hexdigest()
-    iso_obj = etree.fromstring(xml_string)
+    :param iso_obj: The root element of the XML document
+    :param str hash_val: MD5 hash of the document contents
+    '''
     nsmap = iso_obj.nsmap
     nsmap.update(GLOBAL_NS)
     if None in nsmap:
@@ -157,7 +654,7 @@ def validate(xml_string):
 
     validation_errors = [{'error': e,
                           'line_number': l} for e, l
-                         in ISO19139NGDCSchema.is_valid(iso_obj)[-1]]
+                         in validate_schema(iso_obj)]
 
     return {"title": di.title,
             "description": di.abstract,
@@ -168,17 +665,77 @@ def validate(xml_string):
             "validation_errors": validation_errors}
 
 
-def patch_geometry(location):
+def compile_iso_schema():
+    '''
+    Returns a newly compiled ISO 19139 (NGDC) XSD schema used by
+    ckanext-spatial
+    '''
+    xsd_filepath = os.path.join(
+        os.path.dirname(inspect.getfile(ISO19139NGDCSchema)),
+        'xml', 'iso19139ngdc', 'schema.xsd')
+    get_logger().info("Compiling %s", xsd_filepath)
+    return etree.XMLSchema(etree.parse(xsd_filepath))
+
+
+def load_iso_schema():
+    '''
+    Compiles the ISO 19139 schema unless a compiled schema is available. Call
+    this before forking so child processes reuse it.
+    '''
+    if not ISO_SCHEMAS:
+        ISO_SCHEMAS.append(compile_iso_schema())
+
+
+def acquire_iso_schema():
+    '''
+    Returns a compiled ISO 19139 schema that no other thread is validating
+    with. A schema is only compiled when every compiled schema is in use, so
+    a process compiles one per thread validating at the same time. Give the
+    schema back with release_iso_schema.
+    '''
+    try:
+        return ISO_SCHEMAS.pop()
+    except IndexError:
+        return compile_iso_schema()
+
+
+def release_iso_schema(schema):
+    '''
+    Makes a schema returned by acquire_iso_schema available to other threads
+
+    :param schema: The compiled schema
+    '''
+    ISO_SCHEMAS.append(schema)
+
+
+def validate_schema(iso_obj):
+    '''
+    Returns a list of tuples of the error message and line number for each
+    error found validating the document against the ISO 19139 schema. The
+    errors match those reported by ckanext-spatial's ISO19139NGDCSchema.
+
+    :param iso_obj: The root element of the XML document
+    '''
+    schema = acquire_iso_schema()
+    try:
+        if schema.validate(iso_obj):
+            return []
+        errors = [(error.message, error.line) for error in schema.error_log]
+    finally:
+        release_iso_schema(schema)
+    errors.insert(0, ('{0} Validation Error'.format(ISO_SCHEMA_NAME), None))
+    return errors
+
+
+def patch_geometry(xml_root):
     '''
     This function attempts to make a patch to documents that define Extents as
     a point. By offseting the bounds very slightly the geometry can be properly
-    indexed into catalogs as a bounding box of a very small size.
+    indexed into catalogs as a bounding box of a very small size. Returns True
+    if the document was patched.
 
-    :param str location: Location of the document to update
+    :param xml_root: The root element of the document to update
     '''
-    with open(location, 'r') as f:
-        buf = f.read()
-    xml_root = etree.fromstring(buf)
     nsmap = xml_root.nsmap
     if None in nsmap:
         del nsmap[None]
@@ -186,7 +743,7 @@ def patch_geometry(location):
 
     bbox = (xml_root.xpath("./gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/gmd:EX_Extent/gmd:geographicElement/gmd:EX_GeographicBoundingBox", namespaces=nsmap) or [None])[0]
     if bbox is None:
-        return
+        return False
 
     ll_lon = bbox.xpath('./gmd:westBoundLongitude/gco:Decimal', namespaces=nsmap)[0]
     ll_lat = bbox.xpath('./gmd:southBoundLatitude/gco:Decimal', namespaces=nsmap)[0]
@@ -211,8 +768,136 @@ def patch_geometry(location):
         ur_lat.text = str(float(ur_lat.text) + epsilon)
         should_patch = True
 
-    if should_patch:
-        # Only once we make sure it's a point can we update the file
-        buf = etree.tostring(xml_root)
-        with open(location, 'wb') as f:
-            f.write(buf)
+    # Only once we make sure it's a point is the document updated
+    return should_patch
+
+
+def process_task(xml_string):
+    '''
+    Processes a document in a ValidationPool worker. Returns a tuple of the
+    result of process_xml, or None if the document could not be processed in
+    which case the harvest process processes it again to handle the error,
+    and the timings of process_xml.
+
+    :param str xml_string: A string containing an XML ISO-19115-2 Document
+    '''
+    timings = {}
+    try:
+        return process_xml(xml_string, timings=timings), timings
+    except Exception:
+        return None, timings
+
+
+def start_validation_pool(workers=VALIDATION_WORKERS):
+    '''
+    Starts the worker processes shared by every ValidationPool of this
+    process, so harvests running on several threads do not each fork their
+    own. Call this before any harvest threads are started.
+
+    :param int workers: Number of worker processes
+    '''
+    global SHARED_POOL
+    if SHARED_POOL is None and workers > 1:
+        # compile the schema before forking so every worker shares it
+        load_iso_schema()
+        SHARED_POOL = Pool(workers)
+    return SHARED_POOL
+
+
+def stop_validation_pool():
+    '''
+    Stops the worker processes started by start_validation_pool
+    '''
+    global SHARED_POOL
+    if SHARED_POOL is not None:
+        SHARED_POOL.terminate()
+        SHARED_POOL.join()
+        SHARED_POOL = None
+
+
+class ValidationPool(object):
+    '''
+    Validates documents in a pool of worker processes while the caller keeps
+    producing documents, and streams the results back to the caller in the
+    order the documents were given.
+
+    Usage::
+
+        pool = ValidationPool(workers=4)
+        for item, doc, result in pool.imap(tasks):
+            process_doc(doc, ..., result=result)
+
+    '''
+
+    def __init__(self, workers=VALIDATION_WORKERS, metrics=None):
+        '''
+        :param int workers: Number of worker processes, with 1 or less the
+                            documents are left for process_doc to validate
+        :param HarvestMetrics metrics: Collects the timings of the workers and
+                                       the time spent waiting on them
+        '''
+        self.workers = workers
+        self.metrics = metrics or HarvestMetrics()
+        # Maximum number of documents held in memory by the pool
+        self.window = 2 * max(1, workers)
+
+    def imap(self, tasks):
+        '''
+        Returns a generator of (item, doc, result) tuples, where result is the
+        result of process_xml for the document or None if the document was not
+        processed by the pool.
+
+        :param tasks: An iterable of (item, doc, previous) tuples, where item
+                      is passed through, doc is the document or None if there
+                      is nothing to validate and previous is the record from
+                      the previous harvest of the document
+        '''
+        if self.workers <= 1:
+            for item, doc, previous in tasks:
+                yield item, doc, None
+            return
+
+        pool = SHARED_POOL
+        if pool is None:
+            # compile the schema before forking so every worker shares it
+            load_iso_schema()
+            pool = Pool(self.workers)
+        pending = deque()
+        try:
+            for item, doc, previous in tasks:
+                result = None
+                if doc is not None:
+                    summary = get_unchanged_summary(doc, previous)
+                    if summary is None:
+                        result = pool.apply_async(process_task, (doc,))
+                    else:
+                        result = (summary, None)
+                pending.append((item, doc, result))
+
+                while pending and (len(pending) >= self.window or
+                                   self.ready(pending[0][2])):
+                    yield self.finish(*pending.popleft())
+
+            while pending:
+                yield self.finish(*pending.popleft())
+        finally:
+            if pool is not SHARED_POOL:
+                pool.terminate()
+                pool.join()
+
+    def ready(self, result):
+        '''
+        Returns True if the result of a task is available
+        '''
+        return not isinstance(result, AsyncResult) or result.ready()
+
+    def finish(self, item, doc, result):
+        '''
+        Returns the (item, doc, result) tuple of a task, waiting for the
+        result of the pool if necessary.
+        '''
+        if isinstance(result, AsyncResult):
+            with self.metrics.timer('validation_wait'):
+                result, timings = result.get()
+            self.metrics.add_timings(timings)
+        return item, doc, result
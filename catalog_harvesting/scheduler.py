@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/scheduler.py
+
+Runs several harvests at the same time while limiting the number of harvests
+of any one remote host
+'''
+from catalog_harvesting import get_logger
+from six.moves.urllib.parse import urlparse
+import os
+import threading
+
+
+# Maximum number of harvests run at once
+HARVEST_CONCURRENCY = int(os.environ.get('HARVEST_CONCURRENCY', 4))
+# Maximum number of harvests of the same remote host run at once
+HARVEST_HOST_LIMIT = int(os.environ.get('HARVEST_HOST_LIMIT', 1))
+
+
+def get_harvest_host(harvest):
+    '''
+    Returns the remote host a harvest downloads from
+
+    :param dict harvest: A dictionary returned from the mongo collection for
+                         harvests.
+    '''
+    return urlparse(harvest.get('url') or '').netloc.lower()
+
+
+def get_harvest_order(harvests):
+    '''
+    Returns the harvests sorted so that the harvests that took the longest
+    last time, or had the most records if the duration is unknown, come first
+
+    :param list harvests: A list of harvest dictionaries
+    '''
+    def cost(harvest):
+        return (harvest.get('last_harvest_duration') or 0,
+                harvest.get('last_record_count') or 0)
+    return sorted(harvests, key=cost, reverse=True)
+
+
+class HarvestScheduler(object):
+    '''
+    Runs harvests on a bounded number of threads. A harvest is only started
+    while fewer than ``per_host`` harvests of the same remote host are
+    running, otherwise the next harvest in line that is allowed to run is
+    started instead.
+
+    Usage::
+
+        scheduler = HarvestScheduler(lambda harvest: run(harvest))
+        scheduler.run(harvests)
+
+    '''
+
+    def __init__(self, func, workers=HARVEST_CONCURRENCY,
+                 per_host=HARVEST_HOST_LIMIT):
+        '''
+        :param func: A callable accepting a harvest that runs the harvest
+        :param int workers: Maximum number of harvests run at once
+        :param int per_host: Maximum number of harvests of the same remote
+                             host run at once
+        '''
+        self.func = func
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self._cond = threading.Condition()
+        self._hosts = {}
+        self._active = 0
+
+    def next_harvest(self, pending):
+        '''
+        Returns the first pending harvest that may be started now, or None
+
+        :param list pending: Harvests waiting to run, in priority order
+        '''
+        if self._active >= self.workers:
+            return None
+        for harvest in pending:
+            if self._hosts.get(get_harvest_host(harvest), 0) < self.per_host:
+                return harvest
+        return None
+
+    def run(self, harvests):
+        '''
+        Runs every harvest, longest first, and returns once all of them have
+        finished.
+
+        :param list harvests: A list of harvest dictionaries
+        '''
+        pending = get_harvest_order(harvests)
+        threads = []
+        with self._cond:
+            while pending:
+                harvest = self.next_harvest(pending)
+                if harvest is None:
+                    # wait with a timeout so KeyboardInterrupt is delivered
+                    self._cond.wait(1)
+                    continue
+                pending.remove(harvest)
+                host = get_harvest_host(harvest)
+                self._hosts[host] = self._hosts.get(host, 0) + 1
+                self._active += 1
+                thread = threading.Thread(target=self.work,
+                                          args=(harvest, host))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def work(self, harvest, host):
+        '''
+        Runs a harvest and frees its slot when it finishes
+
+        :param dict harvest: A harvest dictionary
+        :param str host: The remote host of the harvest
+        '''
+        try:
+            self.func(harvest)
+        except Exception:
+            get_logger().exception("Failed to harvest")
+            get_logger().error(harvest)
+        finally:
+            with self._cond:
+                self._hosts[host] -= 1
+                self._active -= 1
+                self._cond.notify_all()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/session.py
+
+A shared HTTP session that keeps connections to remote hosts alive between
+requests
+'''
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import os
+import requests
+import threading
+
+
+# Maximum number of connections kept open to any one remote host
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+# Maximum number of remote hosts whose connections are kept open
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+# Number of times a failed request is retried
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+# Retries back off for backoff_factor * 2 ** (retry - 1) seconds
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+
+SESSION = None
+SESSION_PID = None
+_lock = threading.Lock()
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, pool_hosts=HTTP_POOL_HOSTS,
+                   max_retries=HTTP_MAX_RETRIES,
+                   backoff_factor=HTTP_BACKOFF_FACTOR):
+    '''
+    Returns a new requests Session that pools connections per host and
+    retries requests that fail to connect or that the server could not
+    answer. Only idempotent requests are retried.
+
+    :param int pool_size: Maximum number of connections kept open per host
+    :param int pool_hosts: Maximum number of hosts whose connections are kept
+                           open
+    :param int max_retries: Number of times a failed request is retried
+    :param float backoff_factor: Backoff factor between retries in seconds
+    '''
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_hosts,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    '''
+    Returns the HTTP session shared by every request made by this process.
+    Forked processes get a session of their own so that sockets are never
+    shared with the parent.
+    '''
+    global SESSION, SESSION_PID
+    with _lock:
+        if SESSION is None or SESSION_PID != os.getpid():
+            SESSION = create_session()
+            SESSION_PID = os.getpid()
+        return SESSION
@@ -4,6 +4,7 @@ catalog_harvesting/util.py
 
 General utilities for the project
 '''
+from pymongo import MongoClient
 import random
 
 
@@ -15,3 +16,16 @@ def unique_id():
     return ''.join([random.choice(charmap) for i in range(17)])
 
 
+def get_database(conn_string):
+    '''
+    Returns the MongoDB database for a connection string. The database name is
+    taken from the path of the connection string, or "default" if it has none.
+
+    :param str conn_string: MongoDB connection string
+    '''
+    tokens = conn_string.split('/')
+    if len(tokens) > 3:
+        db_name = tokens[3]
+    else:
+        db_name = 'default'
+    return MongoClient(conn_string)[db_name]
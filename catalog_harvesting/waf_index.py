@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+'''
+catalog_harvesting/waf_index.py
+
+An index of when each document in the Central WAF was last seen by a
+harvest, so stale documents can be found without scanning the filesystem
+'''
+from catalog_harvesting import get_logger
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+import os
+import re
+
+
+# Number of documents written to or removed from the index at a time
+INDEX_BATCH_SIZE = 1000
+# Number of days between walks of a folder that index the documents no
+# harvest has recorded
+RECONCILE_DAYS = int(os.environ.get('HARVEST_INDEX_RECONCILE_DAYS', 7))
+
+
+def record_locations(db, locations, seen=None, batch_size=INDEX_BATCH_SIZE):
+    '''
+    Records that the documents at locations were seen by a harvest
+
+    :param db: MongoDB Database Object
+    :param locations: An iterable of file paths in the Central WAF
+    :param datetime seen: When the documents were seen, defaults to now
+    :param int batch_size: Number of documents written at a time
+    '''
+    seen = seen or datetime.utcnow()
+    requests = []
+    for location in locations:
+        requests.append(UpdateOne({"_id": os.path.abspath(location)},
+                                  {"$set": {"last_seen": seen}},
+                                  upsert=True))
+        if len(requests) >= batch_size:
+            db.WafFiles.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        db.WafFiles.bulk_write(requests, ordered=False)
+
+
+def reconcile_index(db, path, batch_size=INDEX_BATCH_SIZE):
+    '''
+    Adds every document under path that isn't in the index, with its
+    modification time as the time it was last seen. These are documents
+    written before the index existed or by harvests that no longer run, so
+    they still expire. Documents already in the index are left as they are.
+
+    :param db: MongoDB Database Object
+    :param str path: Path to a folder of the Central WAF
+    :param int batch_size: Number of documents written at a time
+    '''
+    get_logger().info("Indexing the documents in %s", path)
+    started = datetime.utcnow()
+    requests = []
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            if not filename.endswith('.xml'):
+                continue
+            filepath = os.path.abspath(os.path.join(root, filename))
+            seen = datetime.utcfromtimestamp(os.stat(filepath).st_mtime)
+            requests.append(UpdateOne({"_id": filepath},
+                                      {"$setOnInsert": {"last_seen": seen}},
+                                      upsert=True))
+            if len(requests) >= batch_size:
+                db.WafFiles.bulk_write(requests, ordered=False)
+                requests = []
+    if requests:
+        db.WafFiles.bulk_write(requests, ordered=False)
+    db.WafReconciles.replace_one({"_id": os.path.abspath(path)},
+                                 {"reconciled": started}, upsert=True)
+
+
+def needs_reconcile(db, path, reconcile_days=RECONCILE_DAYS):
+    '''
+    Returns True if path hasn't been walked by reconcile_index in the last
+    reconcile_days days
+
+    :param db: MongoDB Database Object
+    :param str path: Path to a folder of the Central WAF
+    :param int reconcile_days: Number of days between walks of the folder
+    '''
+    entry = db.WafReconciles.find_one({"_id": os.path.abspath(path)})
+    if entry is None:
+        return True
+    cutoff = datetime.utcnow() - timedelta(days=reconcile_days)
+    return entry['reconciled'] < cutoff
+
+
+def get_path_query(path):
+    '''
+    Returns the query matching the documents under path
+
+    :param str path: Path to a folder of the Central WAF
+    '''
+    prefix = os.path.join(os.path.abspath(path), '')
+    return {"_id": {"$regex": '^' + re.escape(prefix)}}
+
+
+def clean_expired(db, path, max_days=3, batch_size=INDEX_BATCH_SIZE,
+                  reconcile_days=RECONCILE_DAYS):
+    '''
+    Deletes the documents under path that no harvest has seen in more than
+    max_days days, and returns the number of documents removed. Documents
+    modified since are kept. Every reconcile_days days, and on the first
+    cleaning of path, the folder is walked first to index the documents no
+    harvest has recorded.
+
+    :param db: MongoDB Database Object
+    :param str path: Path to a folder of the Central WAF
+    :param int max_days: Maximum number of days to keep an old record before
+                         removing it.
+    :param int batch_size: Number of index entries removed at a time
+    :param int reconcile_days: Number of days between walks of the folder
+    '''
+    if needs_reconcile(db, path, reconcile_days):
+        reconcile_index(db, path, batch_size)
+
+    query = get_path_query(path)
+    cutoff = datetime.utcnow() - timedelta(days=max_days)
+    query['last_seen'] = {"$lt": cutoff}
+    expired = db.WafFiles.find(query, {"_id": True}).batch_size(batch_size)
+
+    removed = 0
+    batch = []
+    for entry in expired:
+        filepath = entry['_id']
+        batch.append(filepath)
+        try:
+            mtime = datetime.utcfromtimestamp(os.stat(filepath).st_mtime)
+        except OSError:
+            # Already removed, i.e. by purge_old_records
+            mtime = None
+        if mtime is not None and mtime < cutoff:
+            get_logger().info("Removing %s", filepath)
+            os.remove(filepath)
+            removed += 1
+        elif mtime is not None:
+            # Written by something that doesn't update the index
+            batch.pop()
+            db.WafFiles.update_one({"_id": filepath},
+                                   {"$set": {"last_seen": mtime}})
+        if len(batch) >= batch_size:
+            db.WafFiles.delete_many({"_id": {"$in": batch}})
+            batch = []
+    if batch:
+        db.WafFiles.delete_many({"_id": {"$in": batch}})
+    return removed
@@ -2,9 +2,16 @@
 '''
 catalog_harvesting/waf_parser.py
 '''
-import requests
-from bs4 import BeautifulSoup
+import os
+from multiprocessing.pool import ThreadPool
 from six.moves.urllib.parse import urljoin
+from catalog_harvesting.session import get_session
+from catalog_harvesting.anchors import get_anchors
+from catalog_harvesting.metrics import HarvestMetrics
+
+
+# Maximum number of directory listings fetched at once while crawling a WAF
+CRAWL_WORKERS = int(os.environ.get('HARVEST_CRAWL_WORKERS', 4))
 
 
 class WAFParser(object):
@@ -15,20 +22,29 @@ class WAFParser(object):
 
         # To iterate over all entries in a WAF
         parser = WAFParser('url-to-waf')
-        for document in parser.parse()
+        for document in parser.iter_documents():
             do_something_with_xml(document)
 
     '''
 
-    def __init__(self, url=''):
+    def __init__(self, url='', workers=CRAWL_WORKERS, metrics=None):
+        '''
+        :param str url: URL to the WAF
+        :param int workers: Maximum number of directory listings fetched
+                            concurrently
+        :param HarvestMetrics metrics: Collects the time spent crawling
+        '''
         self.url = url
+        self.workers = max(1, workers)
+        self.metrics = metrics or HarvestMetrics()
+        # Directory listings share the pooled connections of the harvest
+        self.session = get_session()
 
     def get_links(self, content):
         '''
         Returns a list of tuples: href, text for each anchor in the document
         '''
-        soup = BeautifulSoup(content, 'html.parser')
-        return [(a.get('href'), a.text) for a in soup.find_all('a')]
+        return get_anchors(content)
 
     def parse(self, maxdepth=2):
         '''
@@ -37,29 +53,78 @@ class WAFParser(object):
         :param int maxdepth: Max number of directory links to follow in the
                              search
         '''
-        documents = []
-        self._parse(self.url, documents, 0, maxdepth)
-        return documents
+        return list(self.iter_documents(maxdepth))
 
-    def _parse(self, url, documents, depth, maxdepth):
+    def iter_documents(self, maxdepth=2):
         '''
-        Depth-first search of document
+        Returns a generator of the XML documents in the web directory. Each
+        document is yielded as soon as its directory listing has been read and
+        documents linked more than once are only yielded the first time.
 
-        :param str url: URL to read document from
-        :param list documents: Reference to list of documents to append
-                               dicsovered documents to
+        :param int maxdepth: Max number of directory links to follow in the
+                             search
+        '''
+        seen = set()
+        pool = ThreadPool(self.workers)
+        try:
+            listing = pool.apply_async(self.get_directory, (self.url,))
+            visited = set([self.url])
+            for link in self._parse(pool, listing, visited, 0, maxdepth):
+                if link in seen:
+                    continue
+                seen.add(link)
+                yield link
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _parse(self, pool, listing, visited, depth, maxdepth):
+        '''
+        Depth-first search of document. The listings of all subdirectories
+        are requested concurrently before they are searched in order.
+
+        :param pool: Thread pool fetching the directory listings
+        :param listing: The pending result of get_directory for the directory
+        :param set visited: Directories that have already been requested
         :param int depth: Current depth
         :param int maxdepth: Max Depth
         '''
-        if depth > maxdepth:
-            return
+        links, follow = listing.get()
+        for link in links:
+            yield link
 
-        response = requests.get(url)
-        if response.status_code != 200:
+        if depth + 1 > maxdepth:
             return
 
-        links = self.get_links(response.content)
+        listings = []
+        for link in follow:
+            if link in visited:
+                continue
+            visited.add(link)
+            listings.append(pool.apply_async(self.get_directory, (link,)))
+        for listing in listings:
+            for link in self._parse(pool, listing, visited, depth + 1,
+                                    maxdepth):
+                yield link
+
+    def get_directory(self, url):
+        '''
+        Returns a tuple of the list of documents and the list of directories
+        linked from a directory listing
+
+        :param str url: URL to read document from
+        '''
+        documents = []
         follow = []
+
+        with self.metrics.timer('crawl'):
+            response = self.session.get(url)
+        if response.status_code != 200:
+            return documents, follow
+        self.metrics.count('crawl_bytes', len(response.content))
+
+        with self.metrics.timer('crawl_parse'):
+            links = self.get_links(response.content)
         for link, text in links:
             # Some links might not have href. Skip them.
             if link is None:
@@ -83,6 +148,4 @@ class WAFParser(object):
             if link.endswith('/'):
                 follow.append(link)
 
-        for link in follow:
-
-            self._parse(link, documents, depth + 1, maxdepth)
+        return documents, follow
@@ -3,14 +3,21 @@ import sys
 from rq import Connection, Worker
 from catalog_harvesting.cli import setup_logging
 from catalog_harvesting.api import redis_connection
+from catalog_harvesting.fanout import HARVEST_QUEUE
+from catalog_harvesting.record_queue import RECORD_QUEUE
+from catalog_harvesting.records import load_iso_schema
 
 
 def main():
 
     setup_logging()
+    # Compile the schema once so every job forked by the worker reuses it
+    load_iso_schema()
 
     with Connection(redis_connection):
-        qs = sys.argv[1:] or ['default']
+        # Jobs of the default queue are taken first, and the record jobs of
+        # running harvests before the next queued harvest is started
+        qs = sys.argv[1:] or ['default', RECORD_QUEUE, HARVEST_QUEUE]
 
         w = Worker(qs)
         w.work()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+tests/test_anchors.py
+'''
+
+from catalog_harvesting.anchors import get_anchors, get_erddap_anchors
+from unittest import TestCase
+
+
+ERDDAP_PRE = b'''<html><body>
+<p>Links in the page header <a href="help.xml">help.xml</a></p>
+<pre>
+<a href="?C=N;O=D">Name</a>
+<a href="one_iso19115.xml">one_iso19115.xml</a>  01-Jan-2018 00:00  24K
+<a href="two_iso19115.xml">two_iso19115.xml</a>  01-Jan-2018 00:00  24K
+</pre>
+<p>ERDDAP, Version 1.80</p>
+</body></html>'''
+
+ERDDAP_TABLE = b'''<html><body>
+<table><tr><td><a href="header.xml">header.xml</a></td></tr></table>
+<div class="standard_width">
+<p>ERDDAP, Version 1.82</p>
+<table class="compact nowrap">
+<tr><th><a href="?C=N;O=D">Name</a></th></tr>
+<tr><td><a href="one_iso19115.xml">one_iso19115.xml</a></td></tr>
+<tr><td><a href="two_iso19115.xml">two_iso19115.xml</a></td></tr>
+</table>
+</div>
+</body></html>'''
+
+
+class TestAnchors(TestCase):
+
+    def test_get_anchors(self):
+        content = (b'<html><body><table>'
+                   b'<tr><td><a href="/">Parent Directory</a></td></tr>'
+                   b'<tr><td><a href="a/"><b>a</b>/</a></td></tr>'
+                   b'<tr><td><a>no href</a> <a href="x.xml">x.xml</a></td></tr>'
+                   b'</table></body></html>')
+        assert get_anchors(content) == [
+            ('/', 'Parent Directory'),
+            ('a/', 'a/'),
+            (None, 'no href'),
+            ('x.xml', 'x.xml')
+        ]
+        assert get_anchors(b'') == []
+
+    def test_erddap_pre(self):
+        assert get_erddap_anchors(ERDDAP_PRE) == [
+            ('one_iso19115.xml', 'one_iso19115.xml'),
+            ('two_iso19115.xml', 'two_iso19115.xml')
+        ]
+
+    def test_erddap_table(self):
+        assert get_erddap_anchors(ERDDAP_TABLE) == [
+            ('one_iso19115.xml', 'one_iso19115.xml'),
+            ('two_iso19115.xml', 'two_iso19115.xml')
+        ]
+
+    def test_large_listing(self):
+        rows = ''.join('<tr><td><a href="d{0}.xml">d{0}.xml</a></td></tr>'.format(i)
+                       for i in range(5000))
+        content = '<html><body><table>' + rows + '</table></body></html>'
+        anchors = get_anchors(content.encode('ascii'))
+        assert len(anchors) == 5000
+        assert anchors[-1] == ('d4999.xml', 'd4999.xml')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+tests/test_checkpoint.py
+'''
+
+from catalog_harvesting.checkpoint import start_checkpoint, save_checkpoint
+from datetime import datetime, timedelta
+from unittest import TestCase
+import mongomock
+
+
+class TestCheckpoint(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.Harvests.insert_one({'_id': 'h', 'url': 'http://waf/'})
+
+    def get_harvest(self):
+        return self.db.Harvests.find_one({'_id': 'h'})
+
+    def test_resume(self):
+        harvest = self.get_harvest()
+        checkpoint = start_checkpoint(self.db, harvest)
+        save_checkpoint(self.db, harvest, csw_position=41)
+
+        # the run is interrupted and the harvest is started again
+        harvest = self.get_harvest()
+        assert harvest['checkpoint']['csw_position'] == 41
+        resumed = start_checkpoint(self.db, harvest)
+        assert resumed['run_id'] == checkpoint['run_id']
+        assert resumed['csw_position'] == 41
+
+    def test_old_checkpoint_starts_over(self):
+        harvest = self.get_harvest()
+        checkpoint = start_checkpoint(self.db, harvest)
+        self.db.Harvests.update_one({'_id': 'h'}, {'$set': {
+            'checkpoint.started': datetime.utcnow() - timedelta(hours=13)
+        }})
+
+        harvest = self.get_harvest()
+        restarted = start_checkpoint(self.db, harvest, max_hours=12)
+        assert restarted['run_id'] != checkpoint['run_id']
+        assert 'csw_position' not in restarted
+
+    def test_no_checkpoint(self):
+        harvest = self.get_harvest()
+        save_checkpoint(self.db, harvest, csw_position=41)
+        assert 'checkpoint' not in self.get_harvest()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+tests/test_conditional_get.py
+'''
+
+from catalog_harvesting import harvest
+from catalog_harvesting.records import RecordSync
+from unittest import TestCase
+import mongomock
+import os
+import shutil
+import tempfile
+import time
+
+
+RECORD = (b'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" '
+          b'xmlns:gco="http://www.isotc211.org/2005/gco">'
+          b'<gmd:fileIdentifier><gco:CharacterString>%s'
+          b'</gco:CharacterString></gmd:fileIdentifier>'
+          b'</gmd:MD_Metadata>')
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeSession(object):
+    '''
+    Serves a response per URL and records the headers of each request
+    '''
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append((url, headers))
+        return self.responses[url]
+
+
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dest)
+        self.location = os.path.join(self.dest, 'doc.xml')
+        with open(self.location, 'wb') as f:
+            f.write(RECORD % b'old')
+        # the document was written by the previous harvest a while ago
+        os.utime(self.location, (1000000000, 1000000000))
+        self.db.Records.insert_one({
+            '_id': 1, 'harvest_id': 'h', 'url': 'http://waf/doc.xml',
+            'location': self.location, 'etag': '"v1"',
+            'last_modified': 'Mon, 01 Jan 2018 00:00:00 GMT',
+            'hash_val': 'old', 'validation_errors': []
+        })
+        self.harvest = {'_id': 'h', 'url': 'http://waf/',
+                        'organization': 'org', 'harvest_type': 'WAF',
+                        'incremental': True}
+        self.get_session = harvest.get_session
+        self.addCleanup(setattr, harvest, 'get_session', self.get_session)
+
+    def run_harvest(self, response):
+        session = FakeSession({'http://waf/doc.xml': response})
+        harvest.get_session = lambda: session
+        sync = RecordSync(self.db, self.harvest)
+        count, errors = harvest.process_documents(
+            self.db, self.harvest, [('http://waf/doc.xml', self.location)],
+            sync, validation_workers=1)
+        sync.finish()
+        return session, count, errors
+
+    def test_sends_stored_validators(self):
+        session, count, errors = self.run_harvest(FakeResponse(304))
+        url, headers = session.requests[0]
+        assert headers == {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'
+        }
+
+    def test_not_modified_keeps_record(self):
+        session, count, errors = self.run_harvest(FakeResponse(304))
+        assert (count, errors) == (1, 0)
+        rec = self.db.Records.find_one({'url': 'http://waf/doc.xml'})
+        assert rec['_id'] == 1
+        assert rec['hash_val'] == 'old'
+        with open(self.location, 'rb') as f:
+            assert f.read() == RECORD % b'old'
+        # the file was touched so it doesn't age out of the WAF
+        assert os.stat(self.location).st_mtime > time.time() - 60
+
+    def test_modified_replaces_record(self):
+        response = FakeResponse(200, RECORD % b'new', {
+            'ETag': '"v2"', 'Last-Modified': 'Tue, 02 Jan 2018 00:00:00 GMT'
+        })
+        session, count, errors = self.run_harvest(response)
+        assert count == 1
+        assert self.db.Records.count_documents({}) == 1
+        rec = self.db.Records.find_one({'url': 'http://waf/doc.xml'})
+        assert rec['etag'] == '"v2"'
+        assert rec['last_modified'] == 'Tue, 02 Jan 2018 00:00:00 GMT'
+        assert rec['hash_val'] != 'old'
+        with open(self.location, 'rb') as f:
+            assert b'new' in f.read()
+
+    def test_failed_harvest_keeps_records(self):
+        session = FakeSession({})
+        harvest.get_session = lambda: session
+
+        def documents():
+            raise IOError("Failed to crawl the WAF")
+            yield
+
+        with self.assertRaises(IOError):
+            harvest.download_documents(self.db, self.harvest, documents())
+        # the records not seen yet are kept until a run completes
+        assert self.db.Records.find_one({'_id': 1}) is not None
+        assert os.path.exists(self.location)
+
+    def test_error_response_is_not_stored(self):
+        response = FakeResponse(500, b'<html>Server Error</html>',
+                                {'ETag': '"error"'})
+        session, count, errors = self.run_harvest(response)
+        assert errors == 1
+        assert self.db.Records.find_one({'etag': '"error"'}) is None
+        with open(self.location, 'rb') as f:
+            assert f.read() == RECORD % b'old'
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+'''
+tests/test_csw.py
+'''
+
+from catalog_harvesting import csw
+from catalog_harvesting.metrics import HarvestMetrics
+from io import BytesIO
+from unittest import TestCase
+import re
+
+
+RECORD = (b'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" '
+          b'xmlns:gco="http://www.isotc211.org/2005/gco">'
+          b'<gmd:fileIdentifier><gco:CharacterString>id-%d'
+          b'</gco:CharacterString></gmd:fileIdentifier>'
+          b'</gmd:MD_Metadata>')
+
+RESPONSE = (b'<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">'
+            b'<csw:SearchStatus timestamp="2018-01-01T00:00:00Z"/>'
+            b'<csw:SearchResults numberOfRecordsMatched="%d" '
+            b'numberOfRecordsReturned="%d" nextRecord="%d" elementSet="full">'
+            b'%s</csw:SearchResults></csw:GetRecordsResponse>')
+
+
+class FakeResponse(object):
+
+    def __init__(self, content, status_code=200):
+        self.raw = BytesIO(content)
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class TrickleResponse(FakeResponse):
+    '''
+    A response whose body arrives 100 bytes at a time
+    '''
+
+    def __init__(self, content, status_code=200):
+        FakeResponse.__init__(self, content, status_code)
+        self.size = len(content)
+        read = self.raw.read
+        self.raw.read = lambda size=-1: read(100)
+
+
+class FakeSession(object):
+    '''
+    A CSW with 53 records that returns at most 10 records per request
+    '''
+    matches = 53
+    limit = 10
+    response_class = FakeResponse
+
+    def __init__(self):
+        self.responses = []
+
+    def post(self, url, data, headers, stream, timeout):
+        position = int(re.search(b'startPosition="(\\d+)"', data).group(1))
+        maxrecords = int(re.search(b'maxRecords="(\\d+)"', data).group(1))
+        ids = range(position,
+                    min(self.matches + 1, position + min(maxrecords, self.limit)))
+        nextrecord = position + len(ids)
+        if nextrecord > self.matches:
+            nextrecord = 0
+        records = b''.join(RECORD % i for i in ids)
+        self.responses.append(self.response_class(
+            RESPONSE % (self.matches, len(ids), nextrecord, records)))
+        return self.responses[-1]
+
+
+class TestCSWPages(TestCase):
+
+    def setUp(self):
+        self.get_session = csw.get_session
+        csw.get_session = FakeSession
+
+    def tearDown(self):
+        csw.get_session = self.get_session
+
+    def get_names(self, maxrecords, workers):
+        pages = [list(page) for position, page in
+                 csw.get_pages('http://csw', maxrecords, workers)]
+        return pages, [name for page in pages for name, doc in page]
+
+    def test_sequential_pages(self):
+        pages, names = self.get_names(5, 1)
+        assert len(pages) == 11
+        assert names == ['id-%d' % i for i in range(1, 54)]
+
+    def test_concurrent_pages(self):
+        pages, names = self.get_names(5, 4)
+        assert len(pages) == 11
+        # Pages are returned in order
+        assert names == ['id-%d' % i for i in range(1, 54)]
+
+    def test_server_page_limit(self):
+        pages, names = self.get_names(100, 4)
+        assert len(pages) == 6
+        assert names == ['id-%d' % i for i in range(1, 54)]
+
+    def test_start_position(self):
+        for workers in (1, 4):
+            pages = list(csw.get_pages('http://csw', 10, workers, start=31))
+            assert [position for position, page in pages] == [31, 41, 51]
+            names = [name for position, page in pages for name, doc in page]
+            assert names == ['id-%d' % i for i in range(31, 54)]
+
+    def test_record_xml(self):
+        name, doc = csw.get_page('http://csw', 1, 1)[0]
+        assert name == 'id-1'
+        assert doc.startswith(b'<gmd:MD_Metadata')
+        assert b'<gco:CharacterString>id-1</gco:CharacterString>' in doc
+
+    def test_record_tail(self):
+        record = RECORD % 1 + b'\n   '
+        session = FakeSession()
+        session.post = lambda *args, **kwargs: FakeResponse(
+            RESPONSE % (1, 1, 0, record))
+        csw.get_session = lambda: session
+        name, doc = csw.get_page('http://csw', 1, 1)[0]
+        assert doc.endswith(b'</gmd:MD_Metadata>')
+
+    def test_exception_report(self):
+        report = (b'<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows">'
+                  b'<ows:Exception exceptionCode="NoApplicableCode">'
+                  b'<ows:ExceptionText>Broken</ows:ExceptionText>'
+                  b'</ows:Exception></ows:ExceptionReport>')
+        session = FakeSession()
+        session.post = lambda *args, **kwargs: FakeResponse(report)
+        csw.get_session = lambda: session
+        with self.assertRaises(IOError):
+            csw.get_page('http://csw', 1, 10)
+
+    def test_sequential_pages_stream(self):
+        session = FakeSession()
+        session.response_class = TrickleResponse
+        csw.get_session = lambda: session
+        metrics = HarvestMetrics()
+        pages = csw.get_pages('http://csw', 10, 1, metrics=metrics)
+        position, page = next(pages)
+        records = iter(page)
+        assert next(records)[0] == 'id-1'
+        # the rest of the page is still to be read from the response
+        response = session.responses[0]
+        assert response.raw.tell() < response.size
+        assert [name for name, doc in records][-1] == 'id-10'
+        assert len(metrics.timings['download']) == 10
+
+        position, page = next(pages)
+        assert position == 11
+        assert next(iter(page))[0] == 'id-11'
+        assert len(session.responses) == 2
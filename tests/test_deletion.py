@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+tests/test_deletion.py
+'''
+
+from catalog_harvesting.deletion import delete_locations, delete_records
+from catalog_harvesting.metrics import HarvestMetrics
+from unittest import TestCase
+import mongomock
+import os
+import shutil
+import tempfile
+
+
+class TestDeletion(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dest)
+
+    def write(self, name):
+        filepath = os.path.join(self.dest, name)
+        with open(filepath, 'w') as f:
+            f.write('<xml/>')
+        return filepath
+
+    def test_delete_locations(self):
+        locations = [self.write('%d.xml' % i) for i in range(10)]
+        missing = os.path.join(self.dest, 'missing.xml')
+        metrics = HarvestMetrics()
+
+        removed = delete_locations(iter(locations + [missing]), workers=3,
+                                   batch_size=3, metrics=metrics)
+        assert removed == 10
+        assert metrics.counters['files_removed'] == 10
+        assert os.listdir(self.dest) == []
+
+    def test_delete_records(self):
+        for i in range(7):
+            self.db.Records.insert_one({'harvest_id': 'h',
+                                        'location': self.write('%d.xml' % i)})
+        self.db.Records.insert_one({'harvest_id': 'h'})
+        keep = self.write('keep.xml')
+        self.db.Records.insert_one({'harvest_id': 'other', 'location': keep})
+        metrics = HarvestMetrics()
+
+        count = delete_records(self.db, {'harvest_id': 'h'}, workers=2,
+                               batch_size=2, metrics=metrics)
+        assert count == 8
+        assert metrics.counters['files_removed'] == 7
+        assert self.db.Records.count_documents({'harvest_id': 'h'}) == 0
+        assert self.db.Records.count_documents({'harvest_id': 'other'}) == 1
+        assert os.listdir(self.dest) == ['keep.xml']
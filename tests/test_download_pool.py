@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+tests/test_download_pool.py
+'''
+
+from catalog_harvesting.download import DownloadPool
+from unittest import TestCase
+import threading
+import time
+
+
+class TestDownloadPool(TestCase):
+
+    def test_download_all(self):
+        fetched = []
+
+        def fetch(link, location):
+            fetched.append((link, location))
+
+        documents = [('http://example.com/%s.xml' % i, '/tmp/%s.xml' % i)
+                     for i in range(20)]
+        pool = DownloadPool(fetch, workers=4, per_host=2)
+        results = list(pool.imap(iter(documents)))
+
+        assert len(results) == 20
+        assert sorted(fetched) == sorted(documents)
+        assert all(error is None for link, location, result, error in results)
+
+    def test_errors_are_returned(self):
+        def fetch(link, location):
+            if link.endswith('bad.xml'):
+                raise IOError("Connection reset")
+
+        documents = [('http://example.com/good.xml', '/tmp/good.xml'),
+                     ('http://example.com/bad.xml', '/tmp/bad.xml')]
+        pool = DownloadPool(fetch, workers=2, per_host=2)
+        errors = dict((link, error) for link, location, result, error
+                      in pool.imap(documents))
+
+        assert errors['http://example.com/good.xml'] is None
+        assert isinstance(errors['http://example.com/bad.xml'], IOError)
+
+    def test_per_host_limit(self):
+        lock = threading.Lock()
+        active = {'now': 0, 'max': 0}
+
+        def fetch(link, location):
+            with lock:
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.01)
+            with lock:
+                active['now'] -= 1
+
+        documents = [('http://example.com/%s.xml' % i, '/tmp/%s.xml' % i)
+                     for i in range(20)]
+        pool = DownloadPool(fetch, workers=8, per_host=2)
+        list(pool.imap(documents))
+
+        assert active['max'] <= 2
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+tests/test_fanout.py
+'''
+
+from catalog_harvesting.fanout import (enqueue_harvests, finish_batch_job,
+                                       CLEAN_JOB)
+from rq import Queue
+from unittest import TestCase
+import fakeredis
+import mongomock
+
+
+class TestFanout(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.Harvests.insert_many([
+            {'_id': 'a', 'publish': True, 'last_harvest_duration': 10},
+            {'_id': 'b', 'publish': True, 'last_harvest_duration': 300},
+            {'_id': 'c', 'publish': False}
+        ])
+        self.redis = fakeredis.FakeStrictRedis()
+        self.queue = Queue('nightly', connection=self.redis)
+
+    def test_enqueue_longest_first(self):
+        batch_id = enqueue_harvests(self.db, self.redis, '/data', 3,
+                                    queue_name='nightly')
+        jobs = self.queue.jobs
+        assert [job.args for job in jobs] == [('b',), ('a',)]
+        assert all(job.kwargs == {'batch_id': batch_id} for job in jobs)
+
+    def test_last_job_cleans(self):
+        batch_id = enqueue_harvests(self.db, self.redis, '/data', 3,
+                                    queue_name='nightly')
+        self.queue.empty()
+
+        assert finish_batch_job(self.redis, batch_id) is False
+        assert self.queue.count == 0
+        assert finish_batch_job(self.redis, batch_id) is True
+        job = self.queue.jobs[0]
+        assert job.func_name == CLEAN_JOB
+        assert job.args == ('/data', 3)
+        # finishing again does not clean twice
+        assert finish_batch_job(self.redis, batch_id) is False
+
+    def test_unfinished_batch_cleans_on_next_enqueue(self):
+        batch_id = enqueue_harvests(self.db, self.redis, '/data', 3,
+                                    queue_name='nightly')
+        # one harvest finishes, the worker of the other one is killed
+        finish_batch_job(self.redis, batch_id)
+        self.queue.empty()
+
+        enqueue_harvests(self.db, self.redis, '/data', 3,
+                         queue_name='nightly')
+        assert self.queue.jobs[0].func_name == CLEAN_JOB
+        assert [job.args for job in self.queue.jobs[1:]] == [('b',), ('a',)]
+        # the killed job finishing late does not clean again
+        assert finish_batch_job(self.redis, batch_id) is False
+
+    def test_no_clean(self):
+        batch_id = enqueue_harvests(self.db, self.redis, '/data',
+                                    queue_name='nightly')
+        self.queue.empty()
+        finish_batch_job(self.redis, batch_id)
+        assert finish_batch_job(self.redis, batch_id) is True
+        assert self.queue.count == 0
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+'''
+tests/test_indexes.py
+'''
+
+from catalog_harvesting.indexes import ensure_indexes, missing_indexes
+from unittest import TestCase
+import mongomock
+
+
+class TestIndexes(TestCase):
+
+    def test_ensure_indexes(self):
+        db = mongomock.MongoClient().db
+        missing = missing_indexes(db)
+        assert ('Harvests', [('publish', 1)]) in missing
+
+        assert ensure_indexes(db) == missing
+        assert missing_indexes(db) == []
+        # creating the indexes again is a no-op
+        assert ensure_indexes(db) == []
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+tests/test_metrics.py
+'''
+
+from catalog_harvesting import harvest
+from catalog_harvesting.metrics import (HarvestMetrics, percentile,
+                                        start_metrics, get_metrics,
+                                        stop_metrics, format_prometheus)
+from unittest import TestCase
+import mongomock
+
+
+class TestHarvestMetrics(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile(values, 100) == 100
+        assert percentile([], 50) == 0
+
+    def test_summary(self):
+        metrics = HarvestMetrics()
+        for seconds in (0.1, 0.2, 0.3, 0.4):
+            metrics.add_time('download', seconds)
+        metrics.add_timings({'validate': 0.5, 'geometry': 0.01})
+        metrics.count('download_bytes', 100)
+        metrics.count('download_bytes', 50)
+        with metrics.timer('ckan'):
+            pass
+
+        summary = metrics.summary()
+        download = summary['stages']['download']
+        assert download['count'] == 4
+        assert abs(download['total'] - 1.0) < 1e-9
+        assert download['max'] == 0.4
+        assert download['p50'] == 0.2
+        assert summary['stages']['validate']['count'] == 1
+        assert 'ckan' in summary['stages']
+        assert summary['counters'] == {'download_bytes': 150}
+
+    def test_timed_iter(self):
+        metrics = HarvestMetrics()
+        assert list(metrics.timed_iter([1, 2, 3], 'crawl')) == [1, 2, 3]
+        # the wait for the end of the iterable is timed as well
+        assert metrics.summary()['stages']['crawl']['count'] == 4
+
+    def test_active_metrics(self):
+        harvest = {'_id': 'h'}
+        metrics = start_metrics(harvest)
+        assert get_metrics(harvest) is metrics
+        metrics.count('records')
+        summary = stop_metrics(harvest)
+        assert summary['counters'] == {'records': 1}
+        assert get_metrics(harvest) is not metrics
+        assert stop_metrics(harvest) is None
+
+    def test_prometheus(self):
+        metrics = HarvestMetrics()
+        metrics.add_time('download', 0.5)
+        metrics.count('download_bytes', 10)
+        text = format_prometheus([{
+            '_id': 'h',
+            'last_record_count': 3,
+            'last_harvest_metrics': metrics.summary()
+        }])
+        assert 'harvest_records{harvest="h"} 3\n' in text
+        assert 'harvest_stage_seconds{harvest="h",stage="download",quantile="0.5"} 0.5' in text
+        assert 'harvest_stage_seconds_count{harvest="h",stage="download"} 1' in text
+        assert 'harvest_counter{harvest="h",name="download_bytes"} 10' in text
+
+
+class TestDownloadHarvest(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.harvest = {'_id': 'h', 'url': 'http://waf/',
+                        'organization': 'org', 'harvest_type': 'WAF'}
+        self.db.Harvests.insert_one(dict(self.harvest))
+        for name in ('download_waf', 'trigger_ckan_harvest'):
+            self.addCleanup(setattr, harvest, name, getattr(harvest, name))
+        harvest.download_waf = lambda db, h, src, path: (2, 1)
+
+    def test_ckan_triggered_after_update(self):
+        statuses = []
+
+        def trigger_ckan_harvest(db, h):
+            statuses.append(db.Harvests.find_one({'_id': 'h'}))
+        harvest.trigger_ckan_harvest = trigger_ckan_harvest
+
+        harvest.download_harvest(self.db, self.harvest, '/tmp')
+        # CKAN is only asked to harvest the records once they are counted
+        assert statuses[0]['last_harvest_status'] == 'ok'
+        assert statuses[0]['last_record_count'] == 2
+        doc = self.db.Harvests.find_one({'_id': 'h'})
+        assert doc['last_harvest_status'] == 'ok'
+        assert 'ckan' in doc['last_harvest_metrics']['stages']
+
+    def test_failed_ckan_trigger(self):
+        def trigger_ckan_harvest(db, h):
+            raise IOError("CKAN is down")
+        harvest.trigger_ckan_harvest = trigger_ckan_harvest
+        self.addCleanup(setattr, harvest, 'send_notifications',
+                        harvest.send_notifications)
+        harvest.send_notifications = lambda db, h: None
+
+        harvest.download_harvest(self.db, self.harvest, '/tmp')
+        doc = self.db.Harvests.find_one({'_id': 'h'})
+        assert doc['last_harvest_status'] == 'fail'
+        assert doc['last_record_count'] == 2
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+'''
+tests/test_notifications.py
+'''
+
+from catalog_harvesting.harvest import throttle_emails, throttle_email
+from unittest import TestCase
+import fakeredis
+
+
+class TestThrottle(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def test_throttle_emails(self):
+        emails = ['a@ioos.us', 'b@ioos.us']
+        assert throttle_emails(emails, redis_connection=self.redis) == emails
+        # both recipients were just notified
+        assert throttle_emails(emails + ['c@ioos.us'],
+                               redis_connection=self.redis) == ['c@ioos.us']
+        assert not throttle_email('a@ioos.us', redis_connection=self.redis)
+
+    def test_duplicate_recipient(self):
+        recipients = throttle_emails(['a@ioos.us', 'a@ioos.us'],
+                                     redis_connection=self.redis)
+        assert recipients == ['a@ioos.us']
+
+    def test_timeout(self):
+        throttle_emails(['a@ioos.us'], timeout=60,
+                        redis_connection=self.redis)
+        key = self.redis.keys('harvesting:notifications:*')[0]
+        assert 0 < self.redis.ttl(key) <= 60
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''
+tests/test_record_queue.py
+'''
+
+from catalog_harvesting.record_queue import (enqueue_records,
+                                             finish_record_job, get_run_key,
+                                             get_jobs_key, get_lost_jobs,
+                                             recover_record_runs,
+                                             check_record_runs,
+                                             is_current_generation,
+                                             use_record_jobs, RECORD_JOB)
+from rq import Queue
+from rq.job import JobStatus
+from unittest import TestCase
+import fakeredis
+import mongomock
+
+
+class TestRecordQueue(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.redis = fakeredis.FakeStrictRedis()
+        self.queue = Queue('records', connection=self.redis)
+        self.harvest = {'_id': 'h', 'url': 'http://waf/',
+                        'harvest_type': 'WAF',
+                        'checkpoint': {'run_id': 'run'}}
+        self.db.Harvests.insert_one(dict(self.harvest))
+        self.documents = [('http://waf/%d.xml' % i, '/data/%d.xml' % i)
+                          for i in range(5)]
+
+    def enqueue(self):
+        jobs = enqueue_records(self.db, self.redis, self.harvest,
+                               self.documents, batch_size=2,
+                               queue_name='records')
+        return jobs, self.harvest['checkpoint']['record_generation']
+
+    def test_use_record_jobs(self):
+        assert use_record_jobs(dict(self.harvest, record_jobs=True))
+        assert not use_record_jobs(dict(self.harvest, record_jobs=False))
+        assert not use_record_jobs({'harvest_type': 'CSW',
+                                    'record_jobs': True})
+
+    def test_enqueue_batches(self):
+        jobs, generation = self.enqueue()
+        assert jobs == 3
+        enqueued = self.queue.jobs
+        assert all(job.func_name == RECORD_JOB for job in enqueued)
+        assert [len(job.args[3]) for job in enqueued] == [2, 2, 1]
+        assert enqueued[0].args[:3] == ('h', 'run', generation)
+        stored = self.db.Harvests.find_one({'_id': 'h'})
+        assert is_current_generation(stored, 'run', generation)
+
+    def test_last_job_totals(self):
+        jobs, generation = self.enqueue()
+        # the jobs finish before the enqueuer
+        assert finish_record_job(self.redis, generation, 2, 1,
+                                 {'bytes': 10}) is None
+        assert finish_record_job(self.redis, generation, 2, 0,
+                                 {'bytes': 5}) is None
+        assert finish_record_job(self.redis, generation, 1, 0) is None
+        totals = finish_record_job(self.redis, generation,
+                                   counters={'crawl': 1})
+        assert totals['records'] == 5
+        assert totals['errors'] == 1
+        assert totals['counters'] == {'bytes': 15, 'crawl': 1}
+        assert 'started' in totals
+        assert not self.redis.exists(get_run_key(generation))
+        # finishing again does not finish the run twice
+        assert finish_record_job(self.redis, generation, 1, 0) is None
+
+    def test_enqueue_twice(self):
+        # the run is resumed while the jobs of the first enqueue are queued
+        jobs, first = self.enqueue()
+        finish_record_job(self.redis, first)
+        jobs, second = self.enqueue()
+        assert first != second
+        stored = self.db.Harvests.find_one({'_id': 'h'})
+        assert not is_current_generation(stored, 'run', first)
+        assert is_current_generation(stored, 'run', second)
+
+        # the jobs of the first enqueue never finish the second
+        for i in range(3):
+            assert finish_record_job(self.redis, first, 2, 0) is None
+        assert int(self.redis.hget(get_run_key(second), 'remaining')) == 4
+        for i in range(3):
+            assert finish_record_job(self.redis, second, 2, 0) is None
+        totals = finish_record_job(self.redis, second)
+        assert totals['records'] == 6
+
+    def test_finished_jobs_are_not_lost(self):
+        jobs, generation = self.enqueue()
+        assert get_lost_jobs(self.redis, generation) == []
+        for job in self.queue.jobs:
+            finish_record_job(self.redis, generation, 2, 0, job_id=job.id)
+        assert not self.redis.exists(get_jobs_key(generation))
+        assert get_lost_jobs(self.redis, generation) == []
+        assert recover_record_runs(self.db, self.redis) == 0
+
+    def test_lost_jobs_fail_the_run(self):
+        jobs, generation = self.enqueue()
+        killed, missing, queued = self.queue.jobs
+        finish_record_job(self.redis, generation)
+        # RQ marks the job of a killed worker failed, or it expired
+        killed.set_status(JobStatus.FAILED)
+        missing.delete()
+        assert sorted(get_lost_jobs(self.redis, generation)) == sorted(
+            [killed.id, missing.id])
+
+        assert recover_record_runs(self.db, self.redis) == 1
+        stored = self.db.Harvests.find_one({'_id': 'h'})
+        assert stored['last_harvest_status'] == 'fail'
+        # the next run resumes the failed one
+        assert stored['checkpoint']['run_id'] == 'run'
+        assert not self.redis.exists(get_run_key(generation))
+        assert not self.redis.exists(get_jobs_key(generation))
+        # the job still queued can't finish the failed run
+        assert finish_record_job(self.redis, generation, 1, 0,
+                                 job_id=queued.id) is None
+        assert recover_record_runs(self.db, self.redis) == 0
+
+    def test_enqueuer_still_running(self):
+        jobs, generation = self.enqueue()
+        # as if the enqueuer had been killed before finishing
+        self.redis.hset(get_run_key(generation), 'enqueuer', 'enqueuer-job')
+        self.queue.jobs[0].delete()
+        assert get_lost_jobs(self.redis, generation) == ['enqueuer-job']
+
+    def test_check_record_runs_interval(self):
+        jobs, generation = self.enqueue()
+        self.queue.jobs[0].delete()
+        assert check_record_runs(self.db, self.redis) == 1
+        jobs, generation = self.enqueue()
+        self.queue.jobs[-1].delete()
+        # checked recently by another job
+        assert check_record_runs(self.db, self.redis) == 0
+        assert recover_record_runs(self.db, self.redis) == 1
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+'''
+tests/test_records.py
+'''
+
+from catalog_harvesting import records
+from catalog_harvesting.records import (ValidationPool, RecordSync,
+                                        RecordWriter, write_document,
+                                        get_unchanged_summary)
+from ckanext.spatial.validation import ISO19139NGDCSchema
+from lxml import etree
+from pymongo.errors import BulkWriteError
+from unittest import TestCase
+import hashlib
+import logging
+import mongomock
+import os
+import shutil
+import tempfile
+import threading
+
+
+class TestValidationPool(TestCase):
+
+    def test_results_keep_task_order(self):
+        tasks = [(i, None, None) for i in range(10)]
+        tasks[4] = (4, '<not-xml', None)
+        pool = ValidationPool(workers=2)
+        results = list(pool.imap(iter(tasks)))
+
+        assert [item for item, doc, result in results] == list(range(10))
+        # malformed documents are left for process_doc to report
+        assert all(result is None for item, doc, result in results)
+
+    def test_unchanged_documents_reuse_summary(self):
+        doc = b'<gmd:MD_Metadata/>'
+        previous = {
+            'hash_val': hashlib.md5(doc).hexdigest(),
+            'title': 'Previous',
+            'validation_errors': []
+        }
+        pool = ValidationPool(workers=2)
+        [(item, result_doc, result)] = list(pool.imap([(1, doc, previous)]))
+        summary, body = result
+
+        # unchanged documents don't need to be written again
+        assert body is None
+        assert summary['title'] == 'Previous'
+        assert summary['hash_val'] == previous['hash_val']
+
+
+class TestUnchangedSummary(TestCase):
+
+    def setUp(self):
+        self.doc = b'<gmd:MD_Metadata/>'
+        self.previous = {
+            'hash_val': hashlib.md5(self.doc).hexdigest(),
+            'title': 'Previous',
+            'record_url': 'http://registry/waf/org/doc.xml',
+            'validation_errors': [],
+            'etag': '"v1"'
+        }
+
+    def test_reuse(self):
+        summary = get_unchanged_summary(self.doc, self.previous)
+        assert summary['title'] == 'Previous'
+        assert summary['validation_errors'] == []
+        # only the fields derived from the contents are reused
+        assert 'etag' not in summary
+        assert 'record_url' not in summary
+
+    def test_changed_document(self):
+        assert get_unchanged_summary(b'<gmd:MD_Metadata></gmd:MD_Metadata>',
+                                     self.previous) is None
+
+    def test_no_previous_hash(self):
+        assert get_unchanged_summary(self.doc, None) is None
+        del self.previous['hash_val']
+        assert get_unchanged_summary(self.doc, self.previous) is None
+
+    def test_keeps_unpatched_geometry(self):
+        self.previous['record_url'] = None
+        summary = get_unchanged_summary(self.doc, self.previous)
+        assert 'record_url' in summary
+        assert summary['record_url'] is None
+
+
+class TestSchema(TestCase):
+
+    def setUp(self):
+        self.schemas = list(records.ISO_SCHEMAS)
+        del records.ISO_SCHEMAS[:]
+        self.compile_iso_schema = records.compile_iso_schema
+        self.compiled = []
+
+        def compile_iso_schema():
+            schema = self.compile_iso_schema()
+            self.compiled.append(schema)
+            return schema
+        records.compile_iso_schema = compile_iso_schema
+        # Missing the mandatory contact, dateStamp and identificationInfo
+        self.doc = etree.fromstring(
+            b'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" '
+            b'xmlns:gco="http://www.isotc211.org/2005/gco">\n'
+            b'  <gmd:fileIdentifier>\n'
+            b'    <gco:CharacterString>doc-1</gco:CharacterString>\n'
+            b'  </gmd:fileIdentifier>\n'
+            b'  <gmd:bogus/>\n'
+            b'</gmd:MD_Metadata>')
+        # Not an ISO 19139 document at all
+        self.other = etree.fromstring(
+            b'<gmd:MD_Other xmlns:gmd="http://www.isotc211.org/2005/gmd"/>')
+
+    def tearDown(self):
+        records.compile_iso_schema = self.compile_iso_schema
+        records.ISO_SCHEMAS[:] = self.schemas
+
+    def test_compiled_once(self):
+        records.load_iso_schema()
+        records.load_iso_schema()
+        records.validate_schema(self.doc)
+        records.validate_schema(self.doc)
+        assert len(self.compiled) == 1
+        assert records.ISO_SCHEMAS == self.compiled
+
+    def test_same_errors_as_ckanext(self):
+        valid, expected = ISO19139NGDCSchema.is_valid(self.doc)
+        assert not valid
+        assert records.validate_schema(self.doc) == expected
+
+    def test_threads(self):
+        docs = [self.doc, self.other]
+        expected = [records.validate_schema(doc) for doc in docs]
+        assert expected[0] != expected[1]
+        mismatches = []
+
+        def validate():
+            for i in range(100):
+                if records.validate_schema(docs[i % 2]) != expected[i % 2]:
+                    mismatches.append(i)
+        threads = [threading.Thread(target=validate) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each thread validates with a schema of its own
+        assert mismatches == []
+        assert len(self.compiled) <= len(threads)
+
+
+class TestRecordWriter(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+    def test_buffers_writes(self):
+        writer = RecordWriter(self.db, size=10)
+        record_id = writer.insert({'harvest_id': 'h', 'url': 'http://a'})
+        writer.update(record_id, {'title': 'A'})
+        assert self.db.Records.count_documents({}) == 0
+        writer.flush()
+        assert self.db.Records.find_one({'_id': record_id})['title'] == 'A'
+
+        writer.upsert({'harvest_id': 'h', 'url': 'http://a', 'title': 'B'},
+                      record_id)
+        writer.remove(record_id)
+        writer.flush()
+        assert self.db.Records.count_documents({}) == 0
+
+    def test_flushes_at_size(self):
+        writer = RecordWriter(self.db, size=3)
+        for i in range(7):
+            writer.insert({'harvest_id': 'h', 'url': 'http://%d' % i})
+        assert self.db.Records.count_documents({}) == 6
+        assert len(writer.pending) == 1
+        writer.flush()
+        assert self.db.Records.count_documents({}) == 7
+        assert writer.metrics.counters['mongo_writes'] == 7
+
+    def test_flush_empty(self):
+        writer = RecordWriter(self.db)
+        writer.flush()
+        assert self.db.Records.count_documents({}) == 0
+        assert 'mongo_write' not in writer.metrics.timings
+
+    def test_unordered_errors(self):
+        self.db.Records.insert_one({'_id': 1, 'url': 'http://a'})
+        writer = RecordWriter(self.db, size=10)
+        writer.insert({'_id': 1, 'url': 'http://a'})
+        writer.insert({'_id': 2, 'url': 'http://b'})
+        with self.assertRaises(BulkWriteError):
+            writer.flush()
+        # the writes after the failed one are still applied
+        assert self.db.Records.find_one({'_id': 2}) is not None
+        assert writer.pending == []
+
+
+class TestRecordSync(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.Records.insert_many([
+            {'_id': 1, 'harvest_id': 'h', 'url': 'http://a', 'location': '/a',
+             'harvest_run': 'run', 'validation_errors': []},
+            {'_id': 2, 'harvest_id': 'h', 'url': 'http://b', 'location': '/b',
+             'validation_errors': [{'error': 'bad'}]},
+            {'_id': 3, 'harvest_id': 'h', 'url': 'http://c', 'location': '/c'}
+        ])
+        self.harvest = {'_id': 'h', 'checkpoint': {'run_id': 'run'}}
+
+    def test_resume(self):
+        sync = RecordSync(self.db, self.harvest)
+        # the record written by the interrupted run is done
+        assert sync.is_done('http://a')
+        assert not sync.is_done('http://b')
+        assert (sync.done_count, sync.done_errors) == (1, 0)
+
+        assert sync.keep('http://b')['_id'] == 2
+        sync.flush()
+        assert self.db.Records.find_one({'_id': 2})['harvest_run'] == 'run'
+
+        sync.finish()
+        assert sorted(r['_id'] for r in self.db.Records.find()) == [1, 2]
+
+    def test_interrupted_run_keeps_records(self):
+        self.harvest['incremental'] = True
+        sync = RecordSync(self.db, self.harvest)
+        sync.keep('http://b')
+        # an interrupted run only flushes its writes
+        sync.flush()
+        assert self.db.Records.count_documents({}) == 3
+
+    def test_not_incremental_resume(self):
+        self.harvest['incremental'] = False
+        sync = RecordSync(self.db, self.harvest)
+        # only the records of the interrupted run are kept
+        assert [r['_id'] for r in self.db.Records.find()] == [1]
+        assert sync.is_done('http://a')
+
+    def test_record_job(self):
+        self.harvest['incremental'] = False
+        sync = RecordSync(self.db, self.harvest, links=['http://a', 'http://b'])
+        # a record job only loads its own records and removes none
+        assert sync.is_done('http://a')
+        assert sync.get_previous('http://b')['_id'] == 2
+        assert sync.get_previous('http://c') is None
+        assert self.db.Records.count_documents({}) == 3
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestProcessDoc(TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.db = mongomock.MongoClient().db
+        self.handler = ListHandler()
+        records.get_logger().addHandler(self.handler)
+
+    def tearDown(self):
+        records.get_logger().removeHandler(self.handler)
+        shutil.rmtree(self.dest)
+
+    def test_invalid_geometry_logs_link(self):
+        # A bounding box without any bounds can't be patched
+        doc = (b'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd">'
+               b'<gmd:identificationInfo><gmd:MD_DataIdentification>'
+               b'<gmd:extent><gmd:EX_Extent><gmd:geographicElement>'
+               b'<gmd:EX_GeographicBoundingBox/>'
+               b'</gmd:geographicElement></gmd:EX_Extent></gmd:extent>'
+               b'</gmd:MD_DataIdentification></gmd:identificationInfo>'
+               b'</gmd:MD_Metadata>')
+        link = 'http://remote/waf/doc.xml'
+        writer = RecordWriter(self.db)
+        rec = records.process_doc(doc, 'http://registry/waf/org/doc.xml',
+                                  os.path.join(self.dest, 'doc.xml'),
+                                  {'_id': 'h'}, link, self.db, writer=writer)
+        assert rec['record_url'] is None
+        assert self.handler.messages == [
+            'Failed to patch geometry for %s' % link]
+
+
+class TestWriteDocument(TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_replaces_document(self):
+        location = os.path.join(self.dest, 'doc.xml')
+        write_document(location, b'<old/>')
+        write_document(location, b'<new/>')
+        with open(location, 'rb') as f:
+            assert f.read() == b'<new/>'
+        # no temporary files are left behind
+        assert os.listdir(self.dest) == ['doc.xml']
+
+    def test_fsync_directories(self):
+        location = os.path.join(self.dest, 'doc.xml')
+        write_document(location, b'<doc/>', fsync=True)
+        assert self.dest in records.PENDING_DIRECTORIES
+        records.sync_directories()
+        assert not records.PENDING_DIRECTORIES
+
+    def test_failed_write(self):
+        location = os.path.join(self.dest, 'doc.xml')
+
+        def failing_replace(src, dst):
+            raise OSError('rename failed')
+
+        replace = records.replace
+        records.replace = failing_replace
+        try:
+            with self.assertRaises(OSError):
+                write_document(location, b'<doc/>')
+        finally:
+            records.replace = replace
+        # the temporary file is removed
+        assert os.listdir(self.dest) == []
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+tests/test_scheduler.py
+'''
+
+from catalog_harvesting.scheduler import HarvestScheduler, get_harvest_order
+from unittest import TestCase
+import threading
+import time
+
+
+class TestHarvestScheduler(TestCase):
+
+    def test_longest_first(self):
+        harvests = [
+            {'_id': 'a', 'last_harvest_duration': 10},
+            {'_id': 'b'},
+            {'_id': 'c', 'last_harvest_duration': 300},
+            {'_id': 'd', 'last_record_count': 5000}
+        ]
+        order = [h['_id'] for h in get_harvest_order(harvests)]
+        assert order == ['c', 'a', 'd', 'b']
+
+        started = []
+        HarvestScheduler(lambda h: started.append(h['_id']),
+                         workers=1).run(harvests)
+        assert started == order
+
+    def test_limits(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0, 'hosts': {}, 'host_peak': 0}
+
+        def run(harvest):
+            host = harvest['url']
+            with lock:
+                state['active'] += 1
+                state['hosts'][host] = state['hosts'].get(host, 0) + 1
+                state['peak'] = max(state['peak'], state['active'])
+                state['host_peak'] = max(state['host_peak'],
+                                         state['hosts'][host])
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+                state['hosts'][host] -= 1
+
+        harvests = [{'_id': i, 'url': 'http://host%d/waf/' % (i % 3)}
+                    for i in range(12)]
+        HarvestScheduler(run, workers=4, per_host=1).run(harvests)
+        assert state['peak'] == 3
+        assert state['host_peak'] == 1
+
+        state['peak'] = state['host_peak'] = 0
+        HarvestScheduler(run, workers=4, per_host=2).run(harvests)
+        assert state['peak'] == 4
+        assert state['host_peak'] == 2
+
+    def test_failures_do_not_stop_other_harvests(self):
+        finished = []
+
+        def run(harvest):
+            if harvest['_id'] == 1:
+                raise IOError("unreachable")
+            finished.append(harvest['_id'])
+
+        harvests = [{'_id': i, 'url': 'http://host/'} for i in range(3)]
+        HarvestScheduler(run, workers=2).run(harvests)
+        assert sorted(finished) == [0, 2]
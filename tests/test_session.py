@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''
+tests/test_session.py
+'''
+
+from catalog_harvesting import session
+from unittest import TestCase
+
+
+class TestSession(TestCase):
+
+    def setUp(self):
+        self.session = session.SESSION
+        self.session_pid = session.SESSION_PID
+        session.SESSION = None
+        session.SESSION_PID = None
+
+    def tearDown(self):
+        session.SESSION = self.session
+        session.SESSION_PID = self.session_pid
+
+    def test_shared_session(self):
+        shared = session.get_session()
+        assert session.get_session() is shared
+
+    def test_new_session_after_fork(self):
+        parent = session.get_session()
+        # As seen by a process forked from the parent
+        session.SESSION_PID = -1
+        child = session.get_session()
+        assert child is not parent
+        assert session.get_session() is child
+
+    def test_retry_settings(self):
+        for prefix in ('http://', 'https://'):
+            adapter = session.get_session().get_adapter(prefix + 'example.com')
+            retry = adapter.max_retries
+            assert retry.total == session.HTTP_MAX_RETRIES
+            assert retry.backoff_factor == session.HTTP_BACKOFF_FACTOR
+            assert set(retry.status_forcelist) == {502, 503, 504}
+
+    def test_pool_settings(self):
+        adapter = session.create_session(pool_size=4, pool_hosts=2).get_adapter(
+            'http://example.com')
+        assert adapter._pool_maxsize == 4
+        assert adapter._pool_connections == 2
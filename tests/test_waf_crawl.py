@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+tests/test_waf_crawl.py
+'''
+
+from catalog_harvesting.waf_parser import WAFParser
+from unittest import TestCase
+
+
+PAGES = {
+    'http://waf/': '<a href="a/">a/</a><a href="b/">b/</a><a href="top.xml">top.xml</a>',
+    'http://waf/a/': '<a href="../">Parent Directory</a><a href="one.xml">one.xml</a><a href="deep/">deep/</a>',
+    'http://waf/a/deep/': '<a href="two.xml">two.xml</a><a href="deeper/">deeper/</a>',
+    'http://waf/a/deep/deeper/': '<a href="three.xml">three.xml</a>',
+    'http://waf/b/': '<a href="four.xml">four.xml</a>'
+}
+
+
+class FakeResponse(object):
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class FakeSession(object):
+
+    def get(self, url):
+        if url not in PAGES:
+            return FakeResponse('', 404)
+        return FakeResponse(PAGES[url])
+
+
+class TestWAFCrawl(TestCase):
+
+    def get_parser(self, workers):
+        parser = WAFParser('http://waf/', workers=workers)
+        parser.session = FakeSession()
+        return parser
+
+    def test_depth_first_order(self):
+        expected = [
+            'http://waf/top.xml',
+            'http://waf/a/one.xml',
+            'http://waf/a/deep/two.xml',
+            'http://waf/b/four.xml'
+        ]
+        for workers in (1, 4):
+            assert self.get_parser(workers).parse() == expected
+
+    def test_maxdepth(self):
+        parser = self.get_parser(4)
+        assert parser.parse(maxdepth=0) == ['http://waf/top.xml']
+        assert 'http://waf/a/deep/deeper/three.xml' in parser.parse(maxdepth=3)
+
+    def test_iter_documents_skips_duplicates(self):
+        PAGES['http://waf/dup/'] = (
+            '<a href="x.xml">x.xml</a>'
+            '<a href="http://host/thredds/iso/x.xml">iso</a>'
+            '<a href="x.xml">x.xml again</a>'
+            '<a href="../b/">b</a>'
+            '<a href="/b/">b</a>'
+        )
+        try:
+            parser = WAFParser('http://waf/dup/', workers=2)
+            parser.session = FakeSession()
+            documents = parser.iter_documents()
+            assert next(documents) == 'http://waf/dup/x.xml'
+            assert list(documents) == [
+                'http://host/thredds/iso/x.xml',
+                'http://waf/b/four.xml'
+            ]
+        finally:
+            del PAGES['http://waf/dup/']
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+tests/test_waf_index.py
+'''
+
+from catalog_harvesting.waf_index import record_locations, clean_expired
+from datetime import datetime, timedelta
+from unittest import TestCase
+import mongomock
+import os
+import shutil
+import tempfile
+import time
+
+
+class TestWafIndex(TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dest)
+
+    def write(self, name, days_old=0):
+        filepath = os.path.join(self.dest, name)
+        with open(filepath, 'w') as f:
+            f.write('<xml/>')
+        mtime = time.time() - days_old * 86400
+        os.utime(filepath, (mtime, mtime))
+        return filepath
+
+    def test_clean_expired(self):
+        old = self.write('old.xml', days_old=5)
+        seen = self.write('seen.xml', days_old=5)
+        touched = self.write('touched.xml', days_old=0)
+        record_locations(self.db, [old, touched],
+                         seen=datetime.utcnow() - timedelta(days=5))
+        # not modified since, but seen by the last harvest
+        record_locations(self.db, [seen])
+
+        assert clean_expired(self.db, self.dest, max_days=3) == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(seen)
+        assert os.path.exists(touched)
+        assert self.db.WafFiles.find_one({'_id': old}) is None
+        assert self.db.WafFiles.find_one({'_id': touched}) is not None
+
+    def test_reconcile_index(self):
+        old = self.write('old.xml', days_old=5)
+        new = self.write('new.xml', days_old=1)
+        other = os.path.join(self.dest + '-other', 'old.xml')
+        record_locations(self.db, [other],
+                         seen=datetime.utcnow() - timedelta(days=5))
+
+        assert clean_expired(self.db, self.dest, max_days=3) == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(new)
+        assert self.db.WafFiles.find_one({'_id': new}) is not None
+        # entries outside of the folder are left alone
+        assert self.db.WafFiles.find_one({'_id': other}) is not None
+
+    def test_unindexed_files_expire(self):
+        os.mkdir(os.path.join(self.dest, 'orgA'))
+        os.mkdir(os.path.join(self.dest, 'orgB'))
+        indexed = self.write(os.path.join('orgA', 'a.xml'), days_old=10)
+        orphan = self.write(os.path.join('orgB', 'orphan.xml'), days_old=10)
+        record_locations(self.db, [indexed],
+                         seen=datetime.utcnow() - timedelta(days=10))
+
+        assert clean_expired(self.db, self.dest, max_days=3) == 2
+        assert not os.path.exists(indexed)
+        assert not os.path.exists(orphan)
+
+    def test_reconcile_days(self):
+        clean_expired(self.db, self.dest, max_days=3)
+        orphan = self.write('orphan.xml', days_old=10)
+        # the folder was walked recently
+        assert clean_expired(self.db, self.dest, max_days=3) == 0
+        assert os.path.exists(orphan)
+        assert clean_expired(self.db, self.dest, max_days=3,
+                             reconcile_days=0) == 1
+        assert not os.path.exists(orphan)
+
+    def test_reconcile_keeps_last_seen(self):
+        filepath = self.write('seen.xml', days_old=10)
+        record_locations(self.db, [filepath])
+        assert clean_expired(self.db, self.dest, max_days=3) == 0
+        assert os.path.exists(filepath)